@@ -0,0 +1,144 @@
+#!/usr/bin/env python3
+"""
+Category cache benchmark.
+
+Reports how many rows of held-out spreadsheets the category cache would
+resolve after learning the answers of training spreadsheets, and how many of
+those it gets right, for the normalizer the backend runs (simple_normalize)
+and for Utils.token_and_stem when the model package and its nltk data can be
+loaded. No table is needed, the counts are kept in memory. Run with
+`python -m backend.benchmarks.categories train.xlsx ... --test held.xlsx ...`.
+Without spreadsheets it runs on a synthetic ledger.
+"""
+
+import os
+import sys
+import time
+from collections import Counter
+import numpy as np
+
+from backend.utils.categories import CategoryCache, load_normalizer, simple_normalize
+from backend.utils.model.excel import to_pandas
+
+
+def spreadsheet_ledger(paths):
+    """
+    Spreadsheet ledger.
+
+    Vendors, descriptions and categories of labeled spreadsheets.
+    """
+    vendors, descriptions, categories = [], [], []
+    for path in paths:
+        df = to_pandas(path)
+        vendors += df["vendor"].tolist()
+        descriptions += [
+            description if isinstance(description, str) else None
+            for description in df["description"]
+        ]
+        categories += df["category"].tolist()
+    return vendors, descriptions, categories
+
+
+def synthetic_ledger(rows, seed, vendor_count=2000):
+    """
+    Synthetic ledger.
+
+    Vendors spelled a few ways with the category of their account, drawn
+    from the first vendor_count vendors.
+    """
+    # the vendors and their categories are the same for every seed
+    names = np.random.default_rng(0)
+    letters = np.array(list("abcdefghijklmnopqrstuvwxyz"))
+    vendors = [
+        "".join(names.choice(letters, names.integers(4, 10))).title()
+        for _ in range(2000)
+    ]
+    categories = [f"Category {i}" for i in range(40)]
+    owner = names.integers(0, len(categories), len(vendors))
+    rng = np.random.default_rng(seed)
+    suffix = np.array(["", " LLC", " Inc.", " #1042", " Co", " Supplies", "'s"])
+    picks = rng.integers(0, vendor_count, rows)
+    return (
+        [vendors[i] + suffix[rng.integers(0, len(suffix))] for i in picks],
+        ["Expense"] * rows,
+        [categories[owner[i]] for i in picks],
+    )
+
+
+def report(name, normalize, train, test):
+    """
+    Report.
+
+    Learns the training answers under the keys of normalize and prints the
+    share of test rows resolved and their accuracy.
+    """
+    cache = CategoryCache(
+        None,
+        None,
+        None,
+        None,
+        int(os.environ.get("CATEGORY_MIN_COUNT", "3")),
+        float(os.environ.get("CATEGORY_MIN_CONFIDENCE", "0.9")),
+        0,
+        0,
+        normalize,
+    )
+    start = time.perf_counter()
+    counts = {}
+    for vendor, description, category in zip(*train):
+        key = cache.key(vendor, description)
+        counts.setdefault(key, Counter())[category] += 1
+    trusted = {key: cache.confident(found) for key, found in counts.items()}
+    hits = 0
+    right = 0
+    for vendor, description, category in zip(*test):
+        found = trusted.get(cache.key(vendor, description))
+        if found is not None:
+            hits += 1
+            right += found == category
+    seconds = time.perf_counter() - start
+    rows = len(test[0])
+    print(
+        f"{name:16} {len(counts):7} keys  resolved {hits / rows:6.1%} of rows  "
+        f"accuracy {right / hits if hits else 0.0:6.1%}  {seconds:.2f}s"
+    )
+
+
+def main(train, test):
+    """
+    Main.
+
+    Reports on test after learning train, for every normalizer that loads.
+    """
+    if train:
+        train_rows = spreadsheet_ledger(train)
+        test_rows = spreadsheet_ledger(test)
+    else:
+        # a fifth of the held-out vendors were never seen
+        train_rows = synthetic_ledger(50_000, 0, 1600)
+        test_rows = synthetic_ledger(100_000, 1)
+    report("simple_normalize", simple_normalize, train_rows, test_rows)
+    os.environ["CATEGORY_NORMALIZER"] = "stem"
+    normalize = load_normalizer()
+    if normalize is not simple_normalize:
+        report("token_and_stem", normalize, train_rows, test_rows)
+
+
+def split_args(args):
+    """
+    Split args.
+
+    Training files and --test files.
+    """
+    train, test = [], []
+    target = train
+    for arg in args:
+        if arg == "--test":
+            target = test
+        else:
+            target.append(arg)
+    return train, test
+
+
+if __name__ == "__main__":
+    main(*split_args(sys.argv[1:]))
@@ -0,0 +1,120 @@
+#!/usr/bin/env python3
+"""
+Classifier benchmark.
+
+Trains the local classifier and reports rows/sec and accuracy on held-out
+spreadsheets. Run with
+`python -m backend.benchmarks.classifier train.xlsx ... --test held.xlsx ...`
+and add `--save model.npz` to keep the classifier for CLASSIFIER_PATH.
+Without spreadsheets it runs on a synthetic ledger, which only shows speed.
+"""
+
+import sys
+import time
+import numpy as np
+
+from backend.utils.model.classifier import (
+    NearestCategories,
+    row_text,
+    spreadsheet_rows,
+)
+
+THRESHOLDS = [0.0, 0.5, 0.6, 0.7, 0.8, 0.9]
+
+
+def synthetic_rows(rows, seed, vendor_count=2000):
+    """
+    Synthetic rows.
+
+    Vendors spelled a few ways with the category of their account, drawn
+    from the first vendor_count vendors.
+    """
+    # the vendors and their categories are the same for every seed
+    names = np.random.default_rng(0)
+    letters = np.array(list("abcdefghijklmnopqrstuvwxyz"))
+    vendors = [
+        "".join(names.choice(letters, names.integers(4, 10))).title() + " Supply"
+        for _ in range(2000)
+    ]
+    categories = [f"Category {i}" for i in range(40)]
+    owner = names.integers(0, len(categories), len(vendors))
+    rng = np.random.default_rng(seed)
+    suffix = np.array(["", " LLC", " Inc.", " #1042", " Co"])
+    picks = rng.integers(0, vendor_count, rows)
+    texts = [
+        row_text(vendors[i] + suffix[rng.integers(0, len(suffix))], "Expense")
+        for i in picks
+    ]
+    return texts, [categories[owner[i]] for i in picks]
+
+
+def report(model, texts, categories):
+    """
+    Report.
+
+    Prints rows/sec of predict, then accuracy and coverage at every
+    confidence threshold.
+    """
+    start = time.perf_counter()
+    names, confidence = model.predict(texts)
+    seconds = time.perf_counter() - start
+    print(f"predict {len(texts)} rows {seconds:.2f}s {len(texts) / seconds:.0f} rows/s")
+    right = np.array(names, dtype=object) == np.array(categories, dtype=object)
+    for threshold in THRESHOLDS:
+        kept = confidence >= threshold
+        accuracy = right[kept].mean() if kept.any() else 0.0
+        print(
+            f"confidence >= {threshold:.1f}  local {kept.mean():6.1%} of rows  "
+            f"accuracy {accuracy:6.1%}"
+        )
+
+
+def main(train, test, save):
+    """
+    Main.
+
+    Fits on train, reports on test.
+    """
+    if train:
+        train_texts, train_categories = spreadsheet_rows(train)
+        test_texts, test_categories = spreadsheet_rows(test)
+    else:
+        # a fifth of the held-out vendors were never seen
+        train_texts, train_categories = synthetic_rows(50_000, 0, 1600)
+        test_texts, test_categories = synthetic_rows(100_000, 1)
+    start = time.perf_counter()
+    model = NearestCategories.fit(train_texts, train_categories)
+    seconds = time.perf_counter() - start
+    print(
+        f"fit {len(train_texts)} rows ({model.vectors.shape[0]} distinct) "
+        f"{seconds:.2f}s"
+    )
+    report(model, test_texts, test_categories)
+    if save:
+        model.save(save)
+        print(f"saved to {save}")
+
+
+def split_args(args):
+    """
+    Split args.
+
+    Training files, --test files and the --save path.
+    """
+    train, test, save = [], [], None
+    target = train
+    i = 0
+    while i < len(args):
+        if args[i] == "--test":
+            target = test
+        elif args[i] == "--save":
+            save = args[i + 1]
+            i += 1
+        else:
+            target.append(args[i])
+        i += 1
+    return train, test, save
+
+
+if __name__ == "__main__":
+    main(*split_args(sys.argv[1:]))
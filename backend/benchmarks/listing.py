@@ -0,0 +1,111 @@
+#!/usr/bin/env python3
+"""
+Listing benchmark.
+
+Times listing one user's files by scan and through the username index while
+other tenants' files grow, against moto's local DynamoDB. Needs moto installed.
+Moto answers index queries by filtering in memory, so its query times still
+creep up; against DynamoDB Local or AWS they stay flat. Run with
+`python -m backend.benchmarks.listing [tenant files ...]`.
+"""
+
+import os
+import sys
+import time
+import boto3
+from moto import mock_aws
+
+from backend.utils.db.dynamo import query_items_user
+
+DEFAULT_SIZES = [1_000, 10_000, 50_000]
+USER_FILES = 50
+RUNS = 5
+
+
+def create_table(db_client):
+    """
+    Create table.
+
+    File table with the same keys and username index as production.
+    """
+    db_client.create_table(
+        TableName=os.environ["AWS_FILE_TABLE_NAME"],
+        KeySchema=[
+            {"AttributeName": "fileid", "KeyType": "HASH"},
+            {"AttributeName": "username", "KeyType": "RANGE"},
+        ],
+        AttributeDefinitions=[
+            {"AttributeName": "fileid", "AttributeType": "S"},
+            {"AttributeName": "username", "AttributeType": "S"},
+        ],
+        GlobalSecondaryIndexes=[
+            {
+                "IndexName": "username-index",
+                "KeySchema": [{"AttributeName": "username", "KeyType": "HASH"}],
+                "Projection": {"ProjectionType": "ALL"},
+            }
+        ],
+        BillingMode="PAY_PER_REQUEST",
+    )
+
+
+def add_files(db_client, username, start, count):
+    """
+    Add files.
+
+    Puts count unprocessed files for a user.
+    """
+    for i in range(start, start + count):
+        db_client.put_item(
+            TableName=os.environ["AWS_FILE_TABLE_NAME"],
+            Item={
+                "fileid": {"S": f"{username}-{i}"},
+                "username": {"S": username},
+                "filename": {"S": f"ledger-{i}.csv"},
+                "processed": {"S": "not processed"},
+                "jobid": {"S": "none"},
+            },
+        )
+
+
+def time_listing(db_client, index):
+    """
+    Time listing.
+
+    Average seconds to list the benchmark user's files.
+    """
+    os.environ["AWS_FILE_TABLE_USER_INDEX"] = index
+    start = time.perf_counter()
+    for _ in range(RUNS):
+        items = list(query_items_user("bench", db_client))
+    assert len(items) == USER_FILES
+    return (time.perf_counter() - start) / RUNS
+
+
+def main(sizes):
+    """
+    Main.
+
+    Grows the other tenants' files and prints both listing times.
+    """
+    os.environ.setdefault("AWS_DEFAULT_REGION", "us-east-1")
+    os.environ.setdefault("AWS_FILE_TABLE_NAME", "treya-files")
+    with mock_aws():
+        db_client = boto3.client("dynamodb")
+        create_table(db_client)
+        add_files(db_client, "bench", 0, USER_FILES)
+        tenants = 0
+        for size in sizes:
+            add_files(db_client, "tenant", tenants, size - tenants)
+            tenants = size
+            scan = time_listing(db_client, "")
+            query = time_listing(db_client, "username-index")
+            print(
+                f"{size:>7} other files  scan {scan * 1000:8.1f}ms  "
+                f"query {query * 1000:6.1f}ms"
+            )
+
+
+if __name__ == "__main__":
+    sizes = [int(i) for i in sys.argv[1:]]
+    main(sizes or DEFAULT_SIZES)
@@ -0,0 +1,183 @@
+#!/usr/bin/env python3
+"""
+Prompt benchmark.
+
+Compares the row by row prompt conversion with the batched one on synthetic
+csvs. Run with `python -m backend.benchmarks.prompts [rows ...]`. Add
+`--tokens` for the estimated tokens of the compact prompts instead.
+"""
+
+import os
+import sys
+import json
+import time
+import tempfile
+import numpy as np
+import pandas as pd
+
+from backend.utils.db.uploader import convert_frame, convert_line, convert_to_prompts
+from backend.utils.db.prompts import (
+    PromptCompiler,
+    count_tokens,
+    new_token_counts,
+    token_savings,
+)
+
+DEFAULT_ROWS = [10_000, 100_000, 1_000_000]
+# compiler settings compared by --tokens
+COMPILERS = {
+    "compact": PromptCompiler(),
+    "compact, 2 columns": PromptCompiler(["Original Vendor", "GL Account Description"]),
+    "compact, 2 columns, 20 rows": PromptCompiler(
+        ["Original Vendor", "GL Account Description"], 0, 20
+    ),
+}
+
+
+def make_csv(path, rows, seed=0):
+    """
+    Make csv.
+
+    Writes a ledger shaped csv with 5 preamble lines and some empty cells.
+    """
+    rng = np.random.default_rng(seed)
+    vendors = np.array([f"Vendor {i} LLC" for i in range(500)])
+    accounts = np.array([f"GL {i} Expense" for i in range(40)])
+    amount = rng.uniform(1, 5000, rows).round(2)
+    memo = np.where(rng.random(rows) < 0.3, None, "monthly invoice")
+    df = pd.DataFrame(
+        {
+            "Date": pd.date_range("2023-01-01", periods=rows, freq="min").strftime(
+                "%m/%d/%Y"
+            ),
+            "Original Vendor": vendors[rng.integers(0, len(vendors), rows)],
+            "GL Account Description": accounts[rng.integers(0, len(accounts), rows)],
+            "Amount": amount,
+            "Memo": memo,
+        }
+    )
+    with open(path, "w") as f:
+        f.write("Report\nTreya Partners\nGeneral Ledger\nPeriod: 2023\n")
+        f.write("Basis: Accrual\n")
+        df.to_csv(f, index=False)
+
+
+def convert_to_prompts_rows(input_path, output_path, dtype=None):
+    """
+    Convert to prompts rows.
+
+    The previous iterrows implementation, kept for comparison. It let pandas
+    infer the column types, so 3 in a column with blanks became 3.0 and 007
+    became 7. Pass dtype=str for the text the batched path now gives.
+    """
+    df = pd.read_csv(input_path, header=5, dtype=dtype)
+    prompts = []
+    for index, row in df.iterrows():
+        prompts.append(
+            {
+                "modelInput": {
+                    "anthropic_version": "bedrock-2023-05-31",
+                    "max_tokens": 1024,
+                    "messages": [
+                        {
+                            "role": "user",
+                            "content": [
+                                {"type": "text", "text": convert_line(df, index)}
+                            ],
+                        }
+                    ],
+                },
+            }
+        )
+    with open(output_path, "w") as f:
+        for prompt in prompts:
+            f.write(json.dumps(prompt))
+            f.write("\n")
+
+
+def timed(function, *args):
+    """
+    Timed.
+
+    Runs a function and gives back the seconds it took.
+    """
+    start = time.perf_counter()
+    function(*args)
+    return time.perf_counter() - start
+
+
+def compiled_texts(df, compiler):
+    """
+    Compiled texts.
+
+    Prompt texts of a frame built by compiler, packed like the upload packs
+    rows that all get sent.
+    """
+    rows = compiler.rows(df)
+    size = compiler.rows_per_request
+    if size == 1:
+        return [compiler.single(row) for row in rows]
+    return [compiler.pack(rows[i : i + size]) for i in range(0, len(rows), size)]
+
+
+def tokens(sizes):
+    """
+    Tokens.
+
+    Prints the estimated input tokens of every compiler next to the full
+    template.
+    """
+    with tempfile.TemporaryDirectory() as tmp:
+        for rows in sizes:
+            csv_path = os.path.join(tmp, f"{rows}.csv")
+            make_csv(csv_path, rows)
+            df = pd.read_csv(csv_path, header=5, dtype=str)
+            full = convert_frame(df)
+            for name, compiler in COMPILERS.items():
+                counts = new_token_counts()
+                count_tokens(counts, full, compiled_texts(df, compiler))
+                print(
+                    f"{rows:>9} rows  {name:<30} {counts['sent']:>11} tokens "
+                    f"of {counts['full']:>11}  {token_savings(counts):6.1%} saved"
+                )
+
+
+def main(sizes):
+    """
+    Main.
+
+    Runs both converters for every size and prints rows/sec.
+    """
+    with tempfile.TemporaryDirectory() as tmp:
+        for rows in sizes:
+            csv_path = os.path.join(tmp, f"{rows}.csv")
+            make_csv(csv_path, rows)
+            batched_path = os.path.join(tmp, f"{rows}.batched.jsonl")
+            batched = timed(convert_to_prompts, csv_path, batched_path)
+            print(
+                f"{rows:>9} rows  batched {batched:8.2f}s "
+                f"{rows / batched:>10.0f} rows/s"
+            )
+            # the row by row path takes minutes past 100k rows
+            if rows > 100_000 and "--all" not in sys.argv:
+                continue
+            rows_path = os.path.join(tmp, f"{rows}.rows.jsonl")
+            by_row = timed(convert_to_prompts_rows, csv_path, rows_path)
+            # values are read as text now, compare with the row by row path
+            # reading them the same way
+            convert_to_prompts_rows(csv_path, rows_path, str)
+            with open(rows_path) as a, open(batched_path) as b:
+                same = a.read() == b.read()
+            print(
+                f"{rows:>9} rows  iterrows {by_row:7.2f}s "
+                f"{rows / by_row:>10.0f} rows/s  "
+                f"speedup {by_row / batched:.1f}x  same output: {same}"
+            )
+
+
+if __name__ == "__main__":
+    sizes = [int(i) for i in sys.argv[1:] if i.isdigit()]
+    if "--tokens" in sys.argv:
+        tokens(sizes or DEFAULT_ROWS)
+    else:
+        main(sizes or DEFAULT_ROWS)
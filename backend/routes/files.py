@@ -11,6 +11,7 @@ Handes the file route from websocket messages:
 import json
 import secrets
 import string
+from flask_socketio import join_room
 
 from backend.types.errors import CustomError
 from backend.utils.args import parse_args, parse_json
@@ -62,10 +63,28 @@ def upload_handler(message, socketio, db_client, s3_client):
 
         username = verify_jwt(args["token"])
 
+        chunk_size = message_json.get("chunk_size")
+        if chunk_size is not None:
+            chunk_size = int(chunk_size)
+
         fileid = generate_file_id()
         if not (message_json.get("fileid") is None):
             fileid = message_json.get("fileid")
 
+        def progress(part_number, uploaded):
+            socketio.emit(
+                "upload",
+                json.dumps(
+                    {
+                        "status": True,
+                        "finished": False,
+                        "part_number": part_number,
+                        "uploaded_bytes": uploaded,
+                        "response": 200,
+                    }
+                ),
+            )
+
         res = file_ingester(
             username,
             fileid,
@@ -75,6 +94,8 @@ def upload_handler(message, socketio, db_client, s3_client):
             args["total_chunks"],
             db_client,
             s3_client,
+            chunk_size,
+            progress,
         )
         finished = False
         if res == -1:
@@ -95,18 +116,22 @@ def upload_handler(message, socketio, db_client, s3_client):
         socketio.emit("upload", error_handler(e))
 
 
-def list_handler(message, socketio, db_client, bedrock_client):
+def list_handler(message, socketio, db_client, s3_client, bedrock_client):
     """
     List function.
 
     Takes in a username and returns a list of files that are owned.
+    Joins the user's room to get status updates. The job statuses are
+    brought up to date on every list, the job may be watched by another
+    server process.
     """
     try:
         args = parse_args(["token"], message)
 
         username = verify_jwt(args["token"])
+        join_room(username)
 
-        res = list_ingester(username, db_client, bedrock_client)
+        res = list_ingester(username, db_client, bedrock_client, s3_client)
 
         socketio.emit(
             "list", json.dumps({"status": True, "files": res, "response": 200})
@@ -115,19 +140,43 @@ def list_handler(message, socketio, db_client, bedrock_client):
         socketio.emit("list", json.dumps(error_handler(e)))
 
 
-def process_handler(message, socketio, db_client, s3_client, bedrock_client):
+def process_handler(
+    message,
+    socketio,
+    db_client,
+    s3_client,
+    bedrock_client,
+    watcher=None,
+    coalescer=None,
+    ondemand=None,
+):
     """
     Process function.
 
     Takes a file id and runs the model on that file and writes the output out.
+    The jobs are handed to the watcher, which reports when they are done.
+    Small files wait on the coalescer, which hands their shared job over
+    itself, or are run on demand.
     """
     try:
         message_json = parse_json(message)
         args = parse_args(["token", "fileid"], message_json)
 
         username = verify_jwt(args["token"])
+        join_room(username)
 
-        process_ingester(username, args["fileid"], db_client, s3_client, bedrock_client)
+        jobids = process_ingester(
+            username,
+            args["fileid"],
+            db_client,
+            s3_client,
+            bedrock_client,
+            coalescer,
+            ondemand,
+        )
+        if watcher is not None:
+            for jobid in jobids:
+                watcher.track(jobid, args["fileid"], username)
 
         socketio.emit(
             "process",
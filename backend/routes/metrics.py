@@ -0,0 +1,33 @@
+"""
+Metrics route.
+
+Handles the metrics websocket message.
+"""
+
+import json
+
+from backend.routes.files import error_handler
+from backend.utils.args import parse_args, parse_json
+from backend.utils.jwt import verify_jwt
+from backend.utils.metrics import collect_metrics
+
+
+def metrics_handler(
+    message, socketio, db_client, watcher=None, coalescer=None, ondemand=None
+):
+    """
+    Metrics function.
+
+    Takes a token and sends back a snapshot of the server's counters.
+    """
+    try:
+        message_json = parse_json(message)
+        args = parse_args(["token"], message_json)
+
+        verify_jwt(args["token"])
+        res = collect_metrics(db_client, watcher, coalescer, ondemand)
+        socketio.emit(
+            "metrics", json.dumps({"status": True, "metrics": res, "response": 200})
+        )
+    except Exception as e:
+        socketio.emit("metrics", error_handler(e))
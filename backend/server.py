@@ -20,6 +20,12 @@ from backend.routes.files import (
     get_handler,
     process_handler,
 )
+from backend.routes.metrics import metrics_handler
+from backend.utils.watcher import create_job_watcher
+from backend.utils.coalesce import create_coalescer
+from backend.utils.db.filedb import learn_ingester
+from backend.utils.model.model import create_ondemand
+from backend.utils.metrics import log_metrics
 
 load_dotenv()
 
@@ -30,8 +36,12 @@ Cors = CORS(
 )
 
 app.config["SECRET_KEY"] = os.environ.get("SECRET_KEY", "default_secret_key")
+# with several server processes a shared queue, like redis://, carries the
+# status pushes of one process to sockets held by the others
 socketio = SocketIO(
-    app, cors_allowed_origins=os.environ.get("ORIGIN", "localhost:3000")
+    app,
+    cors_allowed_origins=os.environ.get("ORIGIN", "localhost:3000"),
+    message_queue=os.environ.get("SOCKETIO_MESSAGE_QUEUE") or None,
 )
 session = boto3.Session(
     aws_access_key_id=os.environ.get("AWS_API_KEY"),
@@ -42,8 +52,41 @@ session = boto3.Session(
 db_client = session.client("dynamodb", region_name=os.environ.get("AWS_REGION"))
 s3_client = session.client("s3", region_name=os.environ.get("AWS_REGION"))
 bedrock_client = session.client("bedrock", region_name=os.environ.get("AWS_REGION"))
+runtime_client = session.client(
+    "bedrock-runtime", region_name=os.environ.get("AWS_REGION")
+)
 disable = os.environ.get("DISABLE", "False").lower() == "true"
 
+watcher = None
+if os.environ.get("JOB_WATCH", "True").lower() == "true":
+
+    def learn(fileid, username):
+        learn_ingester(username, fileid, db_client, s3_client)
+
+    watcher = create_job_watcher(socketio, db_client, bedrock_client, learn)
+    socketio.start_background_task(watcher.run)
+
+coalescer = None
+if os.environ.get("BATCH_COALESCE", "True").lower() == "true":
+    coalescer = create_coalescer(
+        socketio, db_client, s3_client, bedrock_client, watcher
+    )
+    socketio.start_background_task(coalescer.run)
+
+ondemand = create_ondemand(s3_client, runtime_client)
+
+metrics_interval = int(os.environ.get("METRICS_LOG_INTERVAL", "0"))
+if metrics_interval > 0:
+    socketio.start_background_task(
+        log_metrics,
+        socketio,
+        metrics_interval,
+        db_client,
+        watcher,
+        coalescer,
+        ondemand,
+    )
+
 
 @app.route("/", methods=["GET", "PUT", "POST", "PATCH", "DELETE"])
 def root():
@@ -86,7 +129,16 @@ def process_file(message):
     """
     if disable:
         return
-    process_handler(message, socketio, db_client, s3_client, bedrock_client)
+    process_handler(
+        message,
+        socketio,
+        db_client,
+        s3_client,
+        bedrock_client,
+        watcher,
+        coalescer,
+        ondemand,
+    )
 
 
 @socketio.on("list")
@@ -96,7 +148,7 @@ def list_file(message):
 
     Lists all the files available to the user.
     """
-    list_handler(message, socketio, db_client, bedrock_client)
+    list_handler(message, socketio, db_client, s3_client, bedrock_client)
 
 
 @socketio.on("get")
@@ -121,6 +173,16 @@ def delete_file(message):
     delete_handler(message, socketio, db_client, s3_client)
 
 
+@socketio.on("metrics")
+def get_metrics(message):
+    """
+    Metrics route.
+
+    Gets the counters of the caches, uploads and background tasks.
+    """
+    metrics_handler(message, socketio, db_client, watcher, coalescer, ondemand)
+
+
 if __name__ == "__main__":
     debug = os.environ.get("DEBUG", "False").lower() == "true"
     socketio.run(app, debug=debug)
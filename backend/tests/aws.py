@@ -0,0 +1,90 @@
+"""
+AWS stand-ins.
+
+Env, tables, buckets and a socketio stand-in shared by the tests, against
+moto's local AWS.
+"""
+
+import os
+import json
+import tempfile
+
+ENV = {
+    "AWS_DEFAULT_REGION": "us-east-1",
+    "AWS_ACCESS_KEY_ID": "testing",
+    "AWS_SECRET_ACCESS_KEY": "testing",
+    "AWS_FILE_TABLE_NAME": "files",
+    "AWS_S3_UPLOAD_NAME": "uploads",
+}
+
+
+def set_env(**extra):
+    """
+    Set env.
+
+    Points the backend at moto and a fresh temp directory.
+    """
+    os.environ.update(ENV, TEMP_FILE_LOCATION=tempfile.mkdtemp(), **extra)
+
+
+def create_file_table(db_client):
+    """
+    Create file table.
+
+    File table with the keys of production.
+    """
+    db_client.create_table(
+        TableName=os.environ["AWS_FILE_TABLE_NAME"],
+        KeySchema=[
+            {"AttributeName": "fileid", "KeyType": "HASH"},
+            {"AttributeName": "username", "KeyType": "RANGE"},
+        ],
+        AttributeDefinitions=[
+            {"AttributeName": "fileid", "AttributeType": "S"},
+            {"AttributeName": "username", "AttributeType": "S"},
+        ],
+        BillingMode="PAY_PER_REQUEST",
+    )
+
+
+def create_bucket(s3_client):
+    """
+    Create bucket.
+
+    Upload bucket of the backend.
+    """
+    s3_client.create_bucket(Bucket=os.environ["AWS_S3_UPLOAD_NAME"])
+
+
+class FakeSocketIO:
+    """
+    Fake socketio.
+
+    Records emitted events instead of sending them.
+    """
+
+    def __init__(self):
+        """
+        Init function.
+
+        Starts with nothing emitted.
+        """
+        self.emitted = []
+
+    def emit(self, event, data, to=None):
+        """
+        Emit method.
+
+        Records an event with its data parsed back from json.
+        """
+        if isinstance(data, str):
+            data = json.loads(data)
+        self.emitted.append((event, data, to))
+
+    def events(self, event):
+        """
+        Events method.
+
+        Data of every emitted event called event.
+        """
+        return [data for name, data, _ in self.emitted if name == event]
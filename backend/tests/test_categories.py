@@ -0,0 +1,162 @@
+"""
+Category cache tests.
+
+Checks when a vendor's categories are trusted, that answers learned from
+finished files resolve later rows without sending them, and that wrong
+categories can be forgotten, against moto. Run with
+`python -m unittest backend.tests.test_categories`.
+"""
+
+import unittest
+import boto3
+import pandas as pd
+from moto import mock_aws
+
+from backend.tests.aws import set_env
+from backend.utils.categories import CategoryCache, simple_normalize
+from backend.utils.db.uploader import new_prompt_state, prompt_lines
+
+TABLE = "categories"
+
+
+def create_cache(db_client, min_count=3, min_confidence=0.9, max_entries=100):
+    """
+    Create cache.
+
+    A category cache over the table, keyed by vendor and description.
+    """
+    return CategoryCache(
+        db_client,
+        TABLE,
+        "Original Vendor",
+        "GL Account Description",
+        min_count,
+        min_confidence,
+        max_entries,
+        300,
+        simple_normalize,
+    )
+
+
+class ConfidentTest(unittest.TestCase):
+    """
+    Confident test.
+
+    When counts are trusted.
+    """
+
+    def test_confident(self):
+        """
+        Confident.
+
+        A category is trusted once there are min_count answers and enough
+        of them agree.
+        """
+        cache = create_cache(None)
+        self.assertIsNone(cache.confident({}))
+        self.assertIsNone(cache.confident({"Food": 2}))
+        self.assertEqual(cache.confident({"Food": 3}), "Food")
+        self.assertEqual(cache.confident({"Food": 9, "Travel": 1}), "Food")
+        self.assertIsNone(cache.confident({"Food": 8, "Travel": 2}))
+        self.assertEqual(
+            create_cache(None, 1, 0.5).confident({"Food": 1, "Travel": 1}), "Food"
+        )
+
+    def test_keys(self):
+        """
+        Keys.
+
+        Rows are keyed by normalized vendor and description, rows without a
+        vendor get none.
+        """
+        cache = create_cache(None)
+        df = pd.DataFrame(
+            {
+                "Original Vendor": ["ACME  Corp #12345", None, " "],
+                "GL Account Description": ["Office-Supplies", "Food", "Food"],
+            }
+        )
+        self.assertEqual(cache.row_keys(df), ["acme corp|office supplies", None, None])
+        self.assertEqual(cache.row_keys(df[["GL Account Description"]]), [None] * 3)
+
+
+class CategoryCacheTest(unittest.TestCase):
+    """
+    Category cache test.
+
+    Learning and resolving over a moto table.
+    """
+
+    def setUp(self):
+        """
+        Set up.
+
+        Creates the table.
+        """
+        set_env()
+        self.aws = mock_aws()
+        self.aws.start()
+        self.db_client = boto3.client("dynamodb")
+        self.db_client.create_table(
+            TableName=TABLE,
+            KeySchema=[{"AttributeName": "key", "KeyType": "HASH"}],
+            AttributeDefinitions=[{"AttributeName": "key", "AttributeType": "S"}],
+            BillingMode="PAY_PER_REQUEST",
+        )
+        self.cache = create_cache(self.db_client)
+
+    def tearDown(self):
+        """
+        Tear down.
+
+        Stops moto.
+        """
+        self.aws.stop()
+
+    def test_learned_answers_resolve_rows(self):
+        """
+        Learned answers resolve rows.
+
+        A key is resolved once enough answers agree, also by another cache
+        on the same table, and the rows it resolves are not sent.
+        """
+        key = self.cache.key("Acme", "Supplies")
+        self.assertEqual(self.cache.resolve([key]), [None])
+        self.cache.learn([(key, "Office "), (key, "Office"), (None, "Food")])
+        self.assertEqual(self.cache.resolve([key]), [None])
+        self.cache.learn([(key, "Office"), (key, "")])
+        self.assertEqual(self.cache.resolve([key, None]), ["Office", None])
+        other = create_cache(self.db_client)
+        self.assertEqual(other.resolve([key]), ["Office"])
+        df = pd.DataFrame(
+            {
+                "Original Vendor": ["Acme", "Beta", "ACME"],
+                "GL Account Description": ["Supplies", "Supplies", "supplies"],
+            }
+        )
+        state = new_prompt_state("C" * 32)
+        lines = prompt_lines(state, df, other)
+        self.assertEqual(len(lines), 1)
+        self.assertIn("Beta", lines[0])
+        self.assertEqual(dict(state["resolved"].items()), {0: "Office", 2: "Office"})
+        self.assertEqual(other.metrics()["hits"], 3)
+
+    def test_invalidate_and_local_copy(self):
+        """
+        Invalidate and local copy.
+
+        Resolved keys are kept locally, invalidate forgets a key in the
+        table and locally.
+        """
+        key = self.cache.key("Acme")
+        self.cache.learn([(key, "Office")] * 3)
+        self.assertEqual(self.cache.resolve([key]), ["Office"])
+        reads = self.cache.metrics()["reads"]
+        self.assertEqual(self.cache.resolve([key, key]), ["Office", "Office"])
+        self.assertEqual(self.cache.metrics()["reads"], reads)
+        self.cache.invalidate("Acme")
+        self.assertEqual(self.cache.resolve([key]), [None])
+
+
+if __name__ == "__main__":
+    unittest.main()
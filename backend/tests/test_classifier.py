@@ -0,0 +1,148 @@
+"""
+Classifier tests.
+
+Checks the nearest neighbour classifier finds the training rows closest to
+a text, is sure about exact matches and not about strangers, survives being
+saved, and only resolves rows it is confident about. Run with
+`python -m unittest backend.tests.test_classifier`.
+"""
+
+import os
+import string
+import tempfile
+import unittest
+import numpy as np
+import pandas as pd
+from scipy import sparse
+
+from backend.utils.model.classifier import (
+    LocalResolver,
+    NearestCategories,
+    row_text,
+    top_neighbours,
+)
+
+CATEGORIES = ["Food Expense", "Travel", "Office Supplies", "Utilities"]
+
+
+def training_rows(count=200, seed=0):
+    """
+    Training rows.
+
+    Texts of random made up vendors and their categories.
+    """
+    rng = np.random.default_rng(seed)
+    letters = np.array(list(string.ascii_lowercase))
+    texts = ["".join(rng.choice(letters, 12)) for _ in range(count)]
+    categories = [CATEGORIES[i % len(CATEGORIES)] for i in range(count)]
+    return texts, categories
+
+
+class NearestCategoriesTest(unittest.TestCase):
+    """
+    Nearest categories test.
+
+    A classifier fit on made up vendors.
+    """
+
+    @classmethod
+    def setUpClass(cls):
+        """
+        Set up class.
+
+        Fits the classifier once.
+        """
+        cls.texts, cls.categories = training_rows()
+        cls.model = NearestCategories.fit(cls.texts, cls.categories)
+
+    def test_row_text(self):
+        """
+        Row text.
+
+        Lowercased, punctuation and long numbers removed, description added.
+        """
+        self.assertEqual(
+            row_text("ACME, Inc. #12345", "Office-Supplies"), "acme inc office supplies"
+        )
+        self.assertEqual(row_text("Shop 12", None), "shop 12")
+
+    def test_top_neighbours(self):
+        """
+        Top neighbours.
+
+        Gives the k best columns of every row best first, like sorting
+        does, with empty rows and short rows padded.
+        """
+        rng = np.random.default_rng(1)
+        dense = rng.random((6, 30)) * (rng.random((6, 30)) < 0.3)
+        dense[2] = 0
+        dense[4, :] = 0
+        dense[4, 7] = 0.5
+        sims, neighbours = top_neighbours(sparse.csr_matrix(dense), 3)
+        for row in range(6):
+            order = [
+                col
+                for col in np.argsort(-dense[row], kind="stable")
+                if dense[row, col] > 0
+            ][:3]
+            self.assertEqual(neighbours[row][: len(order)].tolist(), order)
+            self.assertTrue(np.allclose(sims[row][: len(order)], dense[row, order]))
+            self.assertTrue((neighbours[row][len(order) :] == -1).all())
+
+    def test_exact_matches_are_sure(self):
+        """
+        Exact matches are sure.
+
+        Training texts get their own category with high confidence, short of
+        1 only by the few n-grams neighbours of other categories share, and
+        a text like none of them gets little.
+        """
+        names, confidence = self.model.predict(self.texts[:20] + ["zzzz qqqq"])
+        self.assertEqual(names[:20], self.categories[:20])
+        self.assertTrue((confidence[:20] > 0.9).all())
+        self.assertLess(confidence[20], 0.5)
+        names, confidence = self.model.predict([])
+        self.assertEqual((names, len(confidence)), ([], 0))
+
+    def test_save_and_load(self):
+        """
+        Save and load.
+
+        A loaded classifier predicts like the one saved.
+        """
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, "classifier.npz")
+            self.model.save(path)
+            loaded = NearestCategories.load(path)
+        texts = self.texts[::7] + ["zzzz qqqq"]
+        names, confidence = self.model.predict(texts)
+        loaded_names, loaded_confidence = loaded.predict(texts)
+        self.assertEqual(loaded_names, names)
+        self.assertTrue(np.allclose(loaded_confidence, confidence))
+
+    def test_resolver_keeps_unsure_rows(self):
+        """
+        Resolver keeps unsure rows.
+
+        Only confident rows among those asked about are resolved, rows
+        without a vendor never are.
+        """
+        resolver = LocalResolver(self.model, "Vendor", "Description", 0.8)
+        df = pd.DataFrame(
+            {
+                "Vendor": [self.texts[0], "zzzz qqqq", None, self.texts[1]],
+                "Description": [None, None, "Food", None],
+            }
+        )
+        self.assertEqual(
+            resolver.resolve(df), [self.categories[0], None, None, self.categories[1]]
+        )
+        self.assertEqual(
+            resolver.resolve(df, [1, 3]), [None, None, None, self.categories[1]]
+        )
+        self.assertEqual(resolver.resolve(df[["Description"]]), [None] * 4)
+        self.assertEqual(resolver.metrics()["hits"], 3)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,174 @@
+"""
+Coalescer tests.
+
+Checks that small files are queued once, taken off the queue up to the byte
+cap and sent as one shared job whose output is split back per file, against
+moto with the local engine. Run with
+`python -m unittest backend.tests.test_coalesce`.
+"""
+
+import os
+import json
+import unittest
+import boto3
+import pandas as pd
+from moto import mock_aws
+
+from backend.tests.aws import FakeSocketIO, create_bucket, create_file_table, set_env
+from backend.utils.batch import LOCAL_JOB_PREFIX
+from backend.utils.coalesce import BatchCoalescer
+from backend.utils.db import cache
+from backend.utils.db.dynamo import create_item_db, get_item_db
+from backend.utils.db.filedb import get_ingester
+from backend.utils.db.uploader import convert_to_lines
+from backend.utils.model import model
+
+USERNAME = "user"
+
+
+class CoalescerTest(unittest.TestCase):
+    """
+    Coalescer test.
+
+    A coalescer over a moto table and bucket.
+    """
+
+    def setUp(self):
+        """
+        Set up.
+
+        Creates the table and bucket, and a coalescer sending at 100 bytes
+        or after a minute, on the local engine.
+        """
+        set_env(MODEL_ENGINE="local", CLASSIFIER_PATH="")
+        self.aws = mock_aws()
+        self.aws.start()
+        self.db_client = boto3.client("dynamodb")
+        self.s3_client = boto3.client("s3")
+        create_file_table(self.db_client)
+        create_bucket(self.s3_client)
+        self.bucket = os.environ["AWS_S3_UPLOAD_NAME"]
+        model.engine = None
+        cache.result_cache = None
+        self.coalescer = self.create()
+
+    def tearDown(self):
+        """
+        Tear down.
+
+        Stops moto and drops the engine.
+        """
+        model.engine = None
+        self.aws.stop()
+
+    def create(self):
+        """
+        Create method.
+
+        A coalescer, with its own owner.
+        """
+        return BatchCoalescer(
+            FakeSocketIO(),
+            self.db_client,
+            self.s3_client,
+            None,
+            self.bucket,
+            100,
+            60,
+        )
+
+    def add_file(self, fileid, rows=0):
+        """
+        Add file.
+
+        Creates a file with rows prompts in its input.
+        """
+        create_item_db(fileid, USERNAME, "ledger.csv", self.db_client)
+        if rows:
+            df = pd.DataFrame(
+                {"Vendor": [f"{fileid[0]} shop {i}" for i in range(rows)]}
+            )
+            self.s3_client.put_object(
+                Bucket=self.bucket,
+                Key=f"input/{fileid}.jsonl",
+                Body="".join(convert_to_lines(df, fileid)),
+            )
+
+    def test_take_up_to_max_bytes(self):
+        """
+        Take up to max bytes.
+
+        Files come off the queue in order while they fit under max_bytes,
+        a file bigger than that on its own.
+        """
+        for n, size in enumerate([40, 50, 30, 200]):
+            self.add_file(str(n) * 32)
+            self.coalescer.add(str(n) * 32, USERNAME, size)
+        self.assertEqual(self.coalescer.metrics()["pending_bytes"], 320)
+        self.assertTrue(self.coalescer.due(0))
+        taken = [[size for _, _, size in self.coalescer.take()] for _ in range(4)]
+        self.assertEqual(taken, [[40, 50], [30], [200], []])
+        self.assertEqual(self.coalescer.metrics()["pending_bytes"], 0)
+        self.assertFalse(self.coalescer.due(0))
+
+    def test_due_after_max_wait(self):
+        """
+        Due after max wait.
+
+        A queue under max_bytes is due once its oldest file waited max_wait.
+        """
+        self.add_file("A" * 32)
+        self.coalescer.add("A" * 32, USERNAME, 10)
+        since = self.coalescer.since
+        self.assertFalse(self.coalescer.due(since + 59))
+        self.assertTrue(self.coalescer.due(since + 60))
+
+    def test_claimed_files_queued_once(self):
+        """
+        Claimed files queued once.
+
+        A file is queued once, and not by a second coalescer.
+        """
+        self.add_file("A" * 32)
+        self.coalescer.add("A" * 32, USERNAME, 10)
+        self.coalescer.add("A" * 32, USERNAME, 10, mark=False)
+        other = self.create()
+        other.add("A" * 32, USERNAME, 10, mark=False)
+        self.assertEqual(self.coalescer.metrics()["pending"], 1)
+        self.assertEqual(other.metrics()["pending"], 0)
+
+    def test_shared_job_split_per_file(self):
+        """
+        Shared job split per file.
+
+        Queued files go out as one job over a shared input, each keeps its
+        own rows when downloaded, and a file without prompts is set back to
+        not processed.
+        """
+        files = {"A" * 32: 3, "B" * 32: 2, "C" * 32: 0}
+        for fileid, rows in files.items():
+            self.add_file(fileid, rows)
+            self.coalescer.add(fileid, USERNAME, 10)
+        jobid = self.coalescer.flush()
+        self.assertTrue(jobid.startswith(LOCAL_JOB_PREFIX))
+        self.assertEqual(self.coalescer.metrics()["files"], 2)
+        for fileid, rows in files.items():
+            item = get_item_db(fileid, USERNAME, self.db_client)
+            if rows == 0:
+                self.assertEqual(item["processed"], "not processed")
+                continue
+            self.assertEqual(len(item["jobs"]), 1)
+            self.assertEqual(item["jobs"][0]["jobid"], jobid)
+            name = item["jobs"][0]["input"]
+            self.assertTrue(name.startswith("batch-"))
+            socketio = FakeSocketIO()
+            get_ingester(USERNAME, fileid, socketio, self.db_client, self.s3_client)
+            data = socketio.events("download")[-1]["data"]
+            self.assertEqual(len(data), rows)
+        body = self.s3_client.get_object(Bucket=self.bucket, Key=f"input/{name}")
+        records = [json.loads(line)["recordId"] for line in body["Body"].iter_lines()]
+        self.assertEqual([record[0] for record in records], ["A"] * 3 + ["B"] * 2)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,144 @@
+"""
+Dedup tests.
+
+Checks that repeated prompts are sent once and every row is put back from
+the answer of its unique prompt, and the recordId and row order helpers
+that read the answers. Run with `python -m unittest backend.tests.test_dedup`.
+"""
+
+import os
+import json
+import unittest
+import boto3
+import numpy as np
+from moto import mock_aws
+
+from backend.tests.aws import create_bucket, set_env
+from backend.utils.db.dedup import (
+    NOT_SENT,
+    dedup_texts,
+    expand,
+    new_dedup_state,
+    read_index,
+    upload_index,
+)
+from backend.utils.db.filedb import in_row_order
+from backend.utils.db.uploader import (
+    feed_prompts,
+    flush_prompts,
+    new_prompt_state,
+    parse_record_id,
+    record_id,
+)
+from backend.utils.model.model import prompt_text
+
+FILEID = "U" * 32
+PREAMBLE = "a\nb\nc\nd\ne\n"
+
+
+class RecordTest(unittest.TestCase):
+    """
+    Record test.
+
+    recordIds and the order rows are put back in.
+    """
+
+    def test_parse_record_id(self):
+        """
+        Parse record id.
+
+        Gives the row of recordIds of the file, None for anything else.
+        """
+        self.assertEqual(parse_record_id(record_id(FILEID, 0), FILEID), 0)
+        self.assertEqual(parse_record_id(record_id(FILEID, 1234), FILEID), 1234)
+        self.assertIsNone(parse_record_id(record_id("V" * 32, 3), FILEID))
+        self.assertIsNone(parse_record_id(None, FILEID))
+        self.assertIsNone(parse_record_id("00000000003", FILEID))
+        self.assertIsNone(parse_record_id(record_id(FILEID, 3) + "0", FILEID))
+        self.assertIsNone(parse_record_id(FILEID + "0000000000x", FILEID))
+
+    def test_in_row_order(self):
+        """
+        In row order.
+
+        Rows are put back in order with the known ones in between, and rows
+        that never arrived are empty.
+        """
+        rows = [(3, "d"), (0, "a"), (5, "f"), (2, "c")]
+        self.assertEqual(
+            list(in_row_order(rows, {1: "b"})), ["a", "b", "c", "d", "", "f"]
+        )
+        self.assertEqual(list(in_row_order([], {0: "a", 2: "c"})), ["a", "", "c"])
+        self.assertEqual(list(in_row_order([])), [])
+
+    def test_expand(self):
+        """
+        Expand.
+
+        Every row gets the answer of its unique prompt, rows never sent get
+        their known answer or nothing.
+        """
+        index = np.array([0, 1, 0, NOT_SENT, 1, NOT_SENT], dtype="<u4")
+        self.assertEqual(
+            list(expand(["x", "y"], index, {3: "known"})),
+            ["x", "y", "x", "known", "y", ""],
+        )
+
+
+class DedupTest(unittest.TestCase):
+    """
+    Dedup test.
+
+    Prompts of a ledger with repeated rows.
+    """
+
+    def test_same_prompt_sent_once(self):
+        """
+        Same prompt sent once.
+
+        Prompts differing in case or spacing share a number, and None is
+        not sent.
+        """
+        state = new_dedup_state()
+        sent = dedup_texts(state, ["Food  shop", "food shop", None, "Travel"])
+        self.assertEqual(sent, [(0, 0), (1, 3)])
+        self.assertEqual(state["index"].tolist(), [0, 0, NOT_SENT, 1])
+
+    def test_rows_put_back_from_unique_answers(self):
+        """
+        Rows put back from unique answers.
+
+        A ledger fed in chunks sends each distinct row once, numbered by
+        unique prompt, and the stored index gives every row its answer.
+        """
+        vendors = ["Acme", "Beta", "Acme", "Gamma", "Beta", "Acme"]
+        data = (
+            PREAMBLE + "Vendor\n" + "".join(f"{vendor}\n" for vendor in vendors)
+        ).encode()
+        state = new_prompt_state(FILEID, dedup=True)
+        lines = []
+        for start in range(0, len(data), 7):
+            lines += feed_prompts(state, data[start : start + 7])
+        lines += flush_prompts(state)
+        sent = [json.loads(line) for line in lines]
+        self.assertEqual(
+            [line["recordId"] for line in sent],
+            [record_id(FILEID, unique) for unique in range(3)],
+        )
+        answers = [
+            prompt_text(line["modelInput"]).split("Vendor: ")[1].strip()
+            for line in sent
+        ]
+        set_env()
+        with mock_aws():
+            s3_client = boto3.client("s3")
+            create_bucket(s3_client)
+            bucket = os.environ["AWS_S3_UPLOAD_NAME"]
+            upload_index(state["dedup"], FILEID, bucket, s3_client)
+            index = read_index(FILEID, bucket, s3_client)
+            self.assertIsNone(read_index("V" * 32, bucket, s3_client))
+        self.assertEqual(list(expand(answers, index)), vendors)
+
+
+if __name__ == "__main__":
+    unittest.main()
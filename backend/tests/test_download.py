@@ -0,0 +1,227 @@
+"""
+Download tests.
+
+Checks that the results of a processed file are read back from the outputs
+of its jobs in row order and sent as numbered batches, against moto, and
+that repeat downloads come from the result cache. Run with
+`python -m unittest backend.tests.test_download`.
+"""
+
+import os
+import json
+import random
+import tempfile
+import unittest
+import boto3
+from moto import mock_aws
+
+from backend.tests.aws import FakeSocketIO, create_bucket, create_file_table, set_env
+from backend.utils.batch import output_key
+from backend.utils.db import cache
+from backend.utils.db.cache import ResultCache, entry_size
+from backend.utils.db.dynamo import create_item_db, mark_item_db
+from backend.utils.db.filedb import get_ingester
+from backend.utils.db.uploader import record_id
+from backend.utils.model.model import output_record
+
+FILEID = "G" * 32
+USERNAME = "user"
+
+
+def model_input(row):
+    """
+    Model input.
+
+    The model input of a row.
+    """
+    return {"messages": [{"content": [{"text": f"Vendor: Shop {row}\n"}]}]}
+
+
+class DownloadTest(unittest.TestCase):
+    """
+    Download test.
+
+    Downloads of a file whose records are spread over jobs.
+    """
+
+    def setUp(self):
+        """
+        Set up.
+
+        Creates the table and bucket, with a fresh result cache and
+        downloads of 4 rows a batch.
+        """
+        set_env(DOWNLOAD_BATCH_SIZE="4")
+        self.aws = mock_aws()
+        self.aws.start()
+        self.db_client = boto3.client("dynamodb")
+        self.s3_client = boto3.client("s3")
+        create_file_table(self.db_client)
+        create_bucket(self.s3_client)
+        self.bucket = os.environ["AWS_S3_UPLOAD_NAME"]
+        cache.result_cache = None
+        create_item_db(FILEID, USERNAME, "ledger.csv", self.db_client)
+
+    def tearDown(self):
+        """
+        Tear down.
+
+        Stops moto.
+        """
+        self.aws.stop()
+
+    def put_output(self, jobid, input_name, rows, failed=()):
+        """
+        Put output.
+
+        Writes the output of a job answering rows, shuffled as bedrock does
+        not keep the order. Rows in failed get error records.
+        """
+        rows = list(rows)
+        random.Random(jobid).shuffle(rows)
+        lines = []
+        for row in rows:
+            record = record_id(FILEID, row)
+            if row in failed:
+                line = {
+                    "recordId": record,
+                    "modelInput": model_input(row),
+                    "error": {"errorCode": 400, "errorMessage": "bad"},
+                }
+            else:
+                line = output_record(record, model_input(row), f"Cat {row}", "m")
+            lines.append(json.dumps(line) + "\n")
+        self.s3_client.put_object(
+            Bucket=self.bucket, Key=output_key(jobid, input_name), Body="".join(lines)
+        )
+
+    def download(self):
+        """
+        Download method.
+
+        Gives the download messages of the file.
+        """
+        socketio = FakeSocketIO()
+        get_ingester(USERNAME, FILEID, socketio, self.db_client, self.s3_client)
+        return socketio.events("download")
+
+    def test_shards_in_row_order(self):
+        """
+        Shards in row order.
+
+        Rows of two shards come back in row order over numbered batches, the
+        last one finished, with failed rows left empty.
+        """
+        jobs = [
+            {"jobid": "arn:job/shard0", "input": f"{FILEID}-0.jsonl"},
+            {"jobid": "arn:job/shard1", "input": f"{FILEID}-1.jsonl"},
+        ]
+        self.put_output("arn:job/shard1", jobs[1]["input"], range(6, 11))
+        self.put_output("arn:job/shard0", jobs[0]["input"], range(6), failed={2})
+        mark_item_db(FILEID, jobs[0]["jobid"], USERNAME, self.db_client, jobs)
+        messages = self.download()
+        self.assertEqual([message["sequence"] for message in messages], [0, 1, 2])
+        self.assertEqual(
+            [message["finished"] for message in messages], [False, False, True]
+        )
+        self.assertEqual([len(message["data"]) for message in messages], [4, 4, 3])
+        results = [result for message in messages for result in message["data"]]
+        expected = [f"Cat {row}" for row in range(11)]
+        expected[2] = ""
+        self.assertEqual(results, expected)
+
+    def test_repeat_download_from_cache(self):
+        """
+        Repeat download from cache.
+
+        The second download of a job is served without reading its output,
+        a new job for the file reads the new output.
+        """
+        jobs = [{"jobid": "arn:job/first", "input": f"{FILEID}.jsonl"}]
+        self.put_output("arn:job/first", jobs[0]["input"], range(5))
+        mark_item_db(FILEID, "arn:job/first", USERNAME, self.db_client, jobs)
+        first = self.download()
+        self.s3_client.delete_object(
+            Bucket=self.bucket, Key=output_key("arn:job/first", jobs[0]["input"])
+        )
+        self.assertEqual(self.download(), first)
+        self.assertEqual(cache.get_result_cache().metrics()["hits"], 1)
+        jobs = [{"jobid": "arn:job/second", "input": f"{FILEID}.jsonl"}]
+        self.put_output("arn:job/second", jobs[0]["input"], range(2))
+        mark_item_db(FILEID, "arn:job/second", USERNAME, self.db_client, jobs)
+        results = [result for message in self.download() for result in message["data"]]
+        self.assertEqual(results, ["Cat 0", "Cat 1"])
+
+    def test_shared_input_keeps_own_rows(self):
+        """
+        Shared input keeps own rows.
+
+        A job shared with other files gives only the rows of this one.
+        """
+        other = "H" * 32
+        jobid = "arn:job/batch"
+        lines = [
+            output_record(record_id(other, 0), model_input(0), "Other", "m"),
+            output_record(record_id(FILEID, 1), model_input(1), "Cat 1", "m"),
+            output_record(record_id(other, 1), model_input(1), "Other", "m"),
+            output_record(record_id(FILEID, 0), model_input(0), "Cat 0", "m"),
+        ]
+        self.s3_client.put_object(
+            Bucket=self.bucket,
+            Key=output_key(jobid, "batch-1.jsonl"),
+            Body="".join(json.dumps(line) + "\n" for line in lines),
+        )
+        jobs = [{"jobid": jobid, "input": "batch-1.jsonl"}]
+        mark_item_db(FILEID, jobid, USERNAME, self.db_client, jobs)
+        messages = self.download()
+        self.assertEqual(len(messages), 1)
+        self.assertEqual(messages[0]["data"], ["Cat 0", "Cat 1"])
+        self.assertTrue(messages[0]["finished"])
+
+
+class ResultCacheTest(unittest.TestCase):
+    """
+    Result cache test.
+
+    The memory and disk tiers of the result cache.
+    """
+
+    def test_memory_tier_evicts_least_recent(self):
+        """
+        Memory tier evicts least recent.
+
+        Entries past the byte cap push out the least recently used one.
+        """
+        results = ["Food Expense"] * 10
+        store = ResultCache(2 * entry_size(results))
+        store.put("a", "job", results)
+        store.put("b", "job", results)
+        self.assertEqual(store.get("a", "job"), results)
+        store.put("c", "job", results)
+        self.assertIsNone(store.get("b", "job"))
+        self.assertEqual(store.get("a", "job"), results)
+        self.assertEqual(store.get("c", "job"), results)
+        self.assertLessEqual(store.metrics()["bytes"], store.max_bytes)
+
+    def test_disk_tier_outlives_memory(self):
+        """
+        Disk tier outlives memory.
+
+        A new cache over the same directory finds earlier entries on disk,
+        and invalidating a file removes every one of its jobs.
+        """
+        with tempfile.TemporaryDirectory() as tmp:
+            ResultCache(1024, tmp).put("a", "job", ["Travel"])
+            store = ResultCache(1024, tmp)
+            self.assertEqual(store.get("a", "job"), ["Travel"])
+            self.assertEqual(store.metrics()["disk_hits"], 1)
+            self.assertEqual(store.get("a", "job"), ["Travel"])
+            self.assertEqual(store.metrics()["hits"], 1)
+            store.put("a", "other", ["Food"])
+            store.invalidate("a")
+            self.assertIsNone(store.get("a", "job"))
+            self.assertIsNone(ResultCache(1024, tmp).get("a", "other"))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,81 @@
+"""
+Listing tests.
+
+Checks that a user's files are listed by scan unless the username index is
+named, and through the index when it is. Run with
+`python -m unittest backend.tests.test_listing`.
+"""
+
+import os
+import unittest
+import boto3
+from moto import mock_aws
+
+from backend.benchmarks.listing import add_files, create_table
+from backend.tests.aws import create_file_table, set_env
+from backend.utils.db.dynamo import query_items_user
+
+
+class ListingTest(unittest.TestCase):
+    """
+    Listing test.
+
+    Two users' files, listed for one of them.
+    """
+
+    def setUp(self):
+        """
+        Set up.
+
+        Starts moto.
+        """
+        set_env()
+        os.environ.pop("AWS_FILE_TABLE_USER_INDEX", None)
+        self.aws = mock_aws()
+        self.aws.start()
+        self.db_client = boto3.client("dynamodb")
+
+    def tearDown(self):
+        """
+        Tear down.
+
+        Stops moto.
+        """
+        self.aws.stop()
+
+    def listed(self):
+        """
+        Listed.
+
+        Fileids listed for the user bench.
+        """
+        return sorted(
+            item["fileid"]["S"] for item in query_items_user("bench", self.db_client)
+        )
+
+    def test_scans_without_index(self):
+        """
+        Scans without index.
+
+        A table without the index lists by scan when none is named.
+        """
+        create_file_table(self.db_client)
+        add_files(self.db_client, "bench", 0, 3)
+        add_files(self.db_client, "other", 0, 5)
+        self.assertEqual(self.listed(), ["bench-0", "bench-1", "bench-2"])
+
+    def test_queries_named_index(self):
+        """
+        Queries named index.
+
+        With the index named the files come from it.
+        """
+        create_table(self.db_client)
+        add_files(self.db_client, "bench", 0, 3)
+        add_files(self.db_client, "other", 0, 5)
+        os.environ["AWS_FILE_TABLE_USER_INDEX"] = "username-index"
+        self.assertEqual(self.listed(), ["bench-0", "bench-1", "bench-2"])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,181 @@
+"""
+Model tests.
+
+Checks the local engine answers an input in the bedrock batch output format,
+packed prompts included, against moto, and the prompt helpers it uses. Run
+with `python -m unittest backend.tests.test_model`.
+"""
+
+import os
+import json
+import unittest
+import boto3
+import pandas as pd
+from moto import mock_aws
+
+from backend.tests.aws import create_bucket, set_env
+from backend.utils.batch import LOCAL_JOB_PREFIX, output_key
+from backend.utils.db.prompts import PromptCompiler
+from backend.utils.db.uploader import convert_frame, convert_to_lines, record_id
+from backend.utils.model import model
+from backend.utils.model.model import (
+    LocalEngine,
+    create_engine,
+    hashed_answer,
+    prompt_fields,
+    prompt_text,
+)
+
+FILEID = "E" * 32
+CATEGORIES = ["Food Expense", "Travel", "Office Supplies"]
+
+
+def packed_line(texts, record):
+    """
+    Packed line.
+
+    A prompt line asking for several rows at once.
+    """
+    compiler = PromptCompiler(rows_per_request=len(texts))
+    model_input = {"messages": [{"content": [{"text": compiler.pack(texts)}]}]}
+    return {"recordId": record, "modelInput": model_input}
+
+
+class PromptHelpersTest(unittest.TestCase):
+    """
+    Prompt helpers test.
+
+    Reading rows back out of prompts and answering them.
+    """
+
+    def test_prompt_fields(self):
+        """
+        Prompt fields.
+
+        Column values come back from the full template and compact rows.
+        """
+        df = pd.DataFrame({"Original Vendor": ["Acme"], "Amount": ["3"]})
+        fields = prompt_fields(convert_frame(df)[0])
+        self.assertEqual(fields["Original Vendor"], "Acme")
+        self.assertEqual(fields["Amount"], "3")
+        compact = PromptCompiler().rows(df)[0]
+        self.assertEqual(
+            prompt_fields(compact), {"Original Vendor": "Acme", "Amount": "3"}
+        )
+
+    def test_hashed_answer(self):
+        """
+        Hashed answer.
+
+        The same text always gets the same category.
+        """
+        answer = hashed_answer(CATEGORIES)
+        texts = [f"Vendor: Shop {i}" for i in range(30)]
+        first = answer(texts)
+        self.assertEqual(answer(list(reversed(texts))), list(reversed(first)))
+        self.assertTrue(set(first) <= set(CATEGORIES))
+        self.assertGreater(len(set(first)), 1)
+
+    def test_unknown_engine(self):
+        """
+        Unknown engine.
+
+        Only bedrock and local are engines.
+        """
+        with self.assertRaises(ValueError):
+            create_engine("other", None, None)
+
+
+class LocalEngineTest(unittest.TestCase):
+    """
+    Local engine test.
+
+    The local engine over a moto bucket.
+    """
+
+    def setUp(self):
+        """
+        Set up.
+
+        Creates the bucket.
+        """
+        set_env()
+        self.aws = mock_aws()
+        self.aws.start()
+        self.s3_client = boto3.client("s3")
+        create_bucket(self.s3_client)
+        self.bucket = os.environ["AWS_S3_UPLOAD_NAME"]
+        self.answer = hashed_answer(CATEGORIES)
+
+    def tearDown(self):
+        """
+        Tear down.
+
+        Stops moto.
+        """
+        self.aws.stop()
+
+    def test_answers_in_batch_format(self):
+        """
+        Answers in batch format.
+
+        Every line is answered in order under its recordId, lines without
+        one get a number, and packed lines get a JSON answer per row.
+        """
+        df = pd.DataFrame({"Vendor": [f"Shop {i}" for i in range(3)]})
+        lines = [json.loads(line) for line in convert_to_lines(df, FILEID)]
+        lines.append(packed_line(["Vendor: A", "Vendor: B"], record_id(FILEID, 3)))
+        lines.append({"modelInput": lines[0]["modelInput"]})
+        name = f"{FILEID}.jsonl"
+        self.s3_client.put_object(
+            Bucket=self.bucket,
+            Key=f"input/{name}",
+            Body="".join(json.dumps(line) + "\n\n" for line in lines),
+        )
+        engine = LocalEngine(self.s3_client, self.bucket, self.answer, "local-model")
+        jobid = engine.submit(name)
+        self.assertTrue(jobid.startswith(LOCAL_JOB_PREFIX))
+        body = self.s3_client.get_object(
+            Bucket=self.bucket, Key=output_key(jobid, name)
+        )
+        output = [json.loads(line) for line in body["Body"].iter_lines()]
+        self.assertEqual(
+            [line["recordId"] for line in output],
+            [record_id(FILEID, row) for row in range(4)] + ["00000000004"],
+        )
+        texts = [line["modelOutput"]["content"][0]["text"] for line in output]
+        for text, sent in zip(texts[:3], lines):
+            self.assertEqual(text, self.answer([prompt_text(sent["modelInput"])])[0])
+        self.assertEqual(
+            json.loads(texts[3]),
+            dict(zip("12", self.answer(["Vendor: A", "Vendor: B"]))),
+        )
+        self.assertEqual(texts[4], texts[0])
+        self.assertEqual(output[0]["modelOutput"]["model"], "local-model")
+
+    def test_model_handler(self):
+        """
+        Model handler.
+
+        Answers a prompt file from MODEL_DOWNLOAD_PATH into
+        MODEL_UPLOAD_PATH.
+        """
+        down = os.path.join(os.environ["TEMP_FILE_LOCATION"], "down")
+        up = os.path.join(os.environ["TEMP_FILE_LOCATION"], "up")
+        os.makedirs(down)
+        os.makedirs(up)
+        os.environ.update(
+            MODEL_DOWNLOAD_PATH=down, MODEL_UPLOAD_PATH=up, CLASSIFIER_PATH=""
+        )
+        df = pd.DataFrame({"Vendor": ["Shop 1", "Shop 2"]})
+        with open(os.path.join(down, FILEID), "w") as f:
+            f.writelines(convert_to_lines(df, FILEID))
+        model.model_handler(FILEID)
+        with open(os.path.join(up, FILEID)) as f:
+            output = [json.loads(line) for line in f]
+        self.assertEqual(len(output), 2)
+        self.assertTrue(all("modelOutput" in line for line in output))
+
+
+if __name__ == "__main__":
+    unittest.main()
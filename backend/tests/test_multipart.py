@@ -0,0 +1,314 @@
+"""
+Multipart tests.
+
+Checks that prompts go to s3 as multipart parts that keep uploading between
+chunks, land in order and are aborted when an upload fails, against moto.
+Run with `python -m unittest backend.tests.test_multipart`.
+"""
+
+import os
+import json
+import threading
+import unittest
+from concurrent.futures import FIRST_COMPLETED, wait
+from unittest import mock
+import boto3
+from moto import mock_aws
+
+from backend.tests.aws import create_bucket, create_file_table, set_env
+from backend.types.errors import DBError, JSONError
+from backend.utils.args import parse_json
+from backend.utils.db import multipart, uploader
+from backend.utils.db.dynamo import get_item_db
+from backend.utils.db.filedb import file_ingester
+from backend.utils.db.multipart import (
+    MIN_PART_SIZE,
+    MultipartWriter,
+    new_multipart_state,
+    parts_in_flight,
+)
+
+FILEID = "M" * 32
+
+
+class GatedS3:
+    """
+    Gated s3.
+
+    Passes calls to an s3 client, holding the upload of part 1 until the
+    gate opens.
+    """
+
+    def __init__(self, s3_client):
+        """
+        Init function.
+
+        The gate starts closed.
+        """
+        self.s3_client = s3_client
+        self.gate = threading.Event()
+
+    def __getattr__(self, name):
+        """
+        Get attr.
+
+        Every other call goes straight to the client.
+        """
+        return getattr(self.s3_client, name)
+
+    def upload_part(self, **kwargs):
+        """
+        Upload part.
+
+        Waits on the gate for part 1.
+        """
+        if kwargs["PartNumber"] == 1:
+            self.gate.wait(10)
+        return self.s3_client.upload_part(**kwargs)
+
+
+def ledger(rows):
+    """
+    Ledger.
+
+    A csv of rows different vendors.
+    """
+    lines = ["a\nb\nc\nd\ne\n", "Original Vendor,GL Account Description,Amount\n"]
+    lines += [
+        f"Vendor number {i} LLC,Supplies and other things,{i}\n" for i in range(rows)
+    ]
+    return "".join(lines).encode()
+
+
+class MultipartTest(unittest.TestCase):
+    """
+    Multipart test.
+
+    Uploads to a moto bucket.
+    """
+
+    def setUp(self):
+        """
+        Set up.
+
+        Creates the bucket.
+        """
+        set_env(UPLOAD_SESSION_BACKEND="memory", PROMPT_DEDUP="False")
+        self.aws = mock_aws()
+        self.aws.start()
+        self.s3_client = boto3.client("s3")
+        create_bucket(self.s3_client)
+        self.bucket = os.environ["AWS_S3_UPLOAD_NAME"]
+        uploader.ongoing_uploads = None
+
+    def tearDown(self):
+        """
+        Tear down.
+
+        Stops moto.
+        """
+        self.aws.stop()
+
+    def open_uploads(self):
+        """
+        Open uploads.
+
+        Multipart uploads neither complete nor aborted.
+        """
+        response = self.s3_client.list_multipart_uploads(Bucket=self.bucket)
+        return response.get("Uploads", [])
+
+    def test_parts_keep_uploading_between_chunks(self):
+        """
+        Parts keep uploading between chunks.
+
+        A chunk returns while its part is still uploading, the next chunk
+        numbers its part after it, parts that finish first are recorded
+        first, and the object still has them in order.
+        """
+        s3_client = GatedS3(self.s3_client)
+        state = new_multipart_state()
+        first = os.urandom(MIN_PART_SIZE)
+        second = os.urandom(MIN_PART_SIZE)
+        writer = MultipartWriter(state, self.bucket, "out", s3_client, MIN_PART_SIZE)
+        writer.write_bytes(first)
+        writer.collect_done()
+        self.assertEqual(state["parts"], [])
+        self.assertEqual(len(parts_in_flight(state["upload_id"])), 1)
+        writer = MultipartWriter(state, self.bucket, "out", s3_client, MIN_PART_SIZE)
+        writer.write_bytes(second + b"tail")
+        wait(list(writer.futures), timeout=10, return_when=FIRST_COMPLETED)
+        writer.collect_done()
+        self.assertEqual([part["PartNumber"] for part in state["parts"]], [2])
+        s3_client.gate.set()
+        writer = MultipartWriter(state, self.bucket, "out", s3_client, MIN_PART_SIZE)
+        writer.close()
+        self.assertEqual([part["PartNumber"] for part in state["parts"]], [1, 2, 3])
+        body = self.s3_client.get_object(Bucket=self.bucket, Key="out")["Body"].read()
+        self.assertEqual(body, first + second + b"tail")
+        self.assertNotIn(state["upload_id"], multipart.in_flight)
+        self.assertEqual(self.open_uploads(), [])
+
+    def upload(self, data, chunks):
+        """
+        Upload method.
+
+        Sends data through upload_chunk in chunks, gives the result of the
+        last one.
+        """
+        size = len(data) // chunks + 1
+        for number in range(chunks):
+            res = uploader.upload_chunk(
+                FILEID,
+                data[number * size : (number + 1) * size],
+                number,
+                chunks,
+                self.bucket,
+                self.s3_client,
+            )
+        return res
+
+    def test_upload_matches_whole_conversion(self):
+        """
+        Upload matches whole conversion.
+
+        Prompts of a file over several parts match the whole file
+        conversion, in row order under the recordId of their row.
+        """
+        data = ledger(40000)
+        self.assertEqual(self.upload(data, 6), -1)
+        path = os.path.join(os.environ["TEMP_FILE_LOCATION"], "whole.csv")
+        with open(path, "wb") as f:
+            f.write(data)
+        uploader.convert_to_prompts(path, path + ".jsonl", stream=False)
+        with open(path + ".jsonl") as f:
+            expected = [json.loads(line)["modelInput"] for line in f]
+        key = f"input/{FILEID}.jsonl"
+        body = self.s3_client.get_object(Bucket=self.bucket, Key=key)["Body"].read()
+        self.assertGreater(len(body), 2 * MIN_PART_SIZE)
+        lines = [json.loads(line) for line in body.decode().splitlines()]
+        self.assertEqual(
+            [line["recordId"] for line in lines],
+            [uploader.record_id(FILEID, row) for row in range(40000)],
+        )
+        self.assertEqual([line["modelInput"] for line in lines], expected)
+        self.assertEqual(self.open_uploads(), [])
+
+    def test_chunk_past_the_end_is_ignored(self):
+        """
+        Chunk past the end is ignored.
+
+        An empty chunk numbered after the last one leaves the finished
+        object alone and opens no session or temp files.
+        """
+        data = ledger(300)
+        self.assertEqual(self.upload(data, 3), -1)
+        key = f"input/{FILEID}.jsonl"
+        body = self.s3_client.get_object(Bucket=self.bucket, Key=key)["Body"].read()
+        res = uploader.upload_chunk(FILEID, b"", 3, 3, self.bucket, self.s3_client)
+        self.assertEqual(res, 3)
+        self.assertNotIn(FILEID, uploader.get_upload_sessions())
+        for path in uploader.temp_paths(FILEID):
+            self.assertFalse(os.path.exists(path))
+        after = self.s3_client.get_object(Bucket=self.bucket, Key=key)["Body"].read()
+        self.assertEqual(after, body)
+
+    def test_binary_chunks_out_of_order(self):
+        """
+        Binary chunks out of order.
+
+        Binary chunks with a chunk_size are taken without a copy, written at
+        their offset whatever order they arrive in, and give the object of
+        chunks sent in order. A short chunk before the last is refused.
+        """
+        data = ledger(2000)
+        size = 16 * 1024
+        chunks = [data[i : i + size] for i in range(0, len(data), size)]
+        total = len(chunks)
+        order = list(range(total))[::-1]
+        order[0], order[-1] = order[-1], order[0]
+        res = []
+        for number in order:
+            message = parse_json({"chunk": bytearray(chunks[number])})
+            self.assertIsInstance(message["chunk"], memoryview)
+            res.append(
+                uploader.upload_chunk(
+                    FILEID,
+                    message["chunk"],
+                    number,
+                    total,
+                    self.bucket,
+                    self.s3_client,
+                    size,
+                )
+            )
+        self.assertEqual(res, order[:-1] + [-1])
+        key = f"input/{FILEID}.jsonl"
+        body = self.s3_client.get_object(Bucket=self.bucket, Key=key)["Body"].read()
+        self.s3_client.delete_object(Bucket=self.bucket, Key=key)
+        self.assertEqual(self.upload(data, total), -1)
+        in_order = self.s3_client.get_object(Bucket=self.bucket, Key=key)["Body"]
+        self.assertEqual(body, in_order.read())
+        with self.assertRaises(JSONError):
+            uploader.upload_chunk(
+                FILEID, b"short", 0, total, self.bucket, self.s3_client, size
+            )
+
+    def test_error_aborts_upload(self):
+        """
+        Error aborts upload.
+
+        A chunk that fails aborts the multipart upload, forgets the session
+        and removes the local files.
+        """
+        data = ledger(40000)
+        with mock.patch.object(
+            uploader, "flush_prompts", side_effect=ValueError("bad csv")
+        ):
+            with self.assertRaises(DBError):
+                self.upload(data, 6)
+        self.assertEqual(self.open_uploads(), [])
+        self.assertNotIn(FILEID, uploader.get_upload_sessions())
+        self.assertFalse(os.path.exists(uploader.temp_paths(FILEID)[0]))
+
+    def test_tokens_kept_per_file(self):
+        """
+        Tokens kept per file.
+
+        Each finished file has its own estimated prompt tokens on its item,
+        and the process total is their sum.
+        """
+        db_client = boto3.client("dynamodb")
+        create_file_table(db_client)
+        before = uploader.upload_metrics()["tokens"]
+        sizes = {"A" * 32: 300, "B" * 32: 900}
+        for fileid, rows in sizes.items():
+            self.assertEqual(
+                file_ingester(
+                    "user",
+                    fileid,
+                    "ledger.csv",
+                    ledger(rows),
+                    0,
+                    1,
+                    db_client,
+                    self.s3_client,
+                ),
+                -1,
+            )
+        tokens = {
+            fileid: get_item_db(fileid, "user", db_client)["tokens"] for fileid in sizes
+        }
+        for counts in tokens.values():
+            self.assertGreater(counts["full"], 0)
+            self.assertGreater(counts["sent"], 0)
+        self.assertGreater(tokens["B" * 32]["full"], 2 * tokens["A" * 32]["full"])
+        after = uploader.upload_metrics()["tokens"]
+        for name in ("full", "sent"):
+            self.assertEqual(
+                after[name] - before[name], sum(i[name] for i in tokens.values())
+            )
+
+
+if __name__ == "__main__":
+    unittest.main()
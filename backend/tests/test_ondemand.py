@@ -0,0 +1,219 @@
+"""
+On demand tests.
+
+Runs small inputs through the on demand engine on the local runtime against
+moto, checking the output lines, retries of throttled calls and the error
+records of calls that fail. Run with
+`python -m unittest backend.tests.test_ondemand`.
+"""
+
+import os
+import json
+import unittest
+from unittest import mock
+import boto3
+import pandas as pd
+from botocore.exceptions import ClientError
+from moto import mock_aws
+
+from backend.tests.aws import create_bucket, set_env
+from backend.utils.batch import ONDEMAND_JOB_PREFIX, output_key
+from backend.utils.db.uploader import convert_to_lines, record_id
+from backend.utils.model import model
+from backend.utils.model.model import (
+    LocalRuntime,
+    OnDemandEngine,
+    hashed_answer,
+    prompt_text,
+)
+from backend.utils.ratelimit import TokenBucket
+
+FILEID = "D" * 32
+CATEGORIES = ["Food Expense", "Travel", "Office Supplies"]
+
+
+class FlakyRuntime:
+    """
+    Flaky runtime.
+
+    Passes calls to a runtime, failing the prompts that name a vendor with
+    the given error codes first.
+    """
+
+    def __init__(self, runtime, failures):
+        """
+        Init function.
+
+        failures maps a vendor to the error codes its calls get, in order,
+        before they go through.
+        """
+        self.runtime = runtime
+        self.failures = {vendor: list(codes) for vendor, codes in failures.items()}
+        self.calls = {}
+
+    def invoke_model(self, modelId, body, **kwargs):
+        """
+        Invoke model.
+
+        Raises the next error of a failing vendor.
+        """
+        text = prompt_text(json.loads(body))
+        for vendor, codes in self.failures.items():
+            if f"Vendor: {vendor}\n" in text:
+                self.calls[vendor] = self.calls.get(vendor, 0) + 1
+                if codes:
+                    code = codes.pop(0)
+                    raise ClientError(
+                        {"Error": {"Code": code, "Message": f"{code} for {vendor}"}},
+                        "InvokeModel",
+                    )
+        return self.runtime.invoke_model(modelId, body, **kwargs)
+
+
+class OnDemandTest(unittest.TestCase):
+    """
+    On demand test.
+
+    The engine over a moto bucket.
+    """
+
+    def setUp(self):
+        """
+        Set up.
+
+        Creates the bucket and puts the prompts of a five row file in it.
+        Backoff does not sleep.
+        """
+        set_env()
+        self.aws = mock_aws()
+        self.aws.start()
+        self.s3_client = boto3.client("s3")
+        create_bucket(self.s3_client)
+        self.bucket = os.environ["AWS_S3_UPLOAD_NAME"]
+        df = pd.DataFrame(
+            {
+                "Vendor": [f"Shop {i}" for i in range(5)],
+                "Amount": [str(i * 10) for i in range(5)],
+            }
+        )
+        self.lines = [json.loads(line) for line in convert_to_lines(df, FILEID)]
+        self.input_name = f"{FILEID}.jsonl"
+        self.s3_client.put_object(
+            Bucket=self.bucket,
+            Key=f"input/{self.input_name}",
+            Body="".join(json.dumps(line) + "\n" for line in self.lines),
+        )
+        self.answer = hashed_answer(CATEGORIES)
+        backoff = mock.patch.object(model, "backoff_delay", return_value=0)
+        backoff.start()
+        self.addCleanup(backoff.stop)
+
+    def tearDown(self):
+        """
+        Tear down.
+
+        Stops moto.
+        """
+        self.aws.stop()
+
+    def engine(self, failures=None, retries=5):
+        """
+        Engine method.
+
+        An on demand engine on the local runtime, failing some vendors.
+        """
+        runtime = FlakyRuntime(LocalRuntime(self.answer, "local"), failures or {})
+        engine = OnDemandEngine(
+            runtime,
+            self.s3_client,
+            self.bucket,
+            "local",
+            50,
+            3,
+            TokenBucket(1000, 1000),
+            retries,
+        )
+        return engine, runtime
+
+    def output(self, jobid):
+        """
+        Output method.
+
+        The output lines of a job.
+        """
+        key = output_key(jobid, self.input_name)
+        body = self.s3_client.get_object(Bucket=self.bucket, Key=key)["Body"]
+        return [json.loads(line) for line in body.read().decode().splitlines()]
+
+    def test_small_file(self):
+        """
+        Small file.
+
+        Every prompt is answered by the local runtime, in input order under
+        its recordId, in the bedrock batch output format.
+        """
+        engine, _ = self.engine()
+        self.assertTrue(engine.accepts(5))
+        self.assertFalse(engine.accepts(51))
+        jobid = engine.submit(self.input_name)
+        self.assertTrue(jobid.startswith(ONDEMAND_JOB_PREFIX))
+        output = self.output(jobid)
+        self.assertEqual(
+            [line["recordId"] for line in output],
+            [record_id(FILEID, row) for row in range(5)],
+        )
+        for line, sent in zip(output, self.lines):
+            self.assertEqual(line["modelInput"], sent["modelInput"])
+            text = line["modelOutput"]["content"][0]["text"]
+            self.assertEqual(text, self.answer([prompt_text(sent["modelInput"])])[0])
+        self.assertEqual(engine.metrics()["calls"], 5)
+        self.assertEqual(engine.metrics()["retried"], 0)
+
+    def test_retries_throttled_calls(self):
+        """
+        Retries throttled calls.
+
+        Calls failing with a retry code are made again and end up answered.
+        """
+        codes = sorted(model.RETRY_CODES)
+        engine, runtime = self.engine({"Shop 1": codes, "Shop 3": codes[:1]})
+        output = self.output(engine.submit(self.input_name))
+        self.assertTrue(all("modelOutput" in line for line in output))
+        self.assertEqual(runtime.calls, {"Shop 1": len(codes) + 1, "Shop 3": 2})
+        metrics = engine.metrics()
+        self.assertEqual(metrics["retried"], len(codes) + 1)
+        self.assertEqual(metrics["failed"], 0)
+        self.assertEqual(metrics["calls"], 5 + len(codes) + 1)
+
+    def test_error_records(self):
+        """
+        Error records.
+
+        A call failing with a code that is not retried, or still throttled
+        once the retries are used up, leaves an error line for its record
+        like bedrock batch does, and the other records are answered.
+        """
+        engine, runtime = self.engine(
+            {
+                "Shop 0": ["ValidationException"],
+                "Shop 4": ["ThrottlingException"] * 3,
+            },
+            retries=2,
+        )
+        output = self.output(engine.submit(self.input_name))
+        self.assertEqual(
+            [line["recordId"] for line in output],
+            [record_id(FILEID, row) for row in range(5)],
+        )
+        self.assertEqual(output[0]["error"]["errorCode"], "ValidationException")
+        self.assertEqual(output[4]["error"]["errorCode"], "ThrottlingException")
+        self.assertIn("Shop 4", output[4]["error"]["errorMessage"])
+        self.assertEqual(output[4]["modelInput"], self.lines[4]["modelInput"])
+        self.assertNotIn("modelOutput", output[0])
+        self.assertTrue(all("modelOutput" in line for line in output[1:4]))
+        self.assertEqual(runtime.calls, {"Shop 0": 1, "Shop 4": 3})
+        self.assertEqual(engine.metrics()["failed"], 2)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,177 @@
+"""
+Prompt compiler tests.
+
+Checks compact prompts keep only the allowed columns, packed prompts group
+consecutive rows and their answers are split back per row, and that they
+cost fewer tokens than the full template. Run with
+`python -m unittest backend.tests.test_prompts`.
+"""
+
+import json
+import unittest
+import pandas as pd
+
+from backend.utils.db.filedb import in_row_order, iter_records_from_jsonl
+from backend.utils.db.prompts import (
+    COMPACT_PROMPT,
+    PromptCompiler,
+    count_tokens,
+    new_token_counts,
+    packed_rows,
+    packs,
+    split_answer,
+    token_savings,
+)
+from backend.utils.db.uploader import (
+    convert_frame,
+    new_prompt_state,
+    parse_record_id,
+    prompt_lines,
+)
+from backend.utils.model.model import answer_inputs, hashed_answer, output_record
+
+FILEID = "P" * 32
+
+
+def ledger():
+    """
+    Ledger.
+
+    A frame with a long description and a blank.
+    """
+    return pd.DataFrame(
+        {
+            "Date": ["01/01/2023", "01/02/2023", "01/03/2023"],
+            "Original Vendor": ["Acme", "Beta", "Gamma"],
+            "GL Account Description": ["Office supplies\nand paper", None, "Food"],
+        }
+    )
+
+
+class CompilerTest(unittest.TestCase):
+    """
+    Compiler test.
+
+    Compact and packed prompt texts.
+    """
+
+    def test_rows_keep_allowed_columns(self):
+        """
+        Rows keep allowed columns.
+
+        Only allowed columns with a value are sent, on one line, cut to
+        max_value.
+        """
+        compiler = PromptCompiler(["Original Vendor", "GL Account Description"], 8)
+        self.assertEqual(
+            compiler.rows(ledger()),
+            [
+                "Original Vendor: Acme; GL Account Description: Office s",
+                "Original Vendor: Beta",
+                "Original Vendor: Gamma; GL Account Description: Food",
+            ],
+        )
+        self.assertEqual(PromptCompiler(["Missing"]).rows(ledger()), [""] * 3)
+        self.assertEqual(compiler.single("x"), COMPACT_PROMPT + "x")
+
+    def test_packs(self):
+        """
+        Packs.
+
+        Packs hold up to size consecutive numbers.
+        """
+        numbered = [(0, 0), (1, 1), (2, 2), (5, 3), (6, 4), (8, 5)]
+        self.assertEqual(
+            [[number for number, _ in pack] for pack in packs(numbered, 2)],
+            [[0, 1], [2], [5, 6], [8]],
+        )
+
+    def test_split_answer(self):
+        """
+        Split answer.
+
+        Gives the offset and category of every numbered answer, ignoring
+        text around the object and bad numbers, and None for a single
+        answer.
+        """
+        self.assertEqual(
+            split_answer('Sure: {"1": " Food ", "2": "Travel", "x": "A", "0": "B"}.'),
+            [(0, "Food"), (1, "Travel")],
+        )
+        self.assertIsNone(split_answer("Food Expense"))
+        self.assertIsNone(split_answer("{not json}"))
+        self.assertIsNone(split_answer('["Food"]'))
+
+    def test_packed_rows(self):
+        """
+        Packed rows.
+
+        The rows of a packed prompt, None for other prompts.
+        """
+        text = PromptCompiler().pack(["Vendor: A. B", "Vendor: C"])
+        model_input = {"messages": [{"content": [{"text": text}]}]}
+        self.assertEqual(packed_rows(model_input), ["Vendor: A. B", "Vendor: C"])
+        single = {"messages": [{"content": [{"text": "Vendor: A"}]}]}
+        self.assertIsNone(packed_rows(single))
+        self.assertIsNone(packed_rows(None))
+
+
+class PackedUploadTest(unittest.TestCase):
+    """
+    Packed upload test.
+
+    Packed prompts through to their answers.
+    """
+
+    def test_answers_split_back_per_row(self):
+        """
+        Answers split back per row.
+
+        Packed lines are named by their first row and their answer gives
+        every row its own result, in row order.
+        """
+        df = pd.DataFrame({"Vendor": [f"Shop {i}" for i in range(5)]})
+        compiler = PromptCompiler(rows_per_request=2)
+        state = new_prompt_state(FILEID)
+        lines = [
+            json.loads(line) for line in prompt_lines(state, df, None, None, compiler)
+        ]
+        self.assertEqual(
+            [parse_record_id(line["recordId"], FILEID) for line in lines], [0, 2, 4]
+        )
+        answer = hashed_answer(["Food", "Travel", "Office"])
+        texts = answer_inputs(answer, [line["modelInput"] for line in lines])
+        output = [
+            json.dumps(output_record(line["recordId"], line["modelInput"], text, "m"))
+            for line, text in zip(lines, texts)
+        ]
+        rows = [
+            (parse_record_id(record, FILEID) + offset, text)
+            for record, offset, text in iter_records_from_jsonl(reversed(output))
+        ]
+        expected = answer([f"Vendor: Shop {i}" for i in range(5)])
+        self.assertEqual(list(in_row_order(rows)), expected)
+
+    def test_compact_saves_tokens(self):
+        """
+        Compact saves tokens.
+
+        Compact prompts are counted against the full template.
+        """
+        df = ledger()
+        compiler = PromptCompiler(["Original Vendor"])
+        state = new_prompt_state(FILEID)
+        prompt_lines(state, df, None, None, compiler)
+        counts = new_token_counts()
+        count_tokens(
+            counts,
+            convert_frame(df),
+            [compiler.single(row) for row in compiler.rows(df)],
+        )
+        self.assertEqual(state["tokens"], counts)
+        self.assertGreater(token_savings(state["tokens"]), 0.5)
+        self.assertEqual(token_savings(new_token_counts()), 0.0)
+
+
+if __name__ == "__main__":
+    unittest.main()
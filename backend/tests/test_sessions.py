@@ -0,0 +1,341 @@
+"""
+Upload session tests.
+
+Checks the locking and eviction of the upload session stores. Run with
+`python -m unittest backend.tests.test_sessions`.
+"""
+
+import os
+import time
+import sqlite3
+import tempfile
+import threading
+import unittest
+from unittest import mock
+
+from backend.types.errors import DBError
+from backend.utils.db.sessions import (
+    BLOB_BYTES,
+    MemoryTables,
+    SQLiteSessionStore,
+    UploadSessionStore,
+)
+from backend.utils.db.uploader import feed_prompts, flush_prompts, new_prompt_state
+
+
+def run(target):
+    """
+    Run.
+
+    Starts target on a thread.
+    """
+    thread = threading.Thread(target=target, daemon=True)
+    thread.start()
+    return thread
+
+
+class MemoryStoreTest(unittest.TestCase):
+    """
+    Memory store test.
+
+    Sessions of the in process store.
+    """
+
+    def setUp(self):
+        """
+        Set up.
+
+        A store with a small budget.
+        """
+        self.evicted = []
+        self.store = UploadSessionStore(
+            16, 1000, tempfile.mkdtemp(), on_evict=self.on_evict
+        )
+
+    def on_evict(self, fileid, session):
+        """
+        On evict.
+
+        Records the session and whether another thread can take the store
+        lock meanwhile.
+        """
+        free = []
+
+        def take():
+            free.append(self.store.lock.acquire(timeout=1))
+            if free[0]:
+                self.store.lock.release()
+
+        run(take).join()
+        self.evicted.append((fileid, session, free[0]))
+
+    def test_drop_keeps_lock_for_waiters(self):
+        """
+        Drop keeps lock for waiters.
+
+        A chunk arriving while another holds the session waits for it, even
+        when the session is dropped in between.
+        """
+        order = []
+        held = threading.Event()
+        release = threading.Event()
+
+        def holder():
+            with self.store.session("f"):
+                held.set()
+                release.wait()
+                order.append("holder out")
+
+        def waiter():
+            with self.store.session("f"):
+                order.append("waiter in")
+
+        first = run(holder)
+        held.wait()
+        second = run(waiter)
+        time.sleep(0.1)
+        self.store.drop("f")
+        third = run(waiter)
+        time.sleep(0.1)
+        early = list(order)
+        release.set()
+        for thread in (first, second, third):
+            thread.join()
+        self.assertEqual(early, [])
+        self.assertEqual(order, ["holder out", "waiter in", "waiter in"])
+        self.assertEqual(self.store.file_locks, {})
+
+    def test_sweep_evicts_unlocked(self):
+        """
+        Sweep evicts unlocked.
+
+        Idle sessions are handed to on_evict with their chunks dropped and
+        without the store lock held.
+        """
+        with self.store.session("f") as session:
+            session["set"][1] = b"0123456789abcdefgh"
+            session["set"][2] = b"xy"
+        self.store.sweep(time.monotonic() + 2000)
+        self.assertEqual(len(self.evicted), 1)
+        fileid, session, free = self.evicted[0]
+        self.assertEqual(fileid, "f")
+        self.assertEqual(len(session["set"]), 0)
+        self.assertTrue(free)
+        self.assertEqual(
+            self.store.metrics(),
+            {
+                "sessions": 0,
+                "buffered_bytes": 0,
+                "buffered_chunks": 0,
+                "spilled_bytes": 0,
+                "spilled_chunks": 0,
+                "evicted": 1,
+            },
+        )
+
+
+def ledger(rows):
+    """
+    Ledger.
+
+    A csv whose rows repeat every 400 rows, so most prompts are duplicates.
+    """
+    lines = ["a\nb\nc\nd\ne\n", "Original Vendor,GL Account Description\n"]
+    lines += [f"Vendor {i % 400} LLC,Supplies {i % 400}\n" for i in range(rows)]
+    return "".join(lines).encode()
+
+
+def apply_chunk(session, data, last):
+    """
+    Apply chunk.
+
+    Feeds a chunk to the prompt state of a session, keeping the prompts in
+    a pending buffer like a multipart upload does.
+    """
+    if "prompts" not in session:
+        session["prompts"] = new_prompt_state("f", True, session["tables"])
+        session["pending"] = b""
+    lines = feed_prompts(session["prompts"], data)
+    if last:
+        lines += flush_prompts(session["prompts"])
+    session["pending"] += "".join(lines).encode()
+    session["prompts"]["resolved"][len(session["pending"])] = "Food"
+
+
+class SQLiteStoreTest(unittest.TestCase):
+    """
+    SQLite store test.
+
+    Two stores on one database stand in for two worker processes.
+    """
+
+    def setUp(self):
+        """
+        Set up.
+
+        Paths for a store.
+        """
+        self.tmp = tempfile.mkdtemp()
+        self.evicted = []
+
+    def store(self, ttl=1000):
+        """
+        Store method.
+
+        A new store on the shared files.
+        """
+        return SQLiteSessionStore(
+            os.path.join(self.tmp, "sessions.db"),
+            ttl,
+            os.path.join(self.tmp, "locks"),
+            os.path.join(self.tmp, "blobs"),
+            on_evict=lambda fileid, session: self.evicted.append((fileid, session)),
+        )
+
+    def blobs(self):
+        """
+        Blobs method.
+
+        Sizes of the blob files of the upload f.
+        """
+        directory = os.path.join(self.tmp, "blobs", "f")
+        if not os.path.isdir(directory):
+            return []
+        return [
+            os.path.getsize(os.path.join(directory, name))
+            for name in os.listdir(directory)
+        ]
+
+    def test_round_trip_across_stores(self):
+        """
+        Round trip across stores.
+
+        Chunks applied by two stores in turn give the state one memory
+        session gets, with only the small state in the sessions row and the
+        pending bytes in one blob.
+        """
+        data = ledger(3000)
+        chunks = [data[i : i + 4000] for i in range(0, len(data), 4000)]
+        memory = {"tables": MemoryTables()}
+        stores = [self.store(), self.store()]
+        for number, chunk in enumerate(chunks):
+            last = number == len(chunks) - 1
+            apply_chunk(memory, chunk, last)
+            with stores[number % 2].session("f") as session:
+                apply_chunk(session, chunk, last)
+            if number == 20:
+                self.assertEqual(len(self.blobs()), 1)
+        self.assertGreater(len(memory["pending"]), BLOB_BYTES)
+        with self.store().session("f") as session:
+            prompts = session["prompts"]
+            self.assertEqual(session["pending"], memory["pending"])
+            self.assertEqual(prompts["rows"], 3000)
+            self.assertEqual(len(prompts["dedup"]["seen"]), 400)
+            self.assertEqual(
+                prompts["dedup"]["index"].tobytes(),
+                memory["prompts"]["dedup"]["index"].tobytes(),
+            )
+            self.assertEqual(
+                dict(prompts["resolved"].items()), memory["prompts"]["resolved"]
+            )
+        self.assertEqual(self.blobs(), [len(memory["pending"])])
+        with sqlite3.connect(os.path.join(self.tmp, "sessions.db")) as conn:
+            size = conn.execute("SELECT LENGTH(state) FROM sessions").fetchone()[0]
+        self.assertLess(size, 2048)
+
+    def test_failed_chunk_keeps_saved_state(self):
+        """
+        Failed chunk keeps saved state.
+
+        A chunk that fails leaves the state and blobs of the last save.
+        """
+        store = self.store()
+        with store.session("f") as session:
+            session["pending"] = b"x" * BLOB_BYTES
+            session["next"] = 1
+        with self.assertRaises(ValueError):
+            with store.session("f") as session:
+                session["pending"] += b"y"
+                session["next"] = 2
+                raise ValueError("bad chunk")
+        with store.session("f") as session:
+            self.assertEqual(session["pending"], b"x" * BLOB_BYTES)
+            self.assertEqual(session["next"], 1)
+
+    def test_sweep_evicts_idle(self):
+        """
+        Sweep evicts idle.
+
+        An idle session is handed to on_evict once, with its rows and blobs
+        gone and its lock file left for other workers.
+        """
+        store = self.store()
+        with store.session("f") as session:
+            session["set"][3] = b"chunk"
+            session["multipart"] = {"upload_id": "up", "pending": b"x" * BLOB_BYTES}
+        other = self.store()
+        store.sweep(time.time() + 2000)
+        other.sweep(time.time() + 2000)
+        self.assertEqual(len(self.evicted), 1)
+        fileid, session = self.evicted[0]
+        self.assertEqual((fileid, session["multipart"]["upload_id"]), ("f", "up"))
+        self.assertEqual(self.blobs(), [])
+        self.assertEqual(os.listdir(os.path.join(self.tmp, "locks")), ["f.lock"])
+        metrics = other.metrics()
+        self.assertEqual((metrics["sessions"], metrics["evicted"]), (0, 1))
+        with other.session("f") as session:
+            self.assertEqual(len(session["set"]), 0)
+
+    def test_drop_waits_for_holder(self):
+        """
+        Drop waits for holder.
+
+        A worker dropping an upload another worker is applying a chunk to
+        waits for it, and gets the state that worker saved.
+        """
+        holder = self.store()
+        dropper = self.store()
+        held = threading.Event()
+        release = threading.Event()
+        dropped = []
+
+        def hold():
+            with holder.session("f") as session:
+                held.set()
+                release.wait()
+                session["next"] = 7
+
+        first = run(hold)
+        held.wait()
+        second = run(lambda: dropped.append(dropper.drop("f")))
+        time.sleep(0.2)
+        early = list(dropped)
+        release.set()
+        first.join()
+        second.join()
+        self.assertEqual(early, [])
+        self.assertEqual(dropped[0]["next"], 7)
+        self.assertIsNone(dropper.drop("f"))
+
+    def test_other_host_refused(self):
+        """
+        Other host refused.
+
+        A database holding sessions cannot be opened from another host, and
+        a host whose database was taken over stops using it.
+        """
+        store = self.store()
+        with store.session("f"):
+            pass
+        with mock.patch("socket.gethostname", return_value="elsewhere"):
+            with self.assertRaises(DBError):
+                self.store()
+            store.drop("f")
+            self.store()
+        with self.assertRaises(DBError):
+            with store.session("g"):
+                pass
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,193 @@
+"""
+Shard tests.
+
+Checks how many shards a file is split into, that shards keep every row
+under its recordId within their limits, and that a failed submit leaves
+nothing running, against moto. Run with
+`python -m unittest backend.tests.test_shard`.
+"""
+
+import os
+import json
+import unittest
+import boto3
+import pandas as pd
+from moto import mock_aws
+
+from backend.tests.aws import create_bucket, set_env
+from backend.types.errors import BedrockError
+from backend.utils.db.uploader import convert_to_lines, record_id
+from backend.utils.shard import input_rows, input_size, shard_count, shard_jobs
+
+FILEID = "S" * 32
+
+
+class FailingEngine:
+    """
+    Failing engine.
+
+    Gives a job for every shard but the one named bad, recording the jobs
+    stopped.
+    """
+
+    def __init__(self, bad):
+        """
+        Init function.
+
+        bad is the shard input whose submit fails.
+        """
+        self.bad = bad
+        self.stopped = []
+
+    def submit(self, input_name):
+        """
+        Submit method.
+
+        Fails on the bad shard.
+        """
+        if input_name == self.bad:
+            raise RuntimeError("quota")
+        return f"job-{input_name}"
+
+    def stop(self, jobid):
+        """
+        Stop method.
+
+        Records the job.
+        """
+        self.stopped.append(jobid)
+
+
+class ShardCountTest(unittest.TestCase):
+    """
+    Shard count test.
+
+    Shards per file size.
+    """
+
+    def test_shard_count(self):
+        """
+        Shard count.
+
+        One shard per shard_bytes started, at least one and at most
+        max_shards, and one when sharding is off.
+        """
+        self.assertEqual(shard_count(0, 100, 8), 1)
+        self.assertEqual(shard_count(100, 100, 8), 1)
+        self.assertEqual(shard_count(101, 100, 8), 2)
+        self.assertEqual(shard_count(10_000, 100, 8), 8)
+        self.assertEqual(shard_count(10_000, 0, 8), 1)
+
+
+class ShardInputTest(unittest.TestCase):
+    """
+    Shard input test.
+
+    Shards of a file in a moto bucket.
+    """
+
+    def setUp(self):
+        """
+        Set up.
+
+        Puts the prompts of a 100 row file, the first 10 from before
+        prompts had a recordId.
+        """
+        set_env()
+        self.aws = mock_aws()
+        self.aws.start()
+        self.s3_client = boto3.client("s3")
+        create_bucket(self.s3_client)
+        self.bucket = os.environ["AWS_S3_UPLOAD_NAME"]
+        df = pd.DataFrame({"Vendor": [f"Shop {i}" for i in range(100)]})
+        lines = convert_to_lines(df.iloc[:10]) + convert_to_lines(
+            df.iloc[10:], FILEID, 10
+        )
+        self.s3_client.put_object(
+            Bucket=self.bucket, Key=f"input/{FILEID}.jsonl", Body="".join(lines)
+        )
+        self.size = input_size(FILEID, self.bucket, self.s3_client)
+
+    def tearDown(self):
+        """
+        Tear down.
+
+        Stops moto.
+        """
+        self.aws.stop()
+
+    def shard_rows(self, name):
+        """
+        Shard rows.
+
+        The recordIds of a shard.
+        """
+        body = self.s3_client.get_object(Bucket=self.bucket, Key=f"input/{name}")
+        return [json.loads(line)["recordId"] for line in body["Body"].iter_lines()]
+
+    def jobs(self, count, max_rows=None, max_shards=None, engine=None):
+        """
+        Jobs method.
+
+        Shards the file and gives back the rows of every shard.
+        """
+        engine = engine or FailingEngine(None)
+        jobs = shard_jobs(
+            FILEID,
+            self.bucket,
+            self.s3_client,
+            engine,
+            count,
+            self.size,
+            max_rows,
+            max_shards,
+        )
+        return [self.shard_rows(job["input"]) for job in jobs]
+
+    def test_rows_kept_in_order(self):
+        """
+        Rows kept in order.
+
+        Every row lands once, in order, under its recordId, over shards of
+        about the same size.
+        """
+        self.assertEqual(input_rows(FILEID, self.bucket, self.s3_client, 1000), 100)
+        self.assertEqual(input_rows(FILEID, self.bucket, self.s3_client, 5), 6)
+        shards = self.jobs(4)
+        self.assertEqual(len(shards), 4)
+        rows = [record for shard in shards for record in shard]
+        self.assertEqual(rows, [record_id(FILEID, row) for row in range(100)])
+        for shard in shards:
+            self.assertLessEqual(abs(len(shard) - 25), 2)
+
+    def test_max_rows_and_max_shards(self):
+        """
+        Max rows and max shards.
+
+        A shard full of rows starts the next one early, but never past
+        max_shards, where the last shard takes the rest.
+        """
+        self.assertEqual([len(shard) for shard in self.jobs(2, 30, 5)], [30] * 3 + [10])
+        self.assertEqual([len(shard) for shard in self.jobs(2, 30, 3)], [30, 30, 40])
+
+    def test_failed_submit_stops_started_jobs(self):
+        """
+        Failed submit stops started jobs.
+
+        When a shard cannot be submitted the others are stopped and every
+        shard deleted.
+        """
+        engine = FailingEngine(f"{FILEID}-1.jsonl")
+        with self.assertRaises(BedrockError):
+            self.jobs(3, engine=engine)
+        self.assertEqual(
+            sorted(engine.stopped), [f"job-{FILEID}-0.jsonl", f"job-{FILEID}-2.jsonl"]
+        )
+        listed = self.s3_client.list_objects_v2(
+            Bucket=self.bucket, Prefix=f"input/{FILEID}-"
+        )
+        self.assertEqual(listed.get("Contents", []), [])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,182 @@
+"""
+Uploader tests.
+
+Checks that prompts built from a csv fed in chunks, or streamed a block of
+rows at a time, match the whole file conversion, wherever the chunks split.
+Run with
+`python -m unittest backend.tests.test_uploader`.
+"""
+
+import os
+import json
+import tempfile
+import unittest
+from unittest import mock
+
+from backend.utils.db import uploader
+from backend.utils.db.uploader import (
+    PROMPT,
+    convert_to_prompts,
+    feed_prompts,
+    flush_prompts,
+    new_prompt_state,
+    record_id,
+    split_records,
+    stream_prompts,
+)
+
+FILEID = "T" * 32
+PREAMBLE = "Report\nTreya Partners\nGeneral Ledger\nPeriod: 2023\nBasis: Accrual\n"
+
+
+def ledger_csv(rows):
+    """
+    Ledger csv.
+
+    A csv whose amounts are whole numbers until a blank shows up near the
+    end, so a chunk without the blank would infer ints and one with it
+    floats. Some descriptions hold quoted commas and newlines.
+    """
+    lines = [PREAMBLE, "Original Vendor,GL Account Description,Amount,Code\n"]
+    for i in range(rows):
+        amount = "" if i == rows - 3 else str(i % 7)
+        description = f'"Supplies, line {i}\nsecond line"' if i % 5 == 0 else "Food"
+        lines.append(f"Vendor {i} LLC,{description},{amount},00{i % 3}\n")
+    return "".join(lines).encode("utf-8")
+
+
+def chunked_inputs(data, chunk_size):
+    """
+    Chunked inputs.
+
+    Model inputs of the prompts of data fed chunk_size bytes at a time,
+    checking every line carries the recordId of its row.
+    """
+    state = new_prompt_state(FILEID)
+    lines = []
+    for start in range(0, len(data), chunk_size):
+        lines += feed_prompts(state, data[start : start + chunk_size])
+    lines += flush_prompts(state)
+    res = []
+    for row, line in enumerate(lines):
+        parsed = json.loads(line)
+        assert parsed["recordId"] == record_id(FILEID, row)
+        res.append(parsed["modelInput"])
+    return res
+
+
+def whole_inputs(data):
+    """
+    Whole inputs.
+
+    Model inputs of the prompts of data converted in one read.
+    """
+    with tempfile.TemporaryDirectory() as tmp:
+        input_path = os.path.join(tmp, "ledger.csv")
+        output_path = os.path.join(tmp, "ledger.jsonl")
+        with open(input_path, "wb") as f:
+            f.write(data)
+        convert_to_prompts(input_path, output_path, stream=False)
+        with open(output_path) as f:
+            return [json.loads(line)["modelInput"] for line in f]
+
+
+class ChunkedPromptsTest(unittest.TestCase):
+    """
+    Chunked prompts test.
+
+    Chunked conversion against whole file conversion.
+    """
+
+    def test_chunks_match_whole_file(self):
+        """
+        Chunks match whole file.
+
+        Every chunk size gives the prompts of the whole file conversion.
+        """
+        data = ledger_csv(200)
+        expected = whole_inputs(data)
+        self.assertEqual(len(expected), 200)
+        for chunk_size in (1, 7, 64, 1000, 4096, len(data)):
+            with self.subTest(chunk_size=chunk_size):
+                self.assertEqual(chunked_inputs(data, chunk_size), expected)
+
+    def test_values_keep_their_text(self):
+        """
+        Values keep their text.
+
+        Whole numbers stay whole and leading zeros stay, even in a chunk
+        where the column has a blank.
+        """
+        text = chunked_inputs(ledger_csv(200), 64)[-1]["messages"][0]["content"][0]
+        self.assertIn("Amount: 3\n", text["text"])
+        self.assertIn("Code: 001\n", text["text"])
+
+    def test_prompt_text_format(self):
+        """
+        Prompt text format.
+
+        Pins the text of the whole file conversion. Values keep the text
+        they have in the csv where inferred types gave 3.0 and 7, and blank
+        and NaN cells are left out.
+        """
+        data = (
+            PREAMBLE + "Vendor,Amount,Code,Memo\n"
+            "Acme,1.0,007,NaN\nBeta,3,010,\nGamma,,2, x \n"
+        ).encode("utf-8")
+        texts = [i["messages"][0]["content"][0]["text"] for i in whole_inputs(data)]
+        self.assertEqual(
+            texts,
+            [
+                PROMPT + "Vendor: Acme\nAmount: 1.0\nCode: 007\n",
+                PROMPT + "Vendor: Beta\nAmount: 3\nCode: 010\n",
+                PROMPT + "Vendor: Gamma\nCode: 2\nMemo:  x \n",
+            ],
+        )
+
+
+class StreamPromptsTest(unittest.TestCase):
+    """
+    Stream prompts test.
+
+    Block by block conversion against whole file conversion.
+    """
+
+    def test_blocks_match_whole_file(self):
+        """
+        Blocks match whole file.
+
+        Any block size gives the lines of the whole file, converting one
+        block of rows at a time.
+        """
+        data = ledger_csv(200)
+        expected = whole_inputs(data)
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, "ledger.csv")
+            with open(path, "wb") as f:
+                f.write(data)
+            for chunk_rows in (1, 33, 200, 1000):
+                with self.subTest(chunk_rows=chunk_rows):
+                    with mock.patch.object(
+                        uploader, "convert_to_lines", wraps=uploader.convert_to_lines
+                    ) as convert:
+                        lines = list(stream_prompts(path, chunk_rows))
+                    inputs = [json.loads(line)["modelInput"] for line in lines]
+                    self.assertEqual(inputs, expected)
+                    self.assertEqual(convert.call_count, -(-200 // chunk_rows))
+                    for call in convert.call_args_list:
+                        self.assertLessEqual(len(call.args[0]), chunk_rows)
+
+    def test_split_records_skips_quoted_newlines(self):
+        """
+        Split records skips quoted newlines.
+
+        The split falls after the last newline outside quotes.
+        """
+        self.assertEqual(split_records(b'a,b\nc,"d\ne'), 4)
+        self.assertEqual(split_records(b'a,"b\nc"\nd'), 8)
+        self.assertEqual(split_records(b'a,"b\nc'), 0)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,236 @@
+"""
+Job watcher tests.
+
+Checks that a file is marked processed, learned and announced once, however
+many of its jobs finish together and whichever path sees them finish, and
+that job statuses are looked up concurrently and cached. Run with
+`python -m unittest backend.tests.test_watcher`.
+"""
+
+import threading
+import unittest
+import boto3
+from moto import mock_aws
+
+from backend.tests.aws import FakeSocketIO, create_file_table, set_env
+from backend.utils.batch import (
+    LOCAL_JOB_PREFIX,
+    JobStatusTracker,
+    files_state,
+    get_job_tracker,
+)
+from backend.utils.db.dynamo import (
+    create_item_db,
+    finish_item_db,
+    get_item_db,
+    mark_item_db,
+    update_all_items,
+)
+from backend.utils.db.filedb import list_ingester
+from backend.utils.watcher import JobWatcher
+
+FILEID = "W" * 32
+
+
+class FakeBedrock:
+    """
+    Fake bedrock.
+
+    Answers job lookups from a dict of statuses.
+    """
+
+    def __init__(self, statuses):
+        """
+        Init function.
+
+        statuses maps job arns to their status. With a barrier every
+        lookup waits on it, so they only go through when made at once.
+        """
+        self.statuses = statuses
+        self.barrier = None
+        self.lock = threading.Lock()
+        self.calls = []
+
+    def get_model_invocation_job(self, jobIdentifier):
+        """
+        Get model invocation job.
+
+        The status of a job.
+        """
+        with self.lock:
+            self.calls.append(jobIdentifier)
+        if self.barrier is not None:
+            self.barrier.wait(5)
+        return {"status": self.statuses[jobIdentifier]}
+
+
+class WatcherTest(unittest.TestCase):
+    """
+    Watcher test.
+
+    A file sharded over two local jobs, which are complete as soon as they
+    are looked up.
+    """
+
+    def setUp(self):
+        """
+        Set up.
+
+        Creates the table and the file, marked processing on both jobs.
+        """
+        set_env()
+        self.aws = mock_aws()
+        self.aws.start()
+        self.db_client = boto3.client("dynamodb")
+        create_file_table(self.db_client)
+        create_item_db(FILEID, "user", "ledger.csv", self.db_client)
+        self.jobs = [
+            {"jobid": f"{LOCAL_JOB_PREFIX}{FILEID}-{shard}", "input": f"{FILEID}-0"}
+            for shard in range(2)
+        ]
+        mark_item_db(FILEID, self.jobs[0]["jobid"], "user", self.db_client, self.jobs)
+        self.learned = []
+
+    def tearDown(self):
+        """
+        Tear down.
+
+        Stops moto.
+        """
+        self.aws.stop()
+
+    def learn(self, fileid, username):
+        """
+        Learn.
+
+        Records the files learned.
+        """
+        self.learned.append((fileid, username))
+
+    def test_jobs_finishing_together_learn_once(self):
+        """
+        Jobs finishing together learn once.
+
+        Both jobs complete in one poll, the file is learned and announced
+        once.
+        """
+        socketio = FakeSocketIO()
+        watcher = JobWatcher(socketio, self.db_client, None, 0, 0, self.learn)
+        for job in self.jobs:
+            watcher.track(job["jobid"], FILEID, "user", delay=0)
+        watcher.poll()
+        self.assertEqual(self.learned, [(FILEID, "user")])
+        self.assertEqual(
+            [event["processed"] for event in socketio.events("status")],
+            ["processed"],
+        )
+        self.assertEqual(
+            get_item_db(FILEID, "user", self.db_client)["processed"], "processed"
+        )
+        self.assertEqual(watcher.metrics(), {"jobs": 0})
+
+    def test_listing_learns_once(self):
+        """
+        Listing learns once.
+
+        Without a watcher the first list marks the file processed and learns
+        it, later lists leave it.
+        """
+        for _ in range(3):
+            items = update_all_items("user", self.db_client, None, self.learn)
+            self.assertEqual(items[0]["processed"]["S"], "processed")
+        self.assertEqual(self.learned, [(FILEID, "user")])
+
+    def test_list_refreshes_jobs_watched_elsewhere(self):
+        """
+        List refreshes jobs watched elsewhere.
+
+        A job submitted by another server process shows its new status on
+        the next list here.
+        """
+        jobid = "arn:aws:bedrock:job/elsewhere"
+        create_item_db("E" * 32, "user", "other.csv", self.db_client)
+        mark_item_db("E" * 32, jobid, "user", self.db_client)
+        bedrock = FakeBedrock({jobid: "InProgress"})
+        get_job_tracker().forget(jobid)
+        files = list_ingester("user", self.db_client, bedrock)
+        self.assertEqual(files["E" * 32]["processed"], "processing")
+        bedrock.statuses[jobid] = "Completed"
+        get_job_tracker().forget(jobid)
+        files = list_ingester("user", self.db_client, bedrock)
+        self.assertEqual(files["E" * 32]["processed"], "processed")
+
+    def test_finish_once(self):
+        """
+        Finish once.
+
+        Only the first finish moves the file, a deleted file is never
+        written back.
+        """
+        self.assertTrue(finish_item_db(FILEID, "user", self.db_client))
+        self.assertFalse(finish_item_db(FILEID, "user", self.db_client))
+        self.assertFalse(finish_item_db("gone", "user", self.db_client))
+
+
+class TrackerTest(unittest.TestCase):
+    """
+    Tracker test.
+
+    Job status lookups through the tracker.
+    """
+
+    def test_lookups_run_together_and_terminal_ones_stay(self):
+        """
+        Lookups run together and terminal ones stay.
+
+        Stale statuses are fetched at once, terminal ones are never fetched
+        again and in flight ones once their ttl is over.
+        """
+        bedrock = FakeBedrock(
+            {"arn:a": "InProgress", "arn:b": "Completed", "arn:c": "Failed"}
+        )
+        bedrock.barrier = threading.Barrier(3)
+        tracker = JobStatusTracker(0, 3)
+        jobs = ["arn:a", "arn:b", "arn:c", "arn:a"]
+        self.assertEqual(
+            tracker.statuses(jobs, bedrock),
+            {"arn:a": "InProgress", "arn:b": "Completed", "arn:c": "Failed"},
+        )
+        self.assertEqual(sorted(bedrock.calls), ["arn:a", "arn:b", "arn:c"])
+        bedrock.barrier = None
+        bedrock.calls = []
+        bedrock.statuses["arn:a"] = "Completed"
+        self.assertEqual(tracker.status("arn:a", bedrock), "Completed")
+        tracker.statuses(jobs, bedrock)
+        self.assertEqual(bedrock.calls, ["arn:a"])
+
+    def test_in_flight_cached_for_ttl(self):
+        """
+        In flight cached for ttl.
+
+        An in flight status is trusted until its ttl is over.
+        """
+        bedrock = FakeBedrock({"arn:a": "InProgress"})
+        tracker = JobStatusTracker(60, 2)
+        tracker.status("arn:a", bedrock)
+        bedrock.statuses["arn:a"] = "Completed"
+        self.assertEqual(tracker.status("arn:a", bedrock), "InProgress")
+        tracker.forget("arn:a")
+        self.assertEqual(tracker.status("arn:a", bedrock), "Completed")
+        self.assertEqual(len(bedrock.calls), 2)
+
+    def test_files_state(self):
+        """
+        Files state.
+
+        A file is processed once every job is, and goes back to not
+        processed when any of them failed.
+        """
+        self.assertEqual(files_state(["Completed", "PartiallyCompleted"]), "processed")
+        self.assertEqual(files_state(["Completed", "InProgress"]), "processing")
+        self.assertEqual(files_state(["Completed", "Failed"]), "not processed")
+        self.assertEqual(files_state(["Submitted", "Expired"]), "not processed")
+
+
+if __name__ == "__main__":
+    unittest.main()
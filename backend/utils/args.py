@@ -34,7 +34,7 @@ def parse_json(data):
         if not isinstance(data, dict):
             raise ValueError("Expected data to be a dictionary.")
 
-        if "chunk" in data:
+        if "chunk" in data and isinstance(data["chunk"], str):
             base64_chunk = data["chunk"]
             try:
                 # Decode the Base64-encoded file chunk
@@ -44,6 +44,11 @@ def parse_json(data):
                 )
             except Exception as e:
                 raise JSONError(f"Failed to decode Base64 chunk: {e}", False)
+        elif "chunk" in data and isinstance(data["chunk"], (bytes, bytearray)):
+            # binary attachments are used as they are, without a copy
+            data["chunk"] = memoryview(data["chunk"])
+        elif "chunk" in data and not isinstance(data["chunk"], memoryview):
+            raise JSONError("chunk must be base64 or binary", True)
 
         return data
     except json.JSONDecodeError as e:
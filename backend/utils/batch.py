@@ -5,9 +5,60 @@ This module contains the functions that are used to process chunks of data in ba
 """
 
 import os
+import time
 import uuid
+import threading
+from concurrent.futures import ThreadPoolExecutor
 from backend.types.errors import BedrockError
 
+# jobs of the local engine, answered before their id is handed out
+LOCAL_JOB_PREFIX = "local-"
+# jobs of the on demand engine, written before their id is handed out
+ONDEMAND_JOB_PREFIX = "ondemand-"
+# bedrock batch statuses that never change again
+TERMINAL_STATES = {"Completed", "PartiallyCompleted", "Failed", "Stopped", "Expired"}
+
+job_tracker = None
+
+
+def processed_state(status):
+    """
+    Processed state.
+
+    Maps a batch job status to the processed value stored on a file. Jobs that
+    ended without output put the file back to not processed so it can be
+    sent again.
+    """
+    if status in ("Completed", "PartiallyCompleted"):
+        return "processed"
+    if status in TERMINAL_STATES or status == "none":
+        return "not processed"
+    return "processing"
+
+
+def files_state(statuses):
+    """
+    Files state.
+
+    Processed value of a file whose records are spread over several jobs. It
+    is processed once every job is, and goes back if any of them failed.
+    """
+    states = {processed_state(status) for status in statuses}
+    if "not processed" in states:
+        return "not processed"
+    if states == {"processed"}:
+        return "processed"
+    return "processing"
+
+
+def output_key(jobid, input_name):
+    """
+    Output key.
+
+    Where bedrock writes the output of an input file run by a job.
+    """
+    return f"output/{jobid.split('/')[-1]}/{input_name}.out"
+
 
 def create_batch_job(input_file, output_file, bedrock_client):
     """
@@ -37,7 +88,116 @@ def get_batch_job(jobid, bedrock_client):
     try:
         if jobid == "none":
             return "none"
+        if jobid.startswith((LOCAL_JOB_PREFIX, ONDEMAND_JOB_PREFIX)):
+            return "Completed"
         response = bedrock_client.get_model_invocation_job(jobIdentifier=jobid)
         return response.get("status")
     except Exception as e:
         raise BedrockError(str(e))
+
+
+class JobStatusTracker:
+    """
+    Job status tracker.
+
+    Caches batch job statuses. Terminal statuses never change so they are kept
+    for good, in flight ones only for a few seconds. Lookups that miss the
+    cache run concurrently.
+    """
+
+    def __init__(self, ttl, workers):
+        """
+        Init function.
+
+        ttl is how long an in flight status is trusted, workers how many
+        lookups run at once.
+        """
+        self.ttl = ttl
+        self.workers = workers
+        self.lock = threading.Lock()
+        self.cache = {}
+
+    def cached(self, jobid, now):
+        """
+        Cached method.
+
+        Gives back a status that is still fresh, or None.
+        """
+        with self.lock:
+            entry = self.cache.get(jobid)
+        if entry is None:
+            return None
+        status, expires = entry
+        if expires is not None and expires < now:
+            return None
+        return status
+
+    def remember(self, jobid, status, now):
+        """
+        Remember method.
+
+        Caches a status, for good when it is terminal.
+        """
+        expires = None if status in TERMINAL_STATES else now + self.ttl
+        with self.lock:
+            self.cache[jobid] = (status, expires)
+
+    def statuses(self, jobids, bedrock_client):
+        """
+        Statuses method.
+
+        Gets the status of every job, fetching the stale ones concurrently.
+        """
+        now = time.monotonic()
+        res = {}
+        missing = []
+        for jobid in set(jobids):
+            status = self.cached(jobid, now)
+            if status is None:
+                missing.append(jobid)
+            else:
+                res[jobid] = status
+        if len(missing) == 1:
+            res[missing[0]] = get_batch_job(missing[0], bedrock_client)
+        elif missing:
+            with ThreadPoolExecutor(max_workers=self.workers) as pool:
+                fetched = pool.map(
+                    lambda jobid: get_batch_job(jobid, bedrock_client), missing
+                )
+                res.update(zip(missing, fetched))
+        now = time.monotonic()
+        for jobid in missing:
+            self.remember(jobid, res[jobid], now)
+        return res
+
+    def status(self, jobid, bedrock_client):
+        """
+        Status method.
+
+        Gets the status of one job.
+        """
+        return self.statuses([jobid], bedrock_client)[jobid]
+
+    def forget(self, jobid):
+        """
+        Forget method.
+
+        Drops a cached status.
+        """
+        with self.lock:
+            self.cache.pop(jobid, None)
+
+
+def get_job_tracker():
+    """
+    Get job tracker.
+
+    Creates the job status tracker on first use, once the env has been loaded.
+    """
+    global job_tracker
+    if job_tracker is None:
+        job_tracker = JobStatusTracker(
+            float(os.environ.get("JOB_STATUS_TTL", "30")),
+            int(os.environ.get("JOB_STATUS_WORKERS", "16")),
+        )
+    return job_tracker
@@ -0,0 +1,412 @@
+"""
+Category cache.
+
+Remembers the categories bedrock gave each vendor and description across
+uploads, in a dynamo table. Rows of a new upload whose vendor has been put in
+the same category often enough are resolved on the spot and never sent.
+"""
+
+import os
+import re
+import json
+import time
+import threading
+from functools import lru_cache
+from collections import Counter, OrderedDict
+from backend.types.errors import DBError
+
+category_cache = None
+
+# batch_get_item takes at most 100 keys per call
+BATCH_GET_KEYS = 100
+
+
+def simple_normalize(item):
+    """
+    Simple normalize.
+
+    The first steps of Utils.token_and_stem, for when the model utils and
+    their nltk data are not installed.
+    """
+    no_long_numbers = re.sub(r"\b\d{3,}\b", "", item.lower())
+    alphanum = re.sub(r"[^a-z0-9]", " ", no_long_numbers)
+    res = " ".join(alphanum.split())
+    if res == "":
+        return item
+    return res
+
+
+def load_normalizer():
+    """
+    Load normalizer.
+
+    The backend image ships neither the model package nor nltk, so keys are
+    built with simple_normalize. CATEGORY_NORMALIZER=stem uses
+    Utils.token_and_stem from model/process_data/utils instead, the same
+    clean up the search table is keyed by, falling back when it or its nltk
+    data cannot be loaded. Keys of one do not match keys of the other.
+    """
+    if os.environ.get("CATEGORY_NORMALIZER", "simple") != "stem":
+        return simple_normalize
+    try:
+        from model.process_data.utils import Normalizer
+
+        normalize = Normalizer().token_and_stem
+        normalize("probe")
+    except (ImportError, LookupError) as e:
+        print(f"category keys fall back to simple_normalize: {type(e).__name__}")
+        return simple_normalize
+    return normalize
+
+
+class CategoryCache:
+    """
+    Category cache.
+
+    Counts of the categories given to every key, with a local LRU in front of
+    the table so each upload only reads the keys it has not seen lately.
+    """
+
+    def __init__(
+        self,
+        db_client,
+        table,
+        vendor_column,
+        description_column,
+        min_count,
+        min_confidence,
+        max_entries,
+        ttl,
+        normalize,
+    ):
+        """
+        Init function.
+
+        A key is trusted once it has min_count answers and at least
+        min_confidence of them agree. Looked up keys are kept locally for ttl
+        seconds, up to max_entries.
+        """
+        self.db_client = db_client
+        self.table = table
+        self.vendor_column = vendor_column
+        self.description_column = description_column
+        self.min_count = min_count
+        self.min_confidence = min_confidence
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.normalize = lru_cache(maxsize=65536)(normalize)
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()
+        self.rows = 0
+        self.hits = 0
+        self.reads = 0
+        self.learned = 0
+
+    def key(self, vendor, description=None):
+        """
+        Key method.
+
+        Normalized vendor and description of a row.
+        """
+        key = self.normalize(str(vendor))
+        if description is not None:
+            key += "|" + self.normalize(str(description))
+        return key
+
+    def row_keys(self, df):
+        """
+        Row keys.
+
+        Keys of every row of a frame, None for rows without a vendor.
+        """
+        if self.vendor_column not in df.columns:
+            return [None] * len(df)
+        vendors = df[self.vendor_column].tolist()
+        if self.description_column in df.columns:
+            descriptions = df[self.description_column].tolist()
+        else:
+            descriptions = [None] * len(df)
+        keys = []
+        for vendor, description in zip(vendors, descriptions):
+            if not isinstance(vendor, str) or vendor.strip() == "":
+                keys.append(None)
+                continue
+            if not isinstance(description, str):
+                description = None
+            keys.append(self.key(vendor, description))
+        return keys
+
+    def confident(self, counts):
+        """
+        Confident method.
+
+        Gives the category agreed on by the counts, or None.
+        """
+        if not counts:
+            return None
+        total = sum(counts.values())
+        category, count = max(counts.items(), key=lambda item: item[1])
+        if total < self.min_count or count < total * self.min_confidence:
+            return None
+        return category
+
+    def cached(self, key, now):
+        """
+        Cached method.
+
+        Gives the local counts of a key that are still fresh, or None.
+        """
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                return None
+            counts, expires = entry
+            if expires < now:
+                del self.entries[key]
+                return None
+            self.entries.move_to_end(key)
+            return counts
+
+    def remember(self, key, counts, now):
+        """
+        Remember method.
+
+        Keeps the counts of a key locally, evicting the least recently used.
+        """
+        with self.lock:
+            self.entries[key] = (counts, now + self.ttl)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+    def fetch(self, keys):
+        """
+        Fetch method.
+
+        Reads the counts of keys from the table, 100 at a time, asking again
+        for keys dynamo left unprocessed.
+        """
+        res = {key: {} for key in keys}
+        for i in range(0, len(keys), BATCH_GET_KEYS):
+            request = {
+                self.table: {
+                    "Keys": [
+                        {"key": {"S": key}} for key in keys[i : i + BATCH_GET_KEYS]
+                    ]
+                }
+            }
+            delay = 0.05
+            while request:
+                try:
+                    response = self.db_client.batch_get_item(RequestItems=request)
+                except Exception as e:
+                    raise DBError(str(e))
+                for item in response.get("Responses", {}).get(self.table, []):
+                    res[item["key"]["S"]] = {
+                        category: int(count["N"])
+                        for category, count in item.get("categories", {})
+                        .get("M", {})
+                        .items()
+                    }
+                request = response.get("UnprocessedKeys")
+                if request:
+                    time.sleep(delay)
+                    delay = min(delay * 2, 1)
+        with self.lock:
+            self.reads += len(keys)
+        return res
+
+    def resolve(self, keys):
+        """
+        Resolve method.
+
+        Gives the trusted category of every key, None where there is none.
+        """
+        now = time.monotonic()
+        counts = {}
+        missing = []
+        for key in set(keys):
+            if key is None:
+                continue
+            found = self.cached(key, now)
+            if found is None:
+                missing.append(key)
+            else:
+                counts[key] = found
+        if missing:
+            fetched = self.fetch(missing)
+            now = time.monotonic()
+            for key, found in fetched.items():
+                self.remember(key, found, now)
+            counts.update(fetched)
+        categories = {key: self.confident(found) for key, found in counts.items()}
+        res = [categories.get(key) for key in keys]
+        with self.lock:
+            self.rows += len(res)
+            self.hits += sum(category is not None for category in res)
+        return res
+
+    def learn(self, answers):
+        """
+        Learn method.
+
+        Adds (key, category) answers of a finished job to the counts.
+        """
+        tallies = {}
+        for key, category in answers:
+            category = category.strip()
+            if key is None or category == "":
+                continue
+            tallies.setdefault(key, Counter())[category] += 1
+        for key, tally in tallies.items():
+            self.add(key, tally)
+        with self.lock:
+            self.learned += sum(sum(tally.values()) for tally in tallies.values())
+            for key in tallies:
+                self.entries.pop(key, None)
+
+    def add(self, key, tally):
+        """
+        Add method.
+
+        Atomically adds to the counts of a key, creating the map on first use.
+        """
+        try:
+            self.db_client.update_item(
+                TableName=self.table,
+                Key={"key": {"S": key}},
+                UpdateExpression="SET categories = if_not_exists(categories, :empty)",
+                ExpressionAttributeValues={":empty": {"M": {}}},
+            )
+            names = {}
+            values = {":zero": {"N": "0"}}
+            updates = []
+            for i, (category, count) in enumerate(tally.items()):
+                names[f"#c{i}"] = category
+                values[f":n{i}"] = {"N": str(count)}
+                updates.append(
+                    f"categories.#c{i} = "
+                    f"if_not_exists(categories.#c{i}, :zero) + :n{i}"
+                )
+            self.db_client.update_item(
+                TableName=self.table,
+                Key={"key": {"S": key}},
+                UpdateExpression="SET " + ", ".join(updates),
+                ExpressionAttributeNames=names,
+                ExpressionAttributeValues=values,
+            )
+        except Exception as e:
+            raise DBError(str(e))
+
+    def invalidate(self, vendor, description=None):
+        """
+        Invalidate method.
+
+        Forgets everything learned about a vendor and description, for when
+        its category was wrong or has changed.
+        """
+        key = self.key(vendor, description)
+        try:
+            self.db_client.delete_item(TableName=self.table, Key={"key": {"S": key}})
+        except Exception as e:
+            raise DBError(str(e))
+        with self.lock:
+            self.entries.pop(key, None)
+
+    def clear(self):
+        """
+        Clear method.
+
+        Drops the local copy, so every key is read again from the table.
+        """
+        with self.lock:
+            self.entries.clear()
+
+    def metrics(self):
+        """
+        Metrics method.
+
+        Rows looked up, rows resolved without the model and keys read.
+        """
+        with self.lock:
+            return {
+                "rows": self.rows,
+                "hits": self.hits,
+                "hit_rate": self.hits / self.rows if self.rows else 0.0,
+                "reads": self.reads,
+                "learned": self.learned,
+                "entries": len(self.entries),
+            }
+
+
+def get_category_cache(db_client):
+    """
+    Get category cache.
+
+    Creates the category cache on first use, once the env has been loaded.
+    Gives None when AWS_CATEGORY_TABLE_NAME is not set.
+    """
+    global category_cache
+    table = os.environ.get("AWS_CATEGORY_TABLE_NAME")
+    if not table:
+        return None
+    if category_cache is None:
+        category_cache = CategoryCache(
+            db_client,
+            table,
+            os.environ.get("CATEGORY_VENDOR_COLUMN", "Original Vendor"),
+            os.environ.get("CATEGORY_DESCRIPTION_COLUMN", "GL Account Description"),
+            int(os.environ.get("CATEGORY_MIN_COUNT", "3")),
+            float(os.environ.get("CATEGORY_MIN_CONFIDENCE", "0.9")),
+            int(os.environ.get("CATEGORY_CACHE_ENTRIES", "100000")),
+            float(os.environ.get("CATEGORY_CACHE_TTL", "300")),
+            load_normalizer(),
+        )
+    return category_cache
+
+
+def known_key(fileid):
+    """
+    Known key.
+
+    Where the rows resolved by the cache and the key of every record sent
+    for a file are kept, next to its input.
+    """
+    return f"input/{fileid}.categories.json"
+
+
+def upload_known(state, fileid, bucket, s3_client):
+    """
+    Upload known.
+
+    Stores the resolved rows and record keys of an upload.
+    """
+    body = json.dumps(
+        {
+            "resolved": dict(state["resolved"].items()),
+            "keys": dict(state["keys"].items()),
+        }
+    )
+    try:
+        s3_client.put_object(Bucket=bucket, Key=known_key(fileid), Body=body)
+    except Exception as e:
+        raise DBError(str(e))
+
+
+def read_known(fileid, bucket, s3_client):
+    """
+    Read known.
+
+    Gives the resolved rows and record keys of a file, both by number, or
+    empty ones when the cache was not used.
+    """
+    try:
+        body = s3_client.get_object(Bucket=bucket, Key=known_key(fileid))["Body"]
+    except s3_client.exceptions.NoSuchKey:
+        return {}, {}
+    except Exception as e:
+        raise DBError(str(e))
+    known = json.loads(body.read())
+    resolved = {int(row): category for row, category in known["resolved"].items()}
+    keys = {int(number): key for number, key in known["keys"].items()}
+    return resolved, keys
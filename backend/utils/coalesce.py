@@ -0,0 +1,293 @@
+"""
+Batch coalescer.
+
+Merges the prompts of small files, from any user, into shared bedrock batch
+jobs. Every prompt line carries a recordId holding its fileid, so the output
+of a shared job is split back per file when it is read.
+"""
+
+import os
+import time
+import uuid
+import threading
+from backend.types.errors import DBError
+from backend.utils.db.dynamo import (
+    claim_item_db,
+    item_jobs,
+    mark_item_db,
+    scan_processing_db,
+    set_status_db,
+)
+from backend.utils.db.multipart import MultipartWriter, new_multipart_state
+from backend.utils.shard import input_size
+from backend.utils.model.model import get_engine
+
+
+class BatchCoalescer:
+    """
+    Batch coalescer.
+
+    Queues small files and sends them as one job once the queue holds
+    max_bytes of prompts or its oldest file has waited max_wait seconds.
+    """
+
+    def __init__(
+        self,
+        socketio,
+        db_client,
+        s3_client,
+        bedrock_client,
+        bucket,
+        max_bytes,
+        max_wait,
+        watcher=None,
+    ):
+        """
+        Init function.
+
+        Files of max_bytes or more are not worth sharing a job and should be
+        sent on their own, see accepts. Every queued file is claimed in the
+        db under owner, so server processes never queue the same file.
+        """
+        self.socketio = socketio
+        self.db_client = db_client
+        self.s3_client = s3_client
+        self.bedrock_client = bedrock_client
+        self.bucket = bucket
+        self.max_bytes = max_bytes
+        self.max_wait = max_wait
+        self.watcher = watcher
+        self.owner = uuid.uuid4().hex
+        # a live coalescer sends a file within max_wait, older claims are
+        # left by a process that stopped
+        self.claim_ttl = 2 * max_wait + 60
+        self.lock = threading.Lock()
+        self.flushing = threading.Lock()
+        self.pending = []
+        self.bytes = 0
+        self.since = None
+        self.batches = 0
+        self.files = 0
+
+    def size(self, fileid):
+        """
+        Size method.
+
+        Bytes of the prompts of a file.
+        """
+        return input_size(fileid, self.bucket, self.s3_client)
+
+    def accepts(self, size):
+        """
+        Accepts method.
+
+        Whether a file of size bytes should be queued.
+        """
+        return size < self.max_bytes
+
+    def add(self, fileid, username, size=None, mark=True):
+        """
+        Add method.
+
+        Queues a file, marking it processing without a job yet. Files
+        another process claimed, or that were deleted, are left alone.
+        """
+        if mark:
+            mark_item_db(fileid, "none", username, self.db_client, [])
+        if not claim_item_db(
+            fileid,
+            username,
+            self.owner,
+            time.time() - self.claim_ttl,
+            self.db_client,
+        ):
+            return
+        if size is None:
+            size = self.size(fileid)
+        with self.lock:
+            if any(queued[0] == fileid for queued in self.pending):
+                return
+            if not self.pending:
+                self.since = time.monotonic()
+            self.pending.append((fileid, username, size))
+            self.bytes += size
+
+    def due(self, now):
+        """
+        Due method.
+
+        Whether the queue should be sent.
+        """
+        with self.lock:
+            if not self.pending:
+                return False
+            return self.bytes >= self.max_bytes or now - self.since >= self.max_wait
+
+    def take(self):
+        """
+        Take method.
+
+        Takes files off the queue up to max_bytes, at least one.
+        """
+        with self.lock:
+            taken = []
+            size = 0
+            while self.pending:
+                if taken and size + self.pending[0][2] > self.max_bytes:
+                    break
+                queued = self.pending.pop(0)
+                taken.append(queued)
+                size += queued[2]
+            self.bytes -= size
+            self.since = time.monotonic() if self.pending else None
+            return taken
+
+    def merge(self, files, key):
+        """
+        Merge method.
+
+        Copies the prompts of every file into one input, streamed through a
+        multipart upload. Files whose prompts can no longer be read, like
+        files deleted while queued, are dropped and set back to not
+        processed. Gives back the files merged.
+        """
+        merged = []
+        writer = MultipartWriter(
+            new_multipart_state(), self.bucket, key, self.s3_client
+        )
+        try:
+            for queued in files:
+                fileid, username, _ = queued
+                try:
+                    body = self.s3_client.get_object(
+                        Bucket=self.bucket, Key=f"input/{fileid}.jsonl"
+                    )["Body"]
+                except Exception as e:
+                    print(e)
+                    set_status_db(fileid, username, "not processed", self.db_client)
+                    continue
+                last = b"\n"
+                for data in body.iter_chunks(chunk_size=1024 * 1024):
+                    writer.write_bytes(data)
+                    if data:
+                        last = data[-1:]
+                if last != b"\n":
+                    writer.write_bytes(b"\n")
+                merged.append(queued)
+            if merged:
+                writer.close()
+            else:
+                writer.abort()
+        except Exception as e:
+            writer.abort()
+            raise DBError(str(e))
+        return merged
+
+    def release(self, files):
+        """
+        Release method.
+
+        Sets files back to not processed after their job could not be
+        created. Deleted files stay deleted.
+        """
+        for fileid, username, _ in files:
+            set_status_db(fileid, username, "not processed", self.db_client)
+
+    def flush(self):
+        """
+        Flush method.
+
+        Sends queued files as one shared job. Files go back to not processed
+        if the job could not be created. Files deleted while the job was
+        being created are not written back.
+        """
+        with self.flushing:
+            files = self.take()
+            if not files:
+                return None
+            name = f"batch-{uuid.uuid4().hex}.jsonl"
+            try:
+                files = self.merge(files, f"input/{name}")
+                if not files:
+                    return None
+                engine = get_engine(self.s3_client, self.bedrock_client)
+                jobid = engine.submit(name)
+            except Exception as e:
+                print(e)
+                self.release(files)
+                return None
+            jobs = [{"jobid": jobid, "input": name}]
+            for fileid, username, _ in files:
+                if mark_item_db(fileid, jobid, username, self.db_client, jobs) is None:
+                    continue
+                if self.watcher is not None:
+                    self.watcher.track(jobid, fileid, username)
+            with self.lock:
+                self.batches += 1
+                self.files += len(files)
+            return jobid
+
+    def seed(self):
+        """
+        Seed method.
+
+        Queues files that were waiting for a job before the server started,
+        unless another server process already claimed them.
+        """
+        for item in scan_processing_db(self.db_client):
+            if item_jobs(item):
+                continue
+            try:
+                self.add(item["fileid"]["S"], item["username"]["S"], mark=False)
+            except Exception as e:
+                print(e)
+
+    def run(self):
+        """
+        Run method.
+
+        Loop for the socketio background task.
+        """
+        try:
+            self.seed()
+        except Exception as e:
+            print(e)
+        while True:
+            try:
+                while self.due(time.monotonic()):
+                    self.flush()
+            except Exception as e:
+                print(e)
+            self.socketio.sleep(1)
+
+    def metrics(self):
+        """
+        Metrics method.
+
+        Queue size and how many files went through shared jobs.
+        """
+        with self.lock:
+            return {
+                "pending": len(self.pending),
+                "pending_bytes": self.bytes,
+                "batches": self.batches,
+                "files": self.files,
+            }
+
+
+def create_coalescer(socketio, db_client, s3_client, bedrock_client, watcher=None):
+    """
+    Create coalescer.
+
+    Builds a coalescer from the env.
+    """
+    return BatchCoalescer(
+        socketio,
+        db_client,
+        s3_client,
+        bedrock_client,
+        os.environ.get("AWS_S3_UPLOAD_NAME"),
+        int(os.environ.get("BATCH_MAX_BYTES", str(64 * 1024 * 1024))),
+        float(os.environ.get("BATCH_MAX_WAIT", "300")),
+        watcher,
+    )
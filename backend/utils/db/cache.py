@@ -0,0 +1,193 @@
+"""
+Result cache.
+
+Keeps parsed categories of processed files keyed by fileid and jobid. The
+output of a finished job never changes, so repeat opens are served locally.
+An LRU in memory sits in front of an optional directory on disk.
+"""
+
+import os
+import json
+import hashlib
+import threading
+from collections import OrderedDict
+
+result_cache = None
+
+
+def entry_size(results):
+    """
+    Entry size.
+
+    Rough bytes held by a list of results.
+    """
+    return sum(len(result) + 49 for result in results) + 56
+
+
+class ResultCache:
+    """
+    Result cache.
+
+    LRU of results with a byte cap, backed by an optional disk tier.
+    """
+
+    def __init__(self, max_bytes, disk_dir=None, max_disk_bytes=0):
+        """
+        Init function.
+
+        max_bytes caps the memory tier. With a disk_dir, entries are also kept
+        on disk up to max_disk_bytes, oldest written removed first.
+        """
+        self.max_bytes = max_bytes
+        self.disk_dir = disk_dir
+        self.max_disk_bytes = max_disk_bytes
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()
+        self.bytes = 0
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        if disk_dir is not None:
+            os.makedirs(disk_dir, exist_ok=True)
+
+    def path(self, fileid, jobid):
+        """
+        Path method.
+
+        Disk file of an entry, prefixed by fileid so it can be invalidated.
+        """
+        digest = hashlib.sha1(jobid.encode("utf-8")).hexdigest()
+        return os.path.join(self.disk_dir, f"{fileid}.{digest}.json")
+
+    def get(self, fileid, jobid):
+        """
+        Get method.
+
+        Gives back cached results, or None.
+        """
+        with self.lock:
+            results = self.entries.get((fileid, jobid))
+            if results is not None:
+                self.entries.move_to_end((fileid, jobid))
+                self.hits += 1
+                return results
+        if self.disk_dir is not None:
+            try:
+                with open(self.path(fileid, jobid)) as f:
+                    results = json.load(f)
+            except (OSError, ValueError):
+                results = None
+            if results is not None:
+                self.remember(fileid, jobid, results)
+                with self.lock:
+                    self.disk_hits += 1
+                return results
+        with self.lock:
+            self.misses += 1
+        return None
+
+    def put(self, fileid, jobid, results):
+        """
+        Put method.
+
+        Caches the results of a finished job in every tier.
+        """
+        self.remember(fileid, jobid, results)
+        if self.disk_dir is None:
+            return
+        path = self.path(fileid, jobid)
+        with open(f"{path}.tmp", "w") as f:
+            json.dump(results, f)
+        os.replace(f"{path}.tmp", path)
+        self.trim_disk()
+
+    def remember(self, fileid, jobid, results):
+        """
+        Remember method.
+
+        Adds results to the memory tier, evicting the least recently used.
+        """
+        size = entry_size(results)
+        if size > self.max_bytes:
+            return
+        with self.lock:
+            old = self.entries.pop((fileid, jobid), None)
+            if old is not None:
+                self.bytes -= entry_size(old)
+            self.entries[(fileid, jobid)] = results
+            self.bytes += size
+            while self.bytes > self.max_bytes:
+                _, evicted = self.entries.popitem(last=False)
+                self.bytes -= entry_size(evicted)
+
+    def trim_disk(self):
+        """
+        Trim disk.
+
+        Removes the oldest disk entries once the disk tier is over its cap.
+        """
+        if not self.max_disk_bytes:
+            return
+        files = []
+        for name in os.listdir(self.disk_dir):
+            if name.endswith(".json"):
+                stat = os.stat(os.path.join(self.disk_dir, name))
+                files.append((stat.st_mtime, stat.st_size, name))
+        total = sum(size for _, size, _ in files)
+        for _, size, name in sorted(files):
+            if total <= self.max_disk_bytes:
+                break
+            try:
+                os.remove(os.path.join(self.disk_dir, name))
+            except FileNotFoundError:
+                pass
+            total -= size
+
+    def invalidate(self, fileid):
+        """
+        Invalidate method.
+
+        Drops every cached job of a file.
+        """
+        with self.lock:
+            for key in [key for key in self.entries if key[0] == fileid]:
+                self.bytes -= entry_size(self.entries.pop(key))
+        if self.disk_dir is None:
+            return
+        for name in os.listdir(self.disk_dir):
+            if name.startswith(f"{fileid}."):
+                try:
+                    os.remove(os.path.join(self.disk_dir, name))
+                except FileNotFoundError:
+                    pass
+
+    def metrics(self):
+        """
+        Metrics method.
+
+        Gives a snapshot of entries, bytes and hit counts.
+        """
+        with self.lock:
+            return {
+                "entries": len(self.entries),
+                "bytes": self.bytes,
+                "hits": self.hits,
+                "disk_hits": self.disk_hits,
+                "misses": self.misses,
+            }
+
+
+def get_result_cache():
+    """
+    Get result cache.
+
+    Creates the result cache on first use, once the env has been loaded.
+    """
+    global result_cache
+    if result_cache is None:
+        result_cache = ResultCache(
+            int(os.environ.get("RESULT_CACHE_BYTES", str(128 * 1024 * 1024))),
+            os.environ.get("RESULT_CACHE_DIR") or None,
+            int(os.environ.get("RESULT_CACHE_DISK_BYTES", "0")),
+        )
+    return result_cache
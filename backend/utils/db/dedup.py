@@ -0,0 +1,127 @@
+"""
+Prompt dedup.
+
+Ledgers repeat the same rows many times over. Only the first of every prompt
+is sent to bedrock, under the recordId of its unique number, and an index
+kept next to the input maps every row back to its unique prompt.
+"""
+
+import hashlib
+from array import array
+import numpy as np
+from backend.types.errors import DBError
+
+# index value of rows that were resolved without a prompt
+NOT_SENT = 0xFFFFFFFF
+
+
+def normalize_prompt(text):
+    """
+    Normalize prompt.
+
+    Prompts that only differ in case or spacing get the same answer.
+    """
+    return " ".join(text.split()).casefold()
+
+
+def prompt_key(text):
+    """
+    Prompt key.
+
+    Short hash of a normalized prompt.
+    """
+    return hashlib.blake2b(
+        normalize_prompt(text).encode("utf-8"), digest_size=16
+    ).digest()
+
+
+def new_dedup_state(seen=None, index=None):
+    """
+    New dedup state.
+
+    Hashes seen so far with their unique number, and the unique number of
+    every row. seen and index can be a mapping and an array kept elsewhere.
+    """
+    return {
+        "seen": {} if seen is None else seen,
+        "index": array("I") if index is None else index,
+    }
+
+
+def dedup_texts(state, texts):
+    """
+    Dedup texts.
+
+    Records the rows of texts in the index and gives back (unique, position)
+    pairs for the prompts not seen before. Texts that are None are not sent
+    and get NOT_SENT in the index.
+    """
+    seen = state["seen"]
+    index = state["index"]
+    res = []
+    for i, text in enumerate(texts):
+        if text is None:
+            index.append(NOT_SENT)
+            continue
+        key = prompt_key(text)
+        unique = seen.get(key)
+        if unique is None:
+            unique = len(seen)
+            seen[key] = unique
+            res.append((unique, i))
+        index.append(unique)
+    return res
+
+
+def index_key(fileid):
+    """
+    Index key.
+
+    Where the index of a file sits, next to its input.
+    """
+    return f"input/{fileid}.index"
+
+
+def upload_index(state, fileid, bucket, s3_client):
+    """
+    Upload index.
+
+    Stores the index as little endian uint32s, one per row.
+    """
+    index = np.frombuffer(state["index"].tobytes(), dtype=np.uintc)
+    body = index.astype("<u4").tobytes()
+    try:
+        s3_client.put_object(Bucket=bucket, Key=index_key(fileid), Body=body)
+    except Exception as e:
+        raise DBError(str(e))
+
+
+def read_index(fileid, bucket, s3_client):
+    """
+    Read index.
+
+    Gives back the index of a file, or None when its prompts were not
+    deduplicated.
+    """
+    try:
+        body = s3_client.get_object(Bucket=bucket, Key=index_key(fileid))["Body"]
+    except s3_client.exceptions.NoSuchKey:
+        return None
+    except Exception as e:
+        raise DBError(str(e))
+    return np.frombuffer(body.read(), dtype="<u4")
+
+
+def expand(uniques, index, known=None):
+    """
+    Expand.
+
+    Gives the result of every row from the results of the unique prompts.
+    known holds results of rows that were never sent.
+    """
+    known = known or {}
+    for row, unique in enumerate(index.tolist()):
+        if unique < len(uniques):
+            yield uniques[unique]
+        else:
+            yield known.get(row, "")
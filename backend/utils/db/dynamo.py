@@ -5,8 +5,9 @@ This module contains the functions that are used to interact with the dynamodb d
 """
 
 import os
+import time
 from backend.types.errors import DBError, FileIDError, UsernameError
-from backend.utils.batch import get_batch_job
+from backend.utils.batch import get_job_tracker, files_state
 
 
 def get_item_db(fileid, username, db_client):
@@ -32,11 +33,35 @@ def get_item_db(fileid, username, db_client):
             "filename": item["filename"]["S"],
             "processed": item["processed"]["S"],
             "jobid": item["jobid"]["S"],
+            "jobs": item_jobs(item),
+            "tokens": (
+                {name: int(count["N"]) for name, count in item["tokens"]["M"].items()}
+                if "tokens" in item
+                else None
+            ),
         }
     else:
         raise FileIDError(fileid)
 
 
+def item_jobs(item):
+    """
+    Item jobs.
+
+    Gives the batch jobs holding a file's records, each with the name of the
+    input it was sent with. Items from before the jobs list have one job.
+    """
+    if "jobs" in item:
+        return [
+            {"jobid": job["M"]["jobid"]["S"], "input": job["M"]["input"]["S"]}
+            for job in item["jobs"]["L"]
+        ]
+    jobid = item["jobid"]["S"]
+    if jobid == "none":
+        return []
+    return [{"jobid": jobid, "input": f"{item['fileid']['S']}.jsonl"}]
+
+
 def get_item_user(fileid, username, db_client):
     """
     Verify that a file exists in the db.
@@ -91,58 +116,255 @@ def delete_item_db(fileid, username, db_client):
         raise DBError(str(e))
 
 
-def mark_item_db(fileid, jobid, username, db_client):
+def condition_failed(e):
+    """
+    Condition failed.
+
+    Whether an error is a conditional write that did not match.
+    """
+    code = getattr(e, "response", {}).get("Error", {}).get("Code")
+    return code == "ConditionalCheckFailedException"
+
+
+def mark_item_db(fileid, jobid, username, db_client, jobs=None):
     """
     Mark Item function.
 
-    Marks a file as processed in dynamo.
+    Marks a file as processed in dynamo. jobs lists every job holding the
+    file's records, by default just jobid run on the file's own input. Any
+    coalescer claim is dropped. Gives None when the file has been deleted,
+    which is never written back.
     """
     key = {"fileid": {"S": fileid}, "username": {"S": username}}
+    if jobs is None:
+        jobs = [{"jobid": jobid, "input": f"{fileid}.jsonl"}]
 
     try:
         response = db_client.update_item(
             TableName=os.environ.get("AWS_FILE_TABLE_NAME"),
             Key=key,
-            ExpressionAttributeNames={"#processed": "processed"},
-            UpdateExpression="SET #processed = :processed, jobid = :jobid",
+            ExpressionAttributeNames={
+                "#processed": "processed",
+                "#claim": "claim",
+                "#claimed": "claimed",
+            },
+            UpdateExpression="SET #processed = :processed, jobid = :jobid, "
+            "jobs = :jobs REMOVE #claim, #claimed",
+            ConditionExpression="attribute_exists(fileid)",
             ExpressionAttributeValues={
                 ":processed": {"S": "processing"},
                 ":jobid": {"S": jobid},
+                ":jobs": {
+                    "L": [
+                        {
+                            "M": {
+                                "jobid": {"S": job["jobid"]},
+                                "input": {"S": job["input"]},
+                            }
+                        }
+                        for job in jobs
+                    ]
+                },
             },
             ReturnValues="ALL_NEW",
         )
         return response
     except Exception as e:
+        if condition_failed(e):
+            return None
         raise DBError(str(e))
 
 
-def update_all_items(username, db_client, bedrock_client):
+def query_items_user(username, db_client):
+    """
+    Query items user.
+
+    Yields every file item of a user, a page at a time. With
+    AWS_FILE_TABLE_USER_INDEX naming the username index of the table it is
+    queried, so the cost follows this user's files rather than the whole
+    table. Tables without the index are scanned.
+    """
+    index = os.environ.get("AWS_FILE_TABLE_USER_INDEX", "")
+    request = {
+        "TableName": os.environ.get("AWS_FILE_TABLE_NAME"),
+        "ExpressionAttributeNames": {"#sk": "username"},
+        "ExpressionAttributeValues": {":sk_value": {"S": username}},
+    }
+    if index:
+        request["IndexName"] = index
+        request["KeyConditionExpression"] = "#sk = :sk_value"
+        call = db_client.query
+    else:
+        request["FilterExpression"] = "#sk = :sk_value"
+        call = db_client.scan
+    while True:
+        try:
+            response = call(**request)
+        except Exception as e:
+            raise DBError(str(e))
+        yield from response.get("Items", [])
+        if "LastEvaluatedKey" not in response:
+            return
+        request["ExclusiveStartKey"] = response["LastEvaluatedKey"]
+
+
+def update_all_items(username, db_client, bedrock_client, on_processed=None):
     """
     Update all items.
 
     Updates all items in the db with the latest status of the batch job
+    and gives them back. on_processed is called with the fileid and username
+    of every file this call marks processed.
     """
-    response = db_client.scan(
-        TableName=os.environ.get("AWS_FILE_TABLE_NAME"),
-        FilterExpression="#sk = :sk_value",
-        ExpressionAttributeNames={"#sk": "username"},
-        ExpressionAttributeValues={":sk_value": {"S": username}},
-    )
-    items = response.get("Items")
+    items = list(query_items_user(username, db_client))
+    jobids = [job["jobid"] for item in items for job in item_jobs(item)]
+    statuses = get_job_tracker().statuses(jobids, bedrock_client)
     for item in items:
         fileid = item.get("fileid").get("S")
-        jobid = item.get("jobid").get("S")
         status = "not processed"
-        if jobid != "none":
-            status = (
-                "processed"
-                if get_batch_job(jobid, bedrock_client) == "Completed"
-                else "processing"
-            )
+        jobs = item_jobs(item)
+        if jobs:
+            status = files_state([statuses[job["jobid"]] for job in jobs])
+        elif item.get("processed", {}).get("S") in ("processing", "processed"):
+            # waiting to be coalesced, or resolved without a job
+            continue
+        # only write when the status actually moved
+        if item.get("processed", {}).get("S") == status:
+            continue
+        item["processed"] = {"S": status}
+        if status != "processed":
+            set_status_db(fileid, username, status, db_client)
+        elif finish_item_db(fileid, username, db_client) and on_processed:
+            try:
+                on_processed(fileid, username)
+            except Exception as e:
+                print(e)
+    return items
+
+
+def set_status_db(fileid, username, status, db_client):
+    """
+    Set status db.
+
+    Writes the processed status of a file. Gives False when the file has
+    been deleted, which is never written back.
+    """
+    try:
         db_client.update_item(
             TableName=os.environ.get("AWS_FILE_TABLE_NAME"),
             Key={"fileid": {"S": fileid}, "username": {"S": username}},
             UpdateExpression="SET #processed = :processed",
+            ConditionExpression="attribute_exists(fileid)",
             ExpressionAttributeNames={"#processed": "processed"},
             ExpressionAttributeValues={":processed": {"S": status}},
         )
+    except Exception as e:
+        if condition_failed(e):
+            return False
+        raise DBError(str(e))
+    return True
+
+
+def set_tokens_db(fileid, username, tokens, db_client):
+    """
+    Set tokens db.
+
+    Writes the estimated prompt tokens of a file, those the full template
+    would have used and those sent. Gives False when the file has been
+    deleted.
+    """
+    try:
+        db_client.update_item(
+            TableName=os.environ.get("AWS_FILE_TABLE_NAME"),
+            Key={"fileid": {"S": fileid}, "username": {"S": username}},
+            UpdateExpression="SET #tokens = :tokens",
+            ConditionExpression="attribute_exists(fileid)",
+            ExpressionAttributeNames={"#tokens": "tokens"},
+            ExpressionAttributeValues={
+                ":tokens": {
+                    "M": {name: {"N": str(count)} for name, count in tokens.items()}
+                }
+            },
+        )
+    except Exception as e:
+        if condition_failed(e):
+            return False
+        raise DBError(str(e))
+    return True
+
+
+def finish_item_db(fileid, username, db_client):
+    """
+    Finish item db.
+
+    Marks a file processed. Gives True only to the call that moved it
+    there, so what is done once per file, like learning its answers, runs
+    once however many jobs or server processes see it finish.
+    """
+    try:
+        db_client.update_item(
+            TableName=os.environ.get("AWS_FILE_TABLE_NAME"),
+            Key={"fileid": {"S": fileid}, "username": {"S": username}},
+            UpdateExpression="SET #processed = :processed",
+            ConditionExpression="attribute_exists(fileid) AND "
+            "#processed <> :processed",
+            ExpressionAttributeNames={"#processed": "processed"},
+            ExpressionAttributeValues={":processed": {"S": "processed"}},
+        )
+    except Exception as e:
+        if condition_failed(e):
+            return False
+        raise DBError(str(e))
+    return True
+
+
+def claim_item_db(fileid, username, owner, stale, db_client):
+    """
+    Claim item db.
+
+    Claims a file waiting for a job for the coalescer called owner, so no
+    other server process queues it too. Claims made before the stale unix
+    time are taken over. Gives whether the claim was made.
+    """
+    try:
+        db_client.update_item(
+            TableName=os.environ.get("AWS_FILE_TABLE_NAME"),
+            Key={"fileid": {"S": fileid}, "username": {"S": username}},
+            UpdateExpression="SET #claim = :owner, #claimed = :now",
+            ConditionExpression="attribute_exists(fileid) AND "
+            "(attribute_not_exists(#claim) OR #claim = :owner OR #claimed < :stale)",
+            ExpressionAttributeNames={"#claim": "claim", "#claimed": "claimed"},
+            ExpressionAttributeValues={
+                ":owner": {"S": owner},
+                ":now": {"N": str(time.time())},
+                ":stale": {"N": str(stale)},
+            },
+        )
+    except Exception as e:
+        if condition_failed(e):
+            return False
+        raise DBError(str(e))
+    return True
+
+
+def scan_processing_db(db_client):
+    """
+    Scan processing db.
+
+    Yields every file with a job still processing, across all users.
+    """
+    request = {
+        "TableName": os.environ.get("AWS_FILE_TABLE_NAME"),
+        "FilterExpression": "#processed = :processed",
+        "ExpressionAttributeNames": {"#processed": "processed"},
+        "ExpressionAttributeValues": {":processed": {"S": "processing"}},
+    }
+    while True:
+        try:
+            response = db_client.scan(**request)
+        except Exception as e:
+            raise DBError(str(e))
+        yield from response.get("Items", [])
+        if "LastEvaluatedKey" not in response:
+            return
+        request["ExclusiveStartKey"] = response["LastEvaluatedKey"]
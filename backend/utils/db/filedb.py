@@ -12,7 +12,7 @@ import json
 import time
 import random
 from backend.types.errors import DBError, FileIDError, UsernameError, JSONError
-from backend.utils.batch import create_batch_job
+from backend.utils.batch import output_key
 from backend.utils.db.userdb import get_user
 from backend.utils.db.dynamo import (
     get_item_db,
@@ -20,52 +20,217 @@ from backend.utils.db.dynamo import (
     create_item_db,
     mark_item_db,
     delete_item_db,
+    finish_item_db,
+    query_items_user,
+    set_status_db,
+    set_tokens_db,
     update_all_items,
 )
+from backend.utils.db.cache import get_result_cache
+from backend.utils.categories import get_category_cache, known_key, read_known
+from backend.utils.model.classifier import get_classifier
+from backend.utils.model.model import get_engine
+from backend.utils.db.dedup import expand, index_key, read_index
+from backend.utils.db.prompts import packed_rows, split_answer
+from backend.utils.shard import (
+    get_shard_config,
+    input_rows,
+    input_size,
+    shard_count,
+    delete_shards,
+    shard_jobs,
+)
 from backend.utils.db.uploader import (
+    cancel_upload,
     elegible_chunks,
     convert_line,
     convert_to_prompts,
     upload_chunk,
+    parse_record_id,
 )
 
 
+def iter_output_from_jsonl(lines):
+    """
+    Iter output from jsonl.
+
+    Yields the model output of each line of the batch jsonl as it is read
+    """
+    for line in lines:
+        if isinstance(line, bytes):
+            line = line.decode("utf-8")
+        if line.strip() != "":
+            json_line = json.loads(line)
+            yield json_line["modelOutput"]["content"][0]["text"]
+
+
+def iter_records_from_jsonl(lines):
+    """
+    Iter records from jsonl.
+
+    Yields the recordId, offset and model output of each row of the batch
+    jsonl. Records of several rows give one result per row, at the offset
+    of the row in the record. Records bedrock could not run give an empty
+    output.
+    """
+    for line in lines:
+        if isinstance(line, bytes):
+            line = line.decode("utf-8")
+        if line.strip() != "":
+            json_line = json.loads(line)
+            output = json_line.get("modelOutput")
+            text = output["content"][0]["text"] if output else ""
+            rows = packed_rows(json_line.get("modelInput"))
+            if rows is None:
+                yield json_line.get("recordId"), 0, text
+                continue
+            answers = dict(split_answer(text) or [])
+            for offset in range(len(rows)):
+                yield json_line.get("recordId"), offset, answers.get(offset, "")
+
+
+def in_row_order(rows, known=None):
+    """
+    In row order.
+
+    Puts (row, result) pairs back in row order, holding back the ones that
+    arrive early. known holds results of rows that were never sent. Rows
+    that never arrive are given as empty.
+    """
+    held = dict(known or {})
+    following = 0
+    for row, result in rows:
+        held[row] = result
+        while following in held:
+            yield held.pop(following)
+            following += 1
+    if held:
+        for row in range(following, max(held) + 1):
+            yield held.pop(row, "")
+
+
+def file_records(fileid, jobs, bucket, s3_client):
+    """
+    File records.
+
+    Yields the (row, result) pairs of a file from the outputs of its jobs.
+    Shared inputs hold other files too, whose records are skipped. Outputs
+    without recordIds of the file are numbered in the order they are read.
+    """
+    for job in jobs:
+        obj = s3_client.get_object(
+            Bucket=bucket, Key=output_key(job["jobid"], job["input"])
+        )
+        shared = job["input"] != f"{fileid}.jsonl"
+        sequence = 0
+        lines = obj["Body"].iter_lines(chunk_size=64 * 1024)
+        for record, offset, text in iter_records_from_jsonl(lines):
+            row = parse_record_id(record, fileid)
+            if row is None:
+                if shared:
+                    continue
+                row = sequence
+            sequence += 1
+            yield row + offset, text
+
+
 def get_output_from_jsonl(body):
     """
     Get output from jsonl.
 
     Gets the model output from the batch jsonl file
     """
-    res = []
-    for line in body.split("\n"):
-        if line != "":
-            json_line = json.loads(line)
-            res.append(json_line["modelOutput"]["content"][0]["text"])
-    return res
+    return list(iter_output_from_jsonl(body.split("\n")))
+
+
+def collect(results, into):
+    """
+    Collect.
+
+    Passes results through while keeping a copy of them.
+    """
+    for result in results:
+        into.append(result)
+        yield result
 
 
-def delete_item_s3(fileid, bucket, s3_client):
+def emit_batches(results, fileid, socketio, batch_size=None):
+    """
+    Emit batches.
+
+    Sends results as numbered download messages of batch_size rows, the last
+    one marked finished, so the client can start before everything is read.
+    """
+    if batch_size is None:
+        batch_size = int(os.environ.get("DOWNLOAD_BATCH_SIZE", "1000"))
+    sequence = 0
+    batch = []
+    for result in results:
+        batch.append(result)
+        if len(batch) == batch_size:
+            socketio.emit(
+                "download",
+                {
+                    "fileid": fileid,
+                    "sequence": sequence,
+                    "finished": False,
+                    "data": batch,
+                },
+            )
+            sequence += 1
+            batch = []
+    socketio.emit(
+        "download",
+        {"fileid": fileid, "sequence": sequence, "finished": True, "data": batch},
+    )
+
+
+def delete_item_s3(fileid, bucket, s3_client, jobs=()):
     """
     Delete item s3 function.
 
-    Deletes an item from s3 given bucket and filename
+    Deletes an item from s3 given bucket and filename, with its shards and
+    the outputs of the jobs run on its own inputs. Shared batch inputs and
+    outputs hold other files too and are left to the bucket lifecycle.
     """
     try:
         s3_client.delete_object(Bucket=bucket, Key=f"input/{fileid}.jsonl")
+        s3_client.delete_object(Bucket=bucket, Key=index_key(fileid))
+        s3_client.delete_object(Bucket=bucket, Key=known_key(fileid))
         s3_client.delete_object(Bucket=bucket, Key=f"output/{fileid}.jsonl.out")
+        for job in jobs:
+            if job["input"].startswith(fileid):
+                s3_client.delete_object(
+                    Bucket=bucket, Key=output_key(job["jobid"], job["input"])
+                )
     except Exception as e:
         if not isinstance(e, s3_client.meta.client.exceptions.NoSuchKey):
             raise DBError(str(e))
+    delete_shards(fileid, bucket, s3_client)
 
 
 def file_ingester(
-    username, fileid, filename, chunk, chunk_number, total_chunks, db_client, s3_client
+    username,
+    fileid,
+    filename,
+    chunk,
+    chunk_number,
+    total_chunks,
+    db_client,
+    s3_client,
+    chunk_size=None,
+    progress=None,
 ):
     """
     File db handler.
 
-    Entrance for uploading a file
+    Entrance for uploading a file. The estimated prompt tokens of the file
+    are written to its item once the upload finishes.
     """
+
+    def tokens(counts):
+        set_tokens_db(fileid, username, counts, db_client)
+
     try:
         get_item_user(fileid, username, db_client)
     except Exception as e:
@@ -80,26 +245,40 @@ def file_ingester(
         total_chunks,
         os.environ.get("AWS_S3_UPLOAD_NAME"),
         s3_client,
+        chunk_size,
+        progress,
+        get_category_cache(db_client),
+        get_classifier(),
+        tokens,
     )
     return res
 
 
-def list_ingester(username, db_client, bedrock_client):
+def list_ingester(username, db_client, bedrock_client=None, s3_client=None):
     """
     List ingester.
 
-    Get all fileids for a user using sort key.
+    Get all fileids for a user using the username index. With a
+    bedrock_client the statuses are brought up to date through the job
+    tracker, whichever server process is watching the jobs, learning the
+    answers of the files that finished when s3_client is given.
     """
+
+    def learn(fileid, username):
+        learn_ingester(username, fileid, db_client, s3_client)
+
     try:
-        update_all_items(username, db_client, bedrock_client)
-        response = db_client.scan(
-            TableName=os.environ.get("AWS_FILE_TABLE_NAME"),
-            FilterExpression="#sk = :sk_value",
-            ExpressionAttributeNames={"#sk": "username"},
-            ExpressionAttributeValues={":sk_value": {"S": username}},
-        )
         res = {}
-        for i in response["Items"]:
+        if bedrock_client is None:
+            items = query_items_user(username, db_client)
+        else:
+            items = update_all_items(
+                username,
+                db_client,
+                bedrock_client,
+                learn if s3_client is not None else None,
+            )
+        for i in items:
             res[i["fileid"]["S"]] = {
                 "filename": i["filename"]["S"],
                 "processed": i["processed"]["S"],
@@ -109,19 +288,58 @@ def list_ingester(username, db_client, bedrock_client):
         raise DBError(str(e))
 
 
-def process_ingester(username, fileid, db_client, s3_client, bedrock_client):
+def process_ingester(
+    username,
+    fileid,
+    db_client,
+    s3_client,
+    bedrock_client,
+    coalescer=None,
+    ondemand=None,
+):
     """
     Process ingester.
 
-    Runs model on a file sitting in the db, and writes output back
+    Runs model on a file sitting in the db, and writes output back. Large
+    files are split over parallel jobs, small ones are queued on the
+    coalescer to share a job, and files of a few rows are run on demand
+    before this returns. Gives back the jobs started for the file.
     """
     get_item_user(fileid, username, db_client)
-    jobid = create_batch_job(
-        f"s3://{os.environ.get('AWS_S3_UPLOAD_NAME')}/input/{fileid}.jsonl",
-        f"s3://{os.environ.get('AWS_S3_UPLOAD_NAME')}/output/",
-        bedrock_client,
-    )
+    bucket = os.environ.get("AWS_S3_UPLOAD_NAME")
+    engine = get_engine(s3_client, bedrock_client)
+    shard_bytes, max_shards, max_rows = get_shard_config()
+    size = input_size(fileid, bucket, s3_client)
+    if size == 0:
+        # every row was resolved by the category cache
+        mark_item_db(fileid, "none", username, db_client, [])
+        set_status_db(fileid, username, "processed", db_client)
+        return []
+    if ondemand is not None and ondemand.accepts(
+        input_rows(fileid, bucket, s3_client, ondemand.max_rows)
+    ):
+        # the output is written by the time submit returns
+        jobid = ondemand.submit(f"{fileid}.jsonl")
+        mark_item_db(fileid, jobid, username, db_client)
+        if finish_item_db(fileid, username, db_client):
+            try:
+                learn_ingester(username, fileid, db_client, s3_client)
+            except DBError as e:
+                print(e)
+        return [jobid]
+    if shard_bytes and size > shard_bytes:
+        count = shard_count(size, shard_bytes, max_shards)
+        jobs = shard_jobs(
+            fileid, bucket, s3_client, engine, count, size, max_rows, max_shards
+        )
+        mark_item_db(fileid, jobs[0]["jobid"], username, db_client, jobs)
+        return [job["jobid"] for job in jobs]
+    if coalescer is not None and coalescer.accepts(size):
+        coalescer.add(fileid, username, size)
+        return []
+    jobid = engine.submit(f"{fileid}.jsonl")
     mark_item_db(fileid, jobid, username, db_client)
+    return [jobid]
 
 
 def get_ingester(username, fileid, socketio, db_client, s3_client):
@@ -134,13 +352,47 @@ def get_ingester(username, fileid, socketio, db_client, s3_client):
 
     try:
         db_item = get_item_db(fileid, username, db_client)
-        jobid = db_item.get("jobid").split("/")[-1]
-        obj = s3_client.get_object(
-            Bucket=os.environ.get("AWS_S3_UPLOAD_NAME"),
-            Key=f"output/{jobid}/{fileid}.jsonl.out",
-        )
-        body = obj["Body"].read().decode("utf-8")
-        socketio.emit("download", {"data": get_output_from_jsonl(body)})
+        jobs = db_item.get("jobs")
+        jobid = ",".join(job["jobid"].split("/")[-1] for job in jobs)
+        cache = get_result_cache()
+        results = cache.get(fileid, jobid)
+        if results is not None:
+            emit_batches(results, fileid, socketio)
+            return
+        bucket = os.environ.get("AWS_S3_UPLOAD_NAME")
+        resolved, _ = read_known(fileid, bucket, s3_client)
+        records = file_records(fileid, jobs, bucket, s3_client)
+        index = read_index(fileid, bucket, s3_client)
+        if index is None:
+            rows = in_row_order(records, resolved)
+        else:
+            # deduplicated prompts, every unique result is needed before
+            # the rows can be put back
+            rows = expand(list(in_row_order(records)), index, resolved)
+        results = []
+        emit_batches(collect(rows, results), fileid, socketio)
+        cache.put(fileid, jobid, results)
+    except Exception as e:
+        raise DBError(str(e))
+
+
+def learn_ingester(username, fileid, db_client, s3_client):
+    """
+    Learn ingester.
+
+    Adds the answers of a processed file to the category cache.
+    """
+    categories = get_category_cache(db_client)
+    if categories is None:
+        return
+    try:
+        db_item = get_item_db(fileid, username, db_client)
+        bucket = os.environ.get("AWS_S3_UPLOAD_NAME")
+        _, keys = read_known(fileid, bucket, s3_client)
+        if not keys:
+            return
+        records = file_records(fileid, db_item.get("jobs"), bucket, s3_client)
+        categories.learn((keys.get(number), text) for number, text in records)
     except Exception as e:
         raise DBError(str(e))
 
@@ -151,9 +403,13 @@ def delete_ingester(username, fileid, db_client, s3_client):
 
     Delete a file if the user has access
     """
-    get_item_user(fileid, username, db_client)
+    item = get_item_user(fileid, username, db_client)
+    get_result_cache().invalidate(fileid)
+    cancel_upload(fileid, s3_client)
     delete_item_db(fileid, username, db_client)
-    delete_item_s3(fileid, os.environ.get("AWS_S3_UPLOAD_NAME"), s3_client)
+    delete_item_s3(
+        fileid, os.environ.get("AWS_S3_UPLOAD_NAME"), s3_client, item["jobs"]
+    )
 
 
 def delete_user_ingester(username, db_client, s3_client):
@@ -162,8 +418,5 @@ def delete_user_ingester(username, db_client, s3_client):
 
     Mass delete all files for a user
     """
-    list = list_ingester(username, db_client)
-    if len(list) == 0:
-        return
-    for id, info in list[username].items():
+    for id in list_ingester(username, db_client):
         delete_ingester(username, id, db_client, s3_client)
@@ -0,0 +1,259 @@
+"""
+Multipart.
+
+Streams generated lines to s3 with a multipart upload so the whole file never
+has to sit in memory or on disk. Parts are uploaded concurrently while the
+caller keeps producing lines.
+"""
+
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from backend.types.errors import DBError
+
+# s3 rejects parts under 5MiB except for the last one
+MIN_PART_SIZE = 5 * 1024 * 1024
+PART_SIZE = 8 * 1024 * 1024
+# parts queued per upload before write waits, bounds the memory held in parts
+MAX_IN_FLIGHT = 4
+
+part_pool = None
+# parts still uploading by upload id, so they outlive the writer of one chunk
+in_flight = {}
+in_flight_lock = threading.Lock()
+
+
+def get_part_pool():
+    """
+    Get part pool.
+
+    Thread pool shared by every multipart upload of the process.
+    """
+    global part_pool
+    if part_pool is None:
+        part_pool = ThreadPoolExecutor(
+            max_workers=int(os.environ.get("MULTIPART_WORKERS", "4"))
+        )
+    return part_pool
+
+
+def parts_in_flight(upload_id):
+    """
+    Parts in flight.
+
+    The futures of the parts of an upload still uploading in this process,
+    with the bytes of each.
+    """
+    with in_flight_lock:
+        return in_flight.setdefault(upload_id, {})
+
+
+def cancel_parts(upload_id):
+    """
+    Cancel parts.
+
+    Forgets the parts of an upload that is aborted or complete, cancelling
+    the ones not started.
+    """
+    with in_flight_lock:
+        futures = in_flight.pop(upload_id, {})
+    for future in futures:
+        future.cancel()
+
+
+def new_multipart_state():
+    """
+    New multipart state.
+
+    State of a multipart upload, kept in the upload session between chunks.
+    """
+    return {"upload_id": None, "parts": [], "pending": b"", "uploaded": 0}
+
+
+def upload_part(bucket, key, upload_id, part_number, body, s3_client):
+    """
+    Upload part.
+
+    Uploads one part and gives back the entry complete_multipart_upload needs.
+    """
+    response = s3_client.upload_part(
+        Bucket=bucket,
+        Key=key,
+        UploadId=upload_id,
+        PartNumber=part_number,
+        Body=body,
+    )
+    return {"PartNumber": part_number, "ETag": response["ETag"]}
+
+
+class MultipartWriter:
+    """
+    Multipart writer.
+
+    Buffers written lines and hands every full part to the part pool. The
+    state dict is all that is needed to carry on in a later call of the same
+    process, parts still uploading are picked up again by upload id.
+    """
+
+    def __init__(
+        self, state, bucket, key, s3_client, part_size=PART_SIZE, progress=None
+    ):
+        """
+        Init function.
+
+        progress is called with the part number and uploaded bytes of every
+        part once it has landed.
+        """
+        self.state = state
+        self.bucket = bucket
+        self.key = key
+        self.s3_client = s3_client
+        self.part_size = max(part_size, MIN_PART_SIZE)
+        self.progress = progress
+        self.futures = {}
+        if state["upload_id"] is not None:
+            self.futures = parts_in_flight(state["upload_id"])
+
+    def write(self, lines):
+        """
+        Write method.
+
+        Adds lines and starts uploading any part that is full.
+        """
+        self.write_bytes("".join(lines).encode("utf-8"))
+
+    def write_bytes(self, data):
+        """
+        Write bytes method.
+
+        Adds raw bytes and starts uploading any part that is full.
+        """
+        if not data:
+            return
+        self.state["pending"] += data
+        while len(self.state["pending"]) >= self.part_size:
+            body = self.state["pending"][: self.part_size]
+            self.state["pending"] = self.state["pending"][self.part_size :]
+            self.submit(body)
+
+    def submit(self, body):
+        """
+        Submit method.
+
+        Starts the multipart upload if needed and queues one part.
+        """
+        if self.state["upload_id"] is None:
+            self.state["upload_id"] = self.s3_client.create_multipart_upload(
+                Bucket=self.bucket, Key=self.key
+            )["UploadId"]
+            self.futures = parts_in_flight(self.state["upload_id"])
+        while len(self.futures) >= MAX_IN_FLIGHT:
+            self.collect(next(as_completed(self.futures)))
+        part_number = len(self.state["parts"]) + len(self.futures) + 1
+        future = get_part_pool().submit(
+            upload_part,
+            self.bucket,
+            self.key,
+            self.state["upload_id"],
+            part_number,
+            body,
+            self.s3_client,
+        )
+        self.futures[future] = len(body)
+
+    def wait(self):
+        """
+        Wait method.
+
+        Waits for the queued parts and records them in the state.
+        """
+        for future in as_completed(list(self.futures)):
+            self.collect(future)
+        self.state["parts"].sort(key=lambda part: part["PartNumber"])
+
+    def collect_done(self):
+        """
+        Collect done method.
+
+        Records the parts that have finished without waiting for the rest.
+        """
+        for future in [future for future in self.futures if future.done()]:
+            self.collect(future)
+
+    def collect(self, future):
+        """
+        Collect method.
+
+        Records a finished part and reports progress.
+        """
+        part = future.result()
+        self.state["parts"].append(part)
+        self.state["uploaded"] += self.futures.pop(future)
+        if self.progress is not None:
+            self.progress(part["PartNumber"], self.state["uploaded"])
+
+    def close(self):
+        """
+        Close method.
+
+        Uploads what is left and completes the upload. Falls back to a single
+        put when everything fit in one part.
+        """
+        if self.state["upload_id"] is None:
+            self.s3_client.put_object(
+                Bucket=self.bucket, Key=self.key, Body=self.state["pending"]
+            )
+            self.state["uploaded"] += len(self.state["pending"])
+            self.state["pending"] = b""
+            return
+        if self.state["pending"]:
+            self.submit(self.state["pending"])
+            self.state["pending"] = b""
+        self.wait()
+        self.s3_client.complete_multipart_upload(
+            Bucket=self.bucket,
+            Key=self.key,
+            UploadId=self.state["upload_id"],
+            MultipartUpload={"Parts": self.state["parts"]},
+        )
+        cancel_parts(self.state["upload_id"])
+
+    def abort(self):
+        """
+        Abort method.
+
+        Drops queued parts and the upload so s3 does not keep them around.
+        """
+        for future in self.futures:
+            future.cancel()
+        self.futures = {}
+        if self.state["upload_id"] is not None:
+            cancel_parts(self.state["upload_id"])
+            self.s3_client.abort_multipart_upload(
+                Bucket=self.bucket, Key=self.key, UploadId=self.state["upload_id"]
+            )
+            self.state["upload_id"] = None
+
+
+def upload_lines(lines, bucket, key, s3_client, part_size=PART_SIZE, progress=None):
+    """
+    Upload lines.
+
+    Uploads an iterable of str lines to s3, uploading parts concurrently while
+    the lines are still being produced.
+    """
+    writer = MultipartWriter(
+        new_multipart_state(), bucket, key, s3_client, part_size, progress
+    )
+    try:
+        batch = []
+        for line in lines:
+            batch.append(line)
+            if len(batch) == 1000:
+                writer.write(batch)
+                batch = []
+        writer.write(batch)
+        writer.close()
+    except Exception as e:
+        writer.abort()
+        raise DBError(str(e))
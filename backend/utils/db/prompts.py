@@ -0,0 +1,236 @@
+"""
+Prompt compiler.
+
+Builds shorter prompts than the full template: a one line instruction, only
+the columns that help pick a category, long values cut short, and
+optionally several rows per request answered as one JSON object that is
+split back per row when the output is read.
+"""
+
+import os
+import json
+import math
+
+COMPACT_PROMPT = (
+    "Put the company into a category. Answer with just the category, "
+    'e.g. "Food Expense".\n'
+)
+PACKED_PROMPT = (
+    "Put each numbered company into a category. Answer with just a JSON "
+    'object of number to category, e.g. {"1": "Food Expense"}.\n'
+)
+# rough size of a token in english text, for estimates only
+CHARS_PER_TOKEN = 4
+# answer tokens allowed per packed row
+PACKED_ANSWER_TOKENS = 24
+
+prompt_compiler = None
+
+
+def estimate_tokens(text):
+    """
+    Estimate tokens.
+
+    Rough number of input tokens of a text.
+    """
+    return math.ceil(len(text) / CHARS_PER_TOKEN)
+
+
+def truncate(value, max_value):
+    """
+    Truncate.
+
+    Puts a value on one line and cuts it down to max_value characters, 0
+    keeps it whole.
+    """
+    value = " ".join(value.splitlines())
+    if max_value and len(value) > max_value:
+        return value[:max_value]
+    return value
+
+
+class PromptCompiler:
+    """
+    Prompt compiler.
+
+    Turns rows of a csv into compact prompt texts.
+    """
+
+    def __init__(self, columns=None, max_value=0, rows_per_request=1):
+        """
+        Init function.
+
+        columns is the allow list of columns sent, None sends them all.
+        Values are cut to max_value characters and rows_per_request rows
+        share a request.
+        """
+        self.columns = columns
+        self.max_value = max_value
+        self.rows_per_request = rows_per_request
+
+    def max_tokens(self):
+        """
+        Max tokens.
+
+        Answer tokens a request may use.
+        """
+        return max(1024, PACKED_ANSWER_TOKENS * self.rows_per_request)
+
+    def rows(self, df):
+        """
+        Rows method.
+
+        The text of every row, a column at a time like convert_frame, with
+        only the allowed columns and values that are not null.
+        """
+        names = [
+            name
+            for name in df.columns
+            if self.columns is None or str(name).strip() in self.columns
+        ]
+        if not names:
+            return [""] * len(df)
+        values = df[names].to_numpy()
+        present = df[names].notna().to_numpy()
+        columns = []
+        for i, name in enumerate(names):
+            columns.append(
+                [
+                    f"{name}: {truncate(str(value), self.max_value)}" if keep else ""
+                    for value, keep in zip(values[:, i], present[:, i])
+                ]
+            )
+        return ["; ".join(part for part in parts if part) for parts in zip(*columns)]
+
+    def single(self, row):
+        """
+        Single method.
+
+        Prompt text of one row.
+        """
+        return f"{COMPACT_PROMPT}{row}"
+
+    def pack(self, rows):
+        """
+        Pack method.
+
+        Prompt text of several rows, numbered from 1.
+        """
+        body = "".join(f"{number}. {row}\n" for number, row in enumerate(rows, 1))
+        return f"{PACKED_PROMPT}{body}"
+
+
+def packs(numbered, size):
+    """
+    Packs.
+
+    Groups (number, position) pairs into packs of up to size pairs with
+    consecutive numbers, so a pack is named by its first number alone.
+    """
+    pack = []
+    for number, i in numbered:
+        if pack and (len(pack) == size or number != pack[-1][0] + 1):
+            yield pack
+            pack = []
+        pack.append((number, i))
+    if pack:
+        yield pack
+
+
+def packed_rows(model_input):
+    """
+    Packed rows.
+
+    Gives the row texts of a packed model input, or None for any other
+    input.
+    """
+    try:
+        text = model_input["messages"][0]["content"][0]["text"]
+    except (TypeError, KeyError, IndexError):
+        return None
+    if not text.startswith(PACKED_PROMPT):
+        return None
+    return [
+        row.split(". ", 1)[1]
+        for row in text[len(PACKED_PROMPT) :].splitlines()
+        if ". " in row
+    ]
+
+
+def split_answer(text):
+    """
+    Split answer.
+
+    Gives (offset, category) pairs of a packed answer, or None when the
+    answer is for a single row.
+    """
+    start = text.find("{")
+    end = text.rfind("}")
+    if start == -1 or end < start:
+        return None
+    try:
+        answers = json.loads(text[start : end + 1])
+    except ValueError:
+        return None
+    if not isinstance(answers, dict):
+        return None
+    res = []
+    for number, category in answers.items():
+        if str(number).strip().isdigit() and int(number) > 0:
+            res.append((int(number) - 1, str(category).strip()))
+    return res
+
+
+def new_token_counts():
+    """
+    New token counts.
+
+    Estimated input tokens the full template would have used for every row,
+    and those sent.
+    """
+    return {"full": 0, "sent": 0}
+
+
+def count_tokens(counts, full_texts, texts):
+    """
+    Count tokens.
+
+    Adds the full prompts of a block of rows and the texts sent for it.
+    """
+    counts["full"] += sum(map(estimate_tokens, full_texts))
+    counts["sent"] += sum(map(estimate_tokens, texts))
+
+
+def token_savings(counts):
+    """
+    Token savings.
+
+    Share of estimated input tokens saved, 0 when nothing was counted.
+    """
+    if counts["full"] == 0:
+        return 0.0
+    return 1 - counts["sent"] / counts["full"]
+
+
+def get_prompt_compiler():
+    """
+    Get prompt compiler.
+
+    Creates the compiler from the env on first use. Gives None with
+    PROMPT_STYLE=full, which keeps the full template.
+    """
+    global prompt_compiler
+    if os.environ.get("PROMPT_STYLE", "full") != "compact":
+        return None
+    if prompt_compiler is None:
+        columns = [
+            column.strip()
+            for column in os.environ.get("PROMPT_COLUMNS", "").split(",")
+            if column.strip()
+        ]
+        prompt_compiler = PromptCompiler(
+            columns or None,
+            int(os.environ.get("PROMPT_MAX_VALUE", "0")),
+            max(1, int(os.environ.get("PROMPT_ROWS_PER_REQUEST", "1"))),
+        )
+    return prompt_compiler
@@ -0,0 +1,994 @@
+"""
+Upload sessions.
+
+Keeps the state of chunked uploads in progress. The memory store holds out of
+order chunks under a byte budget, spilling the least recently used ones to
+disk, and evicts sessions that have been idle for too long. The sqlite store
+keeps the same state in a database file so several worker processes can share
+uploads. Tables of an upload that grow with its rows are written a chunk's
+worth at a time, and large byte buffers are kept in files next to it.
+"""
+
+import io
+import os
+import time
+import uuid
+import fcntl
+import pickle
+import shutil
+import socket
+import sqlite3
+import threading
+from array import array
+from contextlib import contextmanager
+from collections import OrderedDict
+from collections.abc import MutableMapping
+from backend.types.errors import DBError
+
+# bytes in a sqlite session state from this size on go to a blob file
+BLOB_BYTES = 64 * 1024
+
+
+class ChunkBuffer(MutableMapping):
+    """
+    Chunk buffer.
+
+    Maps chunk numbers to chunk bytes for one upload. Chunks live in memory
+    until the store asks for them to be spilled to disk.
+    """
+
+    def __init__(self, store, fileid):
+        """
+        Init function.
+
+        Creates an empty buffer owned by the store.
+        """
+        self.store = store
+        self.fileid = fileid
+        self.memory = {}
+        self.spilled = {}
+
+    def path(self, chunk_number):
+        """
+        Path method.
+
+        Where a spilled chunk is kept on disk.
+        """
+        return os.path.join(self.store.spill_dir, f"{self.fileid}.{chunk_number}")
+
+    def __getitem__(self, chunk_number):
+        """
+        Get item.
+
+        Reads a chunk from memory or from its spill file.
+        """
+        if chunk_number in self.memory:
+            self.store.touch(self.fileid, chunk_number)
+            return self.memory[chunk_number]
+        if chunk_number in self.spilled:
+            with open(self.path(chunk_number), "rb") as f:
+                return f.read()
+        raise KeyError(chunk_number)
+
+    def __setitem__(self, chunk_number, chunk):
+        """
+        Set item.
+
+        Buffers a chunk in memory and charges it to the store budget.
+        """
+        if chunk_number in self:
+            del self[chunk_number]
+        self.memory[chunk_number] = bytes(chunk)
+        self.store.buffered(self.fileid, chunk_number, len(chunk))
+
+    def __delitem__(self, chunk_number):
+        """
+        Delete item.
+
+        Drops a chunk from memory or removes its spill file.
+        """
+        if chunk_number in self.memory:
+            chunk = self.memory.pop(chunk_number)
+            self.store.released(self.fileid, chunk_number, len(chunk))
+        elif chunk_number in self.spilled:
+            size = self.spilled.pop(chunk_number)
+            self.store.unspilled(size)
+            os.remove(self.path(chunk_number))
+        else:
+            raise KeyError(chunk_number)
+
+    def __contains__(self, chunk_number):
+        """
+        Contains method.
+
+        Checks both memory and disk without reading anything.
+        """
+        return chunk_number in self.memory or chunk_number in self.spilled
+
+    def __iter__(self):
+        """
+        Iter method.
+
+        Iterates over every buffered chunk number.
+        """
+        return iter(list(self.memory) + list(self.spilled))
+
+    def __len__(self):
+        """
+        Len method.
+
+        Number of buffered chunks.
+        """
+        return len(self.memory) + len(self.spilled)
+
+    def clear(self):
+        """
+        Clear method.
+
+        Drops every chunk without reading spilled ones back.
+        """
+        for chunk_number in list(self):
+            del self[chunk_number]
+
+    def spill(self, chunk_number):
+        """
+        Spill method.
+
+        Moves a chunk from memory to disk.
+        """
+        chunk = self.memory.pop(chunk_number)
+        os.makedirs(self.store.spill_dir, exist_ok=True)
+        with open(self.path(chunk_number), "wb") as f:
+            f.write(chunk)
+        self.spilled[chunk_number] = len(chunk)
+        return len(chunk)
+
+
+class MemoryTables:
+    """
+    Memory tables.
+
+    Makes the mappings and arrays of an upload that grow with its rows, as
+    plain dicts and arrays.
+    """
+
+    def map(self, name):
+        """
+        Map method.
+
+        An empty mapping.
+        """
+        return {}
+
+    def array(self, name, typecode):
+        """
+        Array method.
+
+        An empty array of typecode.
+        """
+        return array(typecode)
+
+
+class UploadSessionStore:
+    """
+    Upload session store.
+
+    Bounded store of upload sessions keyed by fileid.
+    """
+
+    # sessions never leave this process
+    shared = False
+
+    def __init__(self, max_bytes, ttl, spill_dir, on_evict=None):
+        """
+        Init function.
+
+        max_bytes is the budget for chunks held in memory, ttl the seconds a
+        session may sit idle and on_evict is called with the fileid and
+        state of every evicted session.
+        """
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.spill_dir = spill_dir
+        self.on_evict = on_evict
+        self.lock = threading.RLock()
+        self.file_locks = {}
+        self.sessions = OrderedDict()
+        self.last_used = {}
+        self.chunks = OrderedDict()
+        self.buffered_bytes = 0
+        self.spilled_bytes = 0
+        self.spilled_chunks = 0
+        self.evicted = 0
+
+    def get(self, fileid):
+        """
+        Get method.
+
+        Gets the session for a fileid, creating it if needed.
+        """
+        now = time.monotonic()
+        self.sweep(now)
+        with self.lock:
+            if fileid not in self.sessions:
+                self.sessions[fileid] = {
+                    "set": ChunkBuffer(self, fileid),
+                    "tables": MemoryTables(),
+                    "finished": [],
+                    "next": 0,
+                }
+            self.sessions.move_to_end(fileid)
+            self.last_used[fileid] = now
+            return self.sessions[fileid]
+
+    @contextmanager
+    def session(self, fileid):
+        """
+        Session method.
+
+        Holds the session for a fileid while chunks are applied to it, so
+        concurrent chunks of one upload are handled one at a time. The lock
+        of an upload is kept while anyone holds or waits on it.
+        """
+        with self.lock:
+            entry = self.file_locks.setdefault(fileid, [threading.Lock(), 0])
+            entry[1] += 1
+        try:
+            with entry[0]:
+                yield self.get(fileid)
+        finally:
+            with self.lock:
+                entry[1] -= 1
+                if entry[1] == 0:
+                    del self.file_locks[fileid]
+
+    def __contains__(self, fileid):
+        """
+        Contains method.
+
+        Checks whether an upload is in progress.
+        """
+        return fileid in self.sessions
+
+    def drop(self, fileid):
+        """
+        Drop method.
+
+        Forgets a session and everything it buffered. Gives back the state
+        of the session, None when there was none.
+        """
+        with self.lock:
+            session = self.sessions.pop(fileid, None)
+            self.last_used.pop(fileid, None)
+            if session is not None:
+                session["set"].clear()
+            return session
+
+    def sweep(self, now=None):
+        """
+        Sweep method.
+
+        Evicts sessions idle for longer than the ttl. on_evict runs once the
+        store is unlocked, it may be slow.
+        """
+        if now is None:
+            now = time.monotonic()
+        evicted = []
+        with self.lock:
+            while self.sessions:
+                fileid = next(iter(self.sessions))
+                if now - self.last_used[fileid] < self.ttl:
+                    break
+                evicted.append((fileid, self.drop(fileid)))
+                self.evicted += 1
+        if self.on_evict is not None:
+            for fileid, session in evicted:
+                self.on_evict(fileid, session)
+
+    def touch(self, fileid, chunk_number):
+        """
+        Touch method.
+
+        Marks an in memory chunk as recently used.
+        """
+        with self.lock:
+            if (fileid, chunk_number) in self.chunks:
+                self.chunks.move_to_end((fileid, chunk_number))
+
+    def buffered(self, fileid, chunk_number, size):
+        """
+        Buffered method.
+
+        Charges a new chunk to the budget, spilling the least recently used
+        chunks until the budget holds again.
+        """
+        with self.lock:
+            self.chunks[(fileid, chunk_number)] = size
+            self.buffered_bytes += size
+            while self.buffered_bytes > self.max_bytes and self.chunks:
+                (owner, number), size = self.chunks.popitem(last=False)
+                self.sessions[owner]["set"].spill(number)
+                self.buffered_bytes -= size
+                self.spilled_bytes += size
+                self.spilled_chunks += 1
+
+    def released(self, fileid, chunk_number, size):
+        """
+        Released method.
+
+        Gives the bytes of an in memory chunk back to the budget.
+        """
+        with self.lock:
+            if self.chunks.pop((fileid, chunk_number), None) is not None:
+                self.buffered_bytes -= size
+
+    def unspilled(self, size):
+        """
+        Unspilled method.
+
+        Accounts for a spilled chunk leaving the disk.
+        """
+        with self.lock:
+            self.spilled_bytes -= size
+            self.spilled_chunks -= 1
+
+    def metrics(self):
+        """
+        Metrics method.
+
+        Gives a snapshot of live sessions and buffered bytes.
+        """
+        with self.lock:
+            return {
+                "sessions": len(self.sessions),
+                "buffered_bytes": self.buffered_bytes,
+                "buffered_chunks": len(self.chunks),
+                "spilled_bytes": self.spilled_bytes,
+                "spilled_chunks": self.spilled_chunks,
+                "evicted": self.evicted,
+            }
+
+
+class SQLiteChunks(MutableMapping):
+    """
+    SQLite chunks.
+
+    Maps chunk numbers to chunk bytes for one upload, stored in the database.
+    """
+
+    def __init__(self, conn, fileid):
+        """
+        Init function.
+
+        Uses an open connection of the store.
+        """
+        self.conn = conn
+        self.fileid = fileid
+
+    def __getitem__(self, chunk_number):
+        """
+        Get item.
+
+        Reads a chunk from the database.
+        """
+        row = self.conn.execute(
+            "SELECT data FROM chunks WHERE fileid = ? AND chunk_number = ?",
+            (self.fileid, chunk_number),
+        ).fetchone()
+        if row is None:
+            raise KeyError(chunk_number)
+        return row[0]
+
+    def __setitem__(self, chunk_number, chunk):
+        """
+        Set item.
+
+        Writes a chunk to the database.
+        """
+        self.conn.execute(
+            "INSERT OR REPLACE INTO chunks (fileid, chunk_number, data) "
+            "VALUES (?, ?, ?)",
+            (self.fileid, chunk_number, bytes(chunk)),
+        )
+
+    def __delitem__(self, chunk_number):
+        """
+        Delete item.
+
+        Removes a chunk from the database.
+        """
+        cursor = self.conn.execute(
+            "DELETE FROM chunks WHERE fileid = ? AND chunk_number = ?",
+            (self.fileid, chunk_number),
+        )
+        if cursor.rowcount == 0:
+            raise KeyError(chunk_number)
+
+    def __contains__(self, chunk_number):
+        """
+        Contains method.
+
+        Checks for a chunk without reading it.
+        """
+        return (
+            self.conn.execute(
+                "SELECT 1 FROM chunks WHERE fileid = ? AND chunk_number = ?",
+                (self.fileid, chunk_number),
+            ).fetchone()
+            is not None
+        )
+
+    def __iter__(self):
+        """
+        Iter method.
+
+        Iterates over every stored chunk number.
+        """
+        rows = self.conn.execute(
+            "SELECT chunk_number FROM chunks WHERE fileid = ?", (self.fileid,)
+        ).fetchall()
+        return iter([row[0] for row in rows])
+
+    def __len__(self):
+        """
+        Len method.
+
+        Number of stored chunks.
+        """
+        return self.conn.execute(
+            "SELECT COUNT(*) FROM chunks WHERE fileid = ?", (self.fileid,)
+        ).fetchone()[0]
+
+
+class SQLiteMap(MutableMapping):
+    """
+    SQLite map.
+
+    Mapping for one upload stored in the database, so a chunk only writes
+    the entries it adds instead of the whole mapping.
+    """
+
+    def __init__(self, conn, fileid, name):
+        """
+        Init function.
+
+        Uses an open connection of the store. Keys and values are pickled.
+        """
+        self.conn = conn
+        self.fileid = fileid
+        self.name = name
+        self.size = None
+
+    def __getitem__(self, key):
+        """
+        Get item.
+
+        Reads an entry from the database.
+        """
+        row = self.conn.execute(
+            "SELECT value FROM entries WHERE fileid = ? AND name = ? AND key = ?",
+            (self.fileid, self.name, pickle.dumps(key)),
+        ).fetchone()
+        if row is None:
+            raise KeyError(key)
+        return pickle.loads(row[0])
+
+    def __setitem__(self, key, value):
+        """
+        Set item.
+
+        Writes an entry to the database.
+        """
+        args = (pickle.dumps(value), self.fileid, self.name, pickle.dumps(key))
+        cursor = self.conn.execute(
+            "UPDATE entries SET value = ? WHERE fileid = ? AND name = ? AND key = ?",
+            args,
+        )
+        if cursor.rowcount == 0:
+            self.conn.execute(
+                "INSERT INTO entries (value, fileid, name, key) VALUES (?, ?, ?, ?)",
+                args,
+            )
+            if self.size is not None:
+                self.size += 1
+
+    def __delitem__(self, key):
+        """
+        Delete item.
+
+        Removes an entry from the database.
+        """
+        cursor = self.conn.execute(
+            "DELETE FROM entries WHERE fileid = ? AND name = ? AND key = ?",
+            (self.fileid, self.name, pickle.dumps(key)),
+        )
+        if cursor.rowcount == 0:
+            raise KeyError(key)
+        if self.size is not None:
+            self.size -= 1
+
+    def __iter__(self):
+        """
+        Iter method.
+
+        Iterates over every key.
+        """
+        return iter([key for key, _ in self.items()])
+
+    def __len__(self):
+        """
+        Len method.
+
+        Number of entries, counted once per session.
+        """
+        if self.size is None:
+            self.size = self.conn.execute(
+                "SELECT COUNT(*) FROM entries WHERE fileid = ? AND name = ?",
+                (self.fileid, self.name),
+            ).fetchone()[0]
+        return self.size
+
+    def items(self):
+        """
+        Items method.
+
+        Every key and value, read in one query.
+        """
+        rows = self.conn.execute(
+            "SELECT key, value FROM entries WHERE fileid = ? AND name = ?",
+            (self.fileid, self.name),
+        ).fetchall()
+        return [(pickle.loads(key), pickle.loads(value)) for key, value in rows]
+
+
+class SQLiteArray:
+    """
+    SQLite array.
+
+    Append only array for one upload stored in the database, a block per
+    session that appended to it.
+    """
+
+    def __init__(self, conn, fileid, name, typecode):
+        """
+        Init function.
+
+        Uses an open connection of the store.
+        """
+        self.conn = conn
+        self.fileid = fileid
+        self.name = name
+        self.typecode = typecode
+        self.pending = array(typecode)
+
+    def append(self, value):
+        """
+        Append method.
+
+        Adds a value, written with the rest when the session is saved.
+        """
+        self.pending.append(value)
+
+    def flush(self):
+        """
+        Flush method.
+
+        Writes the values appended since the last flush as a new block.
+        """
+        if not self.pending:
+            return
+        self.conn.execute(
+            "INSERT INTO blocks (fileid, name, seq, data) VALUES (?, ?, "
+            "(SELECT COALESCE(MAX(seq), -1) + 1 FROM blocks "
+            "WHERE fileid = ? AND name = ?), ?)",
+            (
+                self.fileid,
+                self.name,
+                self.fileid,
+                self.name,
+                self.pending.tobytes(),
+            ),
+        )
+        self.pending = array(self.typecode)
+
+    def tobytes(self):
+        """
+        To bytes method.
+
+        Every value in machine order, like array.tobytes.
+        """
+        rows = self.conn.execute(
+            "SELECT data FROM blocks WHERE fileid = ? AND name = ? ORDER BY seq",
+            (self.fileid, self.name),
+        ).fetchall()
+        return b"".join(row[0] for row in rows) + self.pending.tobytes()
+
+
+class SQLiteTables:
+    """
+    SQLite tables.
+
+    Makes the mappings and arrays of an upload that grow with its rows, kept
+    in the database.
+    """
+
+    def __init__(self, conn, fileid):
+        """
+        Init function.
+
+        Uses an open connection of the store.
+        """
+        self.conn = conn
+        self.fileid = fileid
+
+    def map(self, name):
+        """
+        Map method.
+
+        The mapping called name.
+        """
+        return SQLiteMap(self.conn, self.fileid, name)
+
+    def array(self, name, typecode):
+        """
+        Array method.
+
+        The array called name.
+        """
+        return SQLiteArray(self.conn, self.fileid, name, typecode)
+
+
+class StatePickler(pickle.Pickler):
+    """
+    State pickler.
+
+    Pickles a session state with its tables left in the database and large
+    bytes written to blob files.
+    """
+
+    def __init__(self, file, store, fileid, blobs):
+        """
+        Init function.
+
+        blobs holds the blob files the state was loaded with and their
+        bytes, a blob that only grew is appended to instead of rewritten.
+        """
+        super().__init__(file)
+        self.store = store
+        self.fileid = fileid
+        self.blobs = blobs
+        self.kept = set()
+
+    def persistent_id(self, obj):
+        """
+        Persistent id.
+
+        Gives the reference saved in place of a table or a large bytes.
+        """
+        if isinstance(obj, SQLiteMap):
+            return ("map", obj.name)
+        if isinstance(obj, SQLiteArray):
+            obj.flush()
+            return ("array", obj.name, obj.typecode)
+        if type(obj) is bytes and len(obj) >= BLOB_BYTES:
+            name = self.store.write_blob(self.fileid, obj, self.blobs)
+            self.kept.add(name)
+            return ("blob", name, len(obj))
+        return None
+
+
+class StateUnpickler(pickle.Unpickler):
+    """
+    State unpickler.
+
+    Loads a session state, binding its tables to an open connection and
+    reading its blob files.
+    """
+
+    def __init__(self, file, store, conn, fileid, blobs):
+        """
+        Init function.
+
+        Every blob read is recorded in blobs.
+        """
+        super().__init__(file)
+        self.store = store
+        self.conn = conn
+        self.fileid = fileid
+        self.blobs = blobs
+
+    def persistent_load(self, pid):
+        """
+        Persistent load.
+
+        Gives back the table or bytes of a reference.
+        """
+        if pid[0] == "map":
+            return SQLiteMap(self.conn, self.fileid, pid[1])
+        if pid[0] == "array":
+            return SQLiteArray(self.conn, self.fileid, pid[1], pid[2])
+        if pid[0] == "blob":
+            data = self.store.read_blob(self.fileid, pid[1], pid[2])
+            self.blobs[pid[1]] = data
+            return data
+        raise pickle.UnpicklingError(f"unknown reference {pid[0]}")
+
+
+class SQLiteSessionStore:
+    """
+    SQLite session store.
+
+    Upload sessions shared by every worker process on one host. Chunks and
+    the session state live in a sqlite file, and a lock file per upload makes
+    the chunks of one upload apply one at a time across processes. flock and
+    sqlite locking are not safe on network filesystems, so the database is
+    tied to the host that uses it and other hosts are refused. The state is
+    saved after every chunk, so only what is needed to carry on is in it:
+    tables that grow with the rows only write what a chunk added and large
+    buffers, like the pending bytes of a multipart upload, are blob files.
+    """
+
+    # the next chunk of an upload may be applied by another process
+    shared = True
+
+    def __init__(self, path, ttl, lock_dir, blob_dir, on_evict=None):
+        """
+        Init function.
+
+        path is the database file, ttl the seconds a session may sit idle,
+        blob_dir where large bytes of a state are kept and on_evict is called
+        with the fileid and state of every evicted session.
+        """
+        self.path = path
+        self.ttl = ttl
+        self.lock_dir = lock_dir
+        self.blob_dir = blob_dir
+        self.on_evict = on_evict
+        os.makedirs(lock_dir, exist_ok=True)
+        os.makedirs(blob_dir, exist_ok=True)
+        with self.connect() as conn:
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS sessions "
+                "(fileid TEXT PRIMARY KEY, state BLOB, last_used REAL)"
+            )
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS chunks (fileid TEXT, "
+                "chunk_number INTEGER, data BLOB, "
+                "PRIMARY KEY (fileid, chunk_number))"
+            )
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS entries (fileid TEXT, name TEXT, "
+                "key BLOB, value BLOB, PRIMARY KEY (fileid, name, key))"
+            )
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS blocks (fileid TEXT, name TEXT, "
+                "seq INTEGER, data BLOB, PRIMARY KEY (fileid, name, seq))"
+            )
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS counters (name TEXT PRIMARY KEY, "
+                "value INTEGER)"
+            )
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS meta (name TEXT PRIMARY KEY, value TEXT)"
+            )
+            owner = self.owner(conn)
+            if owner is not None and owner != socket.gethostname():
+                if conn.execute("SELECT COUNT(*) FROM sessions").fetchone()[0]:
+                    raise DBError(
+                        f"upload sessions in {path} are in use by host {owner}"
+                    )
+            conn.execute(
+                "INSERT OR REPLACE INTO meta (name, value) VALUES ('host', ?)",
+                (socket.gethostname(),),
+            )
+
+    def owner(self, conn):
+        """
+        Owner method.
+
+        Host the database belongs to, None before any host opened it.
+        """
+        row = conn.execute("SELECT value FROM meta WHERE name = 'host'").fetchone()
+        return row[0] if row is not None else None
+
+    @contextmanager
+    def connect(self):
+        """
+        Connect method.
+
+        Opens a connection that commits when the block succeeds and is closed
+        afterwards. Every session gets its own.
+        """
+        conn = sqlite3.connect(self.path, timeout=30)
+        try:
+            with conn:
+                yield conn
+        finally:
+            conn.close()
+
+    @contextmanager
+    def lock(self, fileid):
+        """
+        Lock method.
+
+        Takes the cross process lock for one upload.
+        """
+        with open(os.path.join(self.lock_dir, f"{fileid}.lock"), "a") as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
+
+    def blob_path(self, fileid, name):
+        """
+        Blob path.
+
+        Where a blob of an upload is kept.
+        """
+        return os.path.join(self.blob_dir, fileid, name)
+
+    def read_blob(self, fileid, name, size):
+        """
+        Read blob.
+
+        Reads the first size bytes of a blob, bytes past them were written
+        by a save that did not commit.
+        """
+        with open(self.blob_path(fileid, name), "rb") as f:
+            return f.read(size)
+
+    def write_blob(self, fileid, data, blobs):
+        """
+        Write blob.
+
+        Gives the name of a blob holding data. A loaded blob data starts
+        with only gets the new bytes, anything else goes to a new file so
+        the state that is still committed keeps its blobs.
+        """
+        for name, old in list(blobs.items()):
+            if data.startswith(old):
+                del blobs[name]
+                with open(self.blob_path(fileid, name), "r+b") as f:
+                    f.seek(len(old))
+                    f.write(data[len(old) :])
+                    f.truncate()
+                return name
+        name = uuid.uuid4().hex
+        os.makedirs(os.path.join(self.blob_dir, fileid), exist_ok=True)
+        with open(self.blob_path(fileid, name), "wb") as f:
+            f.write(data)
+        return name
+
+    def remove_blobs(self, fileid, kept):
+        """
+        Remove blobs.
+
+        Removes the blobs of an upload its saved state no longer uses.
+        """
+        directory = os.path.join(self.blob_dir, fileid)
+        if not os.path.isdir(directory):
+            return
+        for name in os.listdir(directory):
+            if name not in kept:
+                os.remove(os.path.join(directory, name))
+
+    def load(self, conn, fileid, data, blobs):
+        """
+        Load method.
+
+        Unpickles a state with its tables bound to conn.
+        """
+        return StateUnpickler(io.BytesIO(data), self, conn, fileid, blobs).load()
+
+    @contextmanager
+    def session(self, fileid):
+        """
+        Session method.
+
+        Loads the session for a fileid under its lock and writes the state
+        back when the caller is done with it.
+        """
+        self.sweep()
+        with self.lock(fileid):
+            blobs = {}
+            with self.connect() as conn:
+                owner = self.owner(conn)
+                if owner != socket.gethostname():
+                    # another host took the database over, its workers and
+                    # these cannot share locks
+                    raise DBError(f"upload sessions in {self.path} moved to {owner}")
+                row = conn.execute(
+                    "SELECT state FROM sessions WHERE fileid = ?", (fileid,)
+                ).fetchone()
+                session = {"finished": [], "next": 0}
+                if row is not None:
+                    session = self.load(conn, fileid, row[0], blobs)
+                session["set"] = SQLiteChunks(conn, fileid)
+                session["tables"] = SQLiteTables(conn, fileid)
+                yield session
+                session.pop("set")
+                session.pop("tables")
+                data = io.BytesIO()
+                pickler = StatePickler(data, self, fileid, blobs)
+                pickler.dump(session)
+                conn.execute(
+                    "INSERT OR REPLACE INTO sessions (fileid, state, last_used) "
+                    "VALUES (?, ?, ?)",
+                    (fileid, data.getvalue(), time.time()),
+                )
+            self.remove_blobs(fileid, pickler.kept)
+
+    def drop(self, fileid):
+        """
+        Drop method.
+
+        Forgets a session and everything stored for it. Gives back the state
+        of the session, None when there was none, so only one process sees a
+        session go, its tables go with it. The lock file stays, another
+        process may be holding or waiting on it.
+        """
+        with self.lock(fileid):
+            with self.connect() as conn:
+                row = conn.execute(
+                    "SELECT state FROM sessions WHERE fileid = ?", (fileid,)
+                ).fetchone()
+                session = None
+                if row is not None:
+                    session = self.load(conn, fileid, row[0], {})
+                cursor = conn.execute(
+                    "DELETE FROM sessions WHERE fileid = ?", (fileid,)
+                )
+                if cursor.rowcount == 0:
+                    session = None
+                for table in ("chunks", "entries", "blocks"):
+                    conn.execute(f"DELETE FROM {table} WHERE fileid = ?", (fileid,))
+            shutil.rmtree(os.path.join(self.blob_dir, fileid), ignore_errors=True)
+        return session
+
+    def sweep(self, now=None):
+        """
+        Sweep method.
+
+        Evicts sessions idle for longer than the ttl.
+        """
+        if now is None:
+            now = time.time()
+        with self.connect() as conn:
+            rows = conn.execute(
+                "SELECT fileid FROM sessions WHERE last_used < ?", (now - self.ttl,)
+            ).fetchall()
+        for (fileid,) in rows:
+            session = self.drop(fileid)
+            if session is None:
+                # evicted by another process
+                continue
+            with self.connect() as conn:
+                conn.execute(
+                    "INSERT INTO counters (name, value) VALUES ('evicted', 1) "
+                    "ON CONFLICT(name) DO UPDATE SET value = value + 1"
+                )
+            if self.on_evict is not None:
+                self.on_evict(fileid, session)
+
+    def metrics(self):
+        """
+        Metrics method.
+
+        Gives a snapshot of live sessions and buffered bytes.
+        """
+        with self.connect() as conn:
+            sessions = conn.execute("SELECT COUNT(*) FROM sessions").fetchone()[0]
+            chunks, size = conn.execute(
+                "SELECT COUNT(*), COALESCE(SUM(LENGTH(data)), 0) FROM chunks"
+            ).fetchone()
+            evicted = conn.execute(
+                "SELECT value FROM counters WHERE name = 'evicted'"
+            ).fetchone()
+        return {
+            "sessions": sessions,
+            "buffered_bytes": size,
+            "buffered_chunks": chunks,
+            "evicted": evicted[0] if evicted else 0,
+        }
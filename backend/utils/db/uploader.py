@@ -4,27 +4,171 @@ Uploader.
 This module contains the functions that are used to upload chunks of data to
 """
 
+import io
 import os
 import json
+import threading
+from contextlib import contextmanager
 import pandas as pd
-from backend.types.errors import DBError
+from backend.types.errors import DBError, JSONError
+from backend.utils.db.multipart import (
+    MultipartWriter,
+    cancel_parts,
+    new_multipart_state,
+    upload_lines,
+)
+from backend.utils.db.sessions import (
+    MemoryTables,
+    SQLiteSessionStore,
+    UploadSessionStore,
+)
+from backend.utils.db.dedup import new_dedup_state, dedup_texts, upload_index
+from backend.utils.db.prompts import (
+    count_tokens,
+    get_prompt_compiler,
+    new_token_counts,
+    packs,
+    token_savings,
+)
+from backend.utils.categories import upload_known
 
-ongoing_uploads = {}
+ongoing_uploads = None
+# client the multipart uploads of evicted sessions are aborted with
+sessions_s3_client = None
+# estimated prompt tokens of every upload this process finished
+prompt_tokens = new_token_counts()
+prompt_tokens_lock = threading.Lock()
 
 
-def get_chunk_uploader(fileid, total_chunks):
+def temp_paths(fileid):
+    """
+    Temp paths.
+
+    Gives the local csv and prompt paths for an upload.
+    """
+    path = os.path.join(os.environ.get("TEMP_FILE_LOCATION"), fileid)
+    output_path = os.path.join(
+        os.environ.get("TEMP_FILE_LOCATION"), "prompts", f"{fileid}.jsonl"
+    )
+    return path, output_path
+
+
+def remove_temp_files(fileid):
+    """
+    Remove temp files.
+
+    Removes the local files of an upload that is finished or abandoned.
+    """
+    for path in temp_paths(fileid):
+        if os.path.exists(path):
+            os.remove(path)
+
+
+def abandon_upload(fileid, session, s3_client):
+    """
+    Abandon upload.
+
+    Aborts the multipart upload of a session that will not be finished and
+    removes its local files, so s3 does not keep charging for its parts.
+    """
+    multipart = (session or {}).get("multipart")
+    if multipart and multipart["upload_id"] is not None:
+        cancel_parts(multipart["upload_id"])
+    if s3_client is not None and multipart and multipart["upload_id"] is not None:
+        try:
+            s3_client.abort_multipart_upload(
+                Bucket=os.environ.get("AWS_S3_UPLOAD_NAME"),
+                Key=f"input/{fileid}.jsonl",
+                UploadId=multipart["upload_id"],
+            )
+        except Exception as e:
+            print(e)
+    remove_temp_files(fileid)
+
+
+def evict_upload(fileid, session):
+    """
+    Evict upload.
+
+    Cleans up after a session the store evicted for sitting idle.
+    """
+    abandon_upload(fileid, session, sessions_s3_client)
+
+
+def cancel_upload(fileid, s3_client):
+    """
+    Cancel upload.
+
+    Drops the session of an upload still in progress, like one whose file
+    is deleted, and aborts its multipart upload.
+    """
+    abandon_upload(fileid, get_upload_sessions(s3_client).drop(fileid), s3_client)
+
+
+def get_upload_sessions(s3_client=None):
+    """
+    Get upload sessions.
+
+    Creates the session store on first use, once the env has been loaded.
+    UPLOAD_SESSION_BACKEND picks between the in process memory store and the
+    sqlite store shared by every worker on the host. s3_client is kept to
+    abort the multipart uploads of evicted sessions.
+    """
+    global ongoing_uploads, sessions_s3_client
+    if s3_client is not None:
+        sessions_s3_client = s3_client
+    if ongoing_uploads is None:
+        temp = os.environ.get("TEMP_FILE_LOCATION")
+        ttl = float(os.environ.get("UPLOAD_SESSION_TTL", "3600"))
+        if os.environ.get("UPLOAD_SESSION_BACKEND", "memory") == "sqlite":
+            os.makedirs(temp, exist_ok=True)
+            ongoing_uploads = SQLiteSessionStore(
+                os.environ.get("UPLOAD_SESSION_DB", os.path.join(temp, "sessions.db")),
+                ttl,
+                os.path.join(temp, "locks"),
+                os.path.join(temp, "blobs"),
+                on_evict=evict_upload,
+            )
+        else:
+            ongoing_uploads = UploadSessionStore(
+                int(os.environ.get("UPLOAD_SESSION_BYTES", str(256 * 1024 * 1024))),
+                ttl,
+                os.path.join(temp, "spill"),
+                on_evict=evict_upload,
+            )
+    return ongoing_uploads
+
+
+def upload_metrics():
+    """
+    Upload metrics.
+
+    Live sessions and buffered bytes of the upload session store, and the
+    estimated prompt tokens of all uploads finished by this process with the
+    share saved over the full template. The tokens of each file are kept on
+    its item.
+    """
+    with prompt_tokens_lock:
+        tokens = dict(prompt_tokens)
+    tokens["saved"] = token_savings(tokens)
+    return {**get_upload_sessions().metrics(), "tokens": tokens}
+
+
+@contextmanager
+def get_chunk_uploader(fileid, total_chunks, s3_client=None):
     """
     Get chunk uploader function.
 
-    Get multipart uploader from dictionary or creates one.
+    Holds the multipart uploader for a fileid from the session store, creating
+    one if needed. Changes are shared with other workers once the block exits.
     """
-    if fileid not in ongoing_uploads:
-        ongoing_uploads[fileid] = {
-            "set": {},
-            "finished": [],
-            "next": 0,
-        }
-    return ongoing_uploads[fileid]
+    with get_upload_sessions(s3_client).session(fileid) as uploader:
+        if "prompts" not in uploader:
+            # PROMPT_DEDUP=false sends every row, even repeated ones
+            dedup = os.environ.get("PROMPT_DEDUP", "True").lower() == "true"
+            uploader["prompts"] = new_prompt_state(fileid, dedup, uploader["tables"])
+            uploader["multipart"] = new_multipart_state()
+        yield uploader
 
 
 def elegible_chunks(uploader):
@@ -46,6 +190,11 @@ def elegible_chunks(uploader):
     return res
 
 
+PROMPT = """Use the following categories and data points to put a company into a Category.
+Respond with just the category and no other words. An example response could be "Food Expense" \n\n
+    """
+
+
 def convert_line(df, index):
     """
     Convert line.
@@ -53,9 +202,7 @@ def convert_line(df, index):
     Turns a line of csv, pairing the column name with the data and adding a prompt to categorize.
     """
     line = df.iloc[index]
-    prompt = """Use the following categories and data points to put a company into a Category.
-Respond with just the category and no other words. An example response could be "Food Expense" \n\n
-    """
+    prompt = PROMPT
     for i in range(len(line)):
         # only add the prompt if the value is not null
         if pd.notna(line[i]):
@@ -63,77 +210,482 @@ Respond with just the category and no other words. An example response could be
     return prompt
 
 
-def convert_to_prompts(input_path, output_path):
+def convert_frame(df):
+    """
+    Convert frame.
+
+    Builds the prompt for every line of the csv at once, a column at a time.
+    Gives the same text as convert_line for each row.
+    """
+    # to_numpy upcasts like df.iloc[index] does, so values format the same
+    values = df.to_numpy()
+    present = df.notna().to_numpy()
+    columns = []
+    for i, name in enumerate(df.columns):
+        prefix = f"{name}: "
+        columns.append(
+            [
+                f"{prefix}{value}\n" if keep else ""
+                for value, keep in zip(values[:, i], present[:, i])
+            ]
+        )
+    if not columns:
+        return [PROMPT] * len(df)
+    return [PROMPT + "".join(parts) for parts in zip(*columns)]
+
+
+def prompt_template(max_tokens=1024):
+    """
+    Prompt template.
+
+    Splits the serialized model input around its text so lines can be built
+    by concatenation instead of a json.dumps per row.
+    """
+    marker = "\0"
+    serialized = json.dumps(
+        {
+            "modelInput": {
+                "anthropic_version": "bedrock-2023-05-31",
+                "max_tokens": max_tokens,
+                "messages": [
+                    {
+                        "role": "user",
+                        "content": [
+                            {
+                                "type": "text",
+                                "text": marker,
+                            }
+                        ],
+                    }
+                ],
+            },
+        }
+    )
+    head, tail = serialized.split(json.dumps(marker))
+    return head, tail
+
+
+# rows are appended to the fileid as fixed width digits to make a recordId
+RECORD_DIGITS = 11
+
+
+def record_id(fileid, row):
+    """
+    Record id.
+
+    Bedrock recordId of a row of a file, kept alphanumeric.
+    """
+    return f"{fileid}{row:0{RECORD_DIGITS}d}"
+
+
+def parse_record_id(record, fileid):
+    """
+    Parse record id.
+
+    Gives back the row of a recordId if it belongs to the file, or None.
+    """
+    if record is None or len(record) != len(fileid) + RECORD_DIGITS:
+        return None
+    if not record.startswith(fileid) or not record[len(fileid) :].isdigit():
+        return None
+    return int(record[len(fileid) :])
+
+
+def convert_to_lines(df, fileid=None, start=0):
+    """
+    Convert to lines.
+
+    Gives the jsonl lines for every row of the csv. With a fileid each line
+    carries the recordId of its row, counting rows from start.
+    """
+    head, tail = prompt_template()
+    texts = convert_frame(df)
+    if fileid is None:
+        return [f"{head}{json.dumps(text)}{tail}\n" for text in texts]
+    head = head[1:]
+    return [
+        f'{{"recordId": "{record_id(fileid, row)}", {head}{json.dumps(text)}{tail}\n'
+        for row, text in enumerate(texts, start)
+    ]
+
+
+def prompt_lines(state, df, categories=None, classifier=None, compiler=None):
+    """
+    Prompt lines.
+
+    Gives the jsonl lines of an upload for the rows of df, following on from
+    the rows already seen. Rows the category cache or the local classifier
+    are sure about are kept in the state instead of being sent, and with
+    dedup only the first of every prompt is sent, numbered by unique prompt.
+    With a compiler the prompts are compact, and rows with consecutive
+    numbers share a line under the number of the first.
+    """
+    full = convert_frame(df)
+    if compiler is None:
+        head, tail = prompt_template()
+        texts = list(full)
+    else:
+        head, tail = prompt_template(compiler.max_tokens())
+        texts = compiler.rows(df)
+    head = head[1:]
+    start = state["rows"]
+    state["rows"] += len(df)
+    keys = [None] * len(texts)
+    if categories is not None:
+        keys = categories.row_keys(df)
+        for i, category in enumerate(categories.resolve(keys)):
+            if category is not None:
+                state["resolved"][start + i] = category
+                texts[i] = None
+    if classifier is not None:
+        left = [i for i, text in enumerate(texts) if text is not None]
+        for i, category in enumerate(classifier.resolve(df, left)):
+            if category is not None:
+                state["resolved"][start + i] = category
+                texts[i] = None
+    if state["dedup"] is None:
+        numbered = [(start + i, i) for i, text in enumerate(texts) if text is not None]
+    else:
+        numbered = dedup_texts(state["dedup"], texts)
+    if categories is not None:
+        for number, i in numbered:
+            state["keys"][number] = keys[i]
+    if compiler is None:
+        sent = [(number, texts[i]) for number, i in numbered]
+    elif compiler.rows_per_request == 1:
+        sent = [(number, compiler.single(texts[i])) for number, i in numbered]
+    else:
+        sent = [
+            (pack[0][0], compiler.pack([texts[i] for _, i in pack]))
+            for pack in packs(numbered, compiler.rows_per_request)
+        ]
+    count_tokens(state["tokens"], full, [text for _, text in sent])
+    return [
+        f'{{"recordId": "{record_id(state["fileid"], number)}", '
+        f"{head}{json.dumps(text)}{tail}\n"
+        for number, text in sent
+    ]
+
+
+def stream_prompts(input_path, chunk_rows=None):
+    """
+    Stream prompts.
+
+    Reads the csv a block of rows at a time and yields jsonl lines, so memory
+    stays flat whatever the file size. Values are read as text, so a block
+    renders them like a full read does.
+    """
+    if chunk_rows is None:
+        chunk_rows = int(os.environ.get("PROMPT_CHUNK_ROWS", "10000"))
+    # the 6th line is the headers. Ignore everything above
+    with pd.read_csv(input_path, header=5, dtype=str, chunksize=chunk_rows) as reader:
+        for df in reader:
+            yield from convert_to_lines(df)
+
+
+def write_prompts(lines, output_path):
+    """
+    Write prompts.
+
+    Writes jsonl lines to disk as they are produced.
+    """
+    with open(output_path, "w") as f:
+        for line in lines:
+            f.write(line)
+
+
+def convert_to_prompts(input_path, output_path, stream=True):
     """
     Convert to prompts.
 
     Converts a file to prompts for the model
     """
+    if stream:
+        write_prompts(stream_prompts(input_path), output_path)
+        return
     # the 6th line is the headers. Ignore everything above
-    df = pd.read_csv(input_path, header=5)
-    prompts = []
-    for index, row in df.iterrows():
-        prompts.append(
-            {
-                "modelInput": {
-                    "anthropic_version": "bedrock-2023-05-31",
-                    "max_tokens": 1024,
-                    "messages": [
-                        {
-                            "role": "user",
-                            "content": [
-                                {
-                                    "type": "text",
-                                    "text": convert_line(df, index),
-                                }
-                            ],
-                        }
-                    ],
-                },
-            }
-        )
+    df = pd.read_csv(input_path, header=5, dtype=str)
+    write_prompts(convert_to_lines(df), output_path)
 
-    with open(output_path, "w") as f:
-        for prompt in prompts:
-            f.write(json.dumps(prompt))
-            f.write("\n")
+
+def upload_prompts(input_path, bucket, key, s3_client):
+    """
+    Upload prompts.
+
+    Converts a file to prompts and streams them straight into s3.
+    """
+    upload_lines(stream_prompts(input_path), bucket, key, s3_client)
+
+
+# records above and including the headers, matching pd.read_csv(header=5)
+HEADER_RECORDS = 6
+
+
+def split_records(data):
+    """
+    Split records.
+
+    Gives the offset just past the last newline that ends a csv record, so a
+    newline inside a quoted field never splits a row. Expects data to start on
+    a record boundary.
+    """
+    end = data.rfind(b"\n")
+    while end != -1:
+        # an even number of quotes before the newline means it is not quoted
+        if data.count(b'"', 0, end) % 2 == 0:
+            return end + 1
+        end = data.rfind(b"\n", 0, end)
+    return 0
+
+
+def split_head(data):
+    """
+    Split head.
+
+    Gives the offset just past the header record, or 0 if it has not arrived.
+    Blank lines are skipped when counting, like pandas does.
+    """
+    records = 0
+    start = 0
+    end = split_records(data)
+    while start < end:
+        stop = data.find(b"\n", start)
+        while data.count(b'"', start, stop) % 2 != 0:
+            stop = data.find(b"\n", stop + 1)
+        if data[start:stop].rstrip(b"\r") != b"":
+            records += 1
+        start = stop + 1
+        if records == HEADER_RECORDS:
+            return start
+    return 0
 
 
-def upload_chunk(fileid, chunk, chunk_number, total_chunks, bucket, s3_client):
+def new_prompt_state(fileid=None, dedup=False, tables=None):
+    """
+    New prompt state.
+
+    State carried between chunks by feed_prompts, with the estimated tokens
+    of its prompts. The mappings that grow with the rows come from tables,
+    so a session store can keep them outside the state.
+    """
+    if tables is None:
+        tables = MemoryTables()
+    return {
+        "head": None,
+        "tail": b"",
+        "fileid": fileid,
+        "rows": 0,
+        "dedup": (
+            new_dedup_state(tables.map("seen"), tables.array("index", "I"))
+            if dedup
+            else None
+        ),
+        "resolved": tables.map("resolved"),
+        "keys": tables.map("keys"),
+        "tokens": new_token_counts(),
+    }
+
+
+def parse_records(state, data, categories=None, classifier=None, compiler=None):
+    """
+    Parse records.
+
+    Turns complete csv records into jsonl lines, reusing the preamble and
+    headers so pandas applies the same header=5 rules as a full read. Values
+    are read as text, types inferred per chunk would render the same value
+    differently depending on where the chunks split.
+    """
+    if data.strip(b"\r\n") == b"":
+        return []
+    df = pd.read_csv(io.BytesIO(state["head"] + data), header=5, dtype=str)
+    return prompt_lines(state, df, categories, classifier, compiler)
+
+
+def feed_prompts(state, data, categories=None, classifier=None, compiler=None):
+    """
+    Feed prompts.
+
+    Takes the next contiguous bytes of the csv and gives back the jsonl lines
+    for every record completed by them. Partial records wait in the state.
+    Every chunk of an upload must be fed with the same compiler.
+    """
+    buffer = state["tail"] + data
+    if state["head"] is None:
+        end = split_head(buffer)
+        if end == 0:
+            state["tail"] = buffer
+            return []
+        state["head"] = buffer[:end]
+        buffer = buffer[end:]
+    end = split_records(buffer)
+    state["tail"] = buffer[end:]
+    return parse_records(state, buffer[:end], categories, classifier, compiler)
+
+
+def flush_prompts(state, categories=None, classifier=None, compiler=None):
+    """
+    Flush prompts.
+
+    Converts whatever is left once the last chunk has arrived.
+    """
+    tail = state["tail"]
+    state["tail"] = b""
+    if state["head"] is None:
+        # never saw a full header, let pandas report it like a full read would
+        df = pd.read_csv(io.BytesIO(tail), header=5, dtype=str)
+        return prompt_lines(state, df, categories, classifier, compiler)
+    return parse_records(state, tail, categories, classifier, compiler)
+
+
+def write_chunk(path, chunk, chunk_number, chunk_size):
+    """
+    Write chunk.
+
+    Writes a chunk straight to its final offset in the file, so chunks that
+    arrive out of order never have to be buffered.
+    """
+    fd = os.open(path, os.O_WRONLY | os.O_CREAT)
+    try:
+        os.pwrite(fd, chunk, chunk_number * chunk_size)
+    finally:
+        os.close(fd)
+
+
+def read_chunk(path, chunk_number, chunk_size):
+    """
+    Read chunk.
+
+    Reads back a chunk that was written at its offset.
+    """
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        return os.pread(fd, chunk_size, chunk_number * chunk_size)
+    finally:
+        os.close(fd)
+
+
+def upload_chunk(
+    fileid,
+    chunk,
+    chunk_number,
+    total_chunks,
+    bucket,
+    s3_client,
+    chunk_size=None,
+    progress=None,
+    categories=None,
+    classifier=None,
+    on_tokens=None,
+):
     """
     Upload Chunk function.
 
     Takes a chunk, figures out if there is an uploader (creates if otherwise)
-    and uploads chunk
+    and uploads chunk. With a chunk_size every chunk is written at its offset
+    and the uploader only tracks which chunks have landed. Prompts go to s3 as
+    multipart parts while the upload is still going, progress is called for
+    every part. Rows the categories cache or the classifier already know are
+    not sent. When the file is done its estimated prompt tokens are logged
+    and given to on_tokens. Chunks numbered past the end of the file are
+    ignored.
     """
+    if chunk_number >= total_chunks:
+        # older clients send an empty chunk after the last one, it would
+        # open a session that never finishes
+        return chunk_number
     if not os.path.exists(os.environ.get("TEMP_FILE_LOCATION")):
         os.makedirs(os.environ.get("TEMP_FILE_LOCATION"))
     if not os.path.exists(
         os.path.join(os.environ.get("TEMP_FILE_LOCATION"), "prompts")
     ):
         os.makedirs(os.path.join(os.environ.get("TEMP_FILE_LOCATION"), "prompts"))
-    path = os.path.join(os.environ.get("TEMP_FILE_LOCATION"), fileid)
-    output_path = os.path.join(
-        os.environ.get("TEMP_FILE_LOCATION"), "prompts", f"{fileid}.jsonl"
-    )
+    path, output_path = temp_paths(fileid)
+    # PROMPT_STAGING=false skips the local copy of the prompts
+    staging = os.environ.get("PROMPT_STAGING", "True").lower() == "true"
     if not os.path.exists(path):
         with open(path, "wb") as f:
             f.write(b"")
-    if not os.path.exists(output_path):
+    if staging and not os.path.exists(output_path):
         with open(output_path, "wb") as f:
             f.write(b"")
+    if chunk_size is not None:
+        if len(chunk) != chunk_size and chunk_number < total_chunks - 1:
+            raise JSONError(f"chunk {chunk_number} is not {chunk_size} bytes", True)
+        write_chunk(path, chunk, chunk_number, chunk_size)
 
-    uploader = get_chunk_uploader(fileid, total_chunks)
-    uploader["set"][chunk_number] = chunk
-    for i in elegible_chunks(uploader):
-        with open(path, "ab") as f:
-            f.write(i["chunk"])
-        uploader["finished"].append(i["chunk_number"])
-    if len(uploader["finished"]) == total_chunks:
+    compiler = get_prompt_compiler()
+    error = None
+    with get_chunk_uploader(fileid, total_chunks, s3_client) as uploader:
+        writer = MultipartWriter(
+            uploader["multipart"],
+            bucket,
+            f"input/{fileid}.jsonl",
+            s3_client,
+            progress=progress,
+        )
+
+        def emit(lines):
+            if staging:
+                with open(output_path, "a") as f:
+                    f.writelines(lines)
+            writer.write(lines)
+
+        # in offset mode the bytes are already on disk, only mark the arrival
+        uploader["set"][chunk_number] = chunk if chunk_size is None else b""
         try:
-            convert_to_prompts(path, output_path)
-            s3_client.upload_file(output_path, bucket, f"input/{fileid}.jsonl")
+            for i in elegible_chunks(uploader):
+                data = i["chunk"]
+                if chunk_size is None:
+                    with open(path, "ab") as f:
+                        f.write(data)
+                elif i["chunk_number"] == chunk_number:
+                    data = chunk
+                else:
+                    data = read_chunk(path, i["chunk_number"], chunk_size)
+                emit(
+                    feed_prompts(
+                        uploader["prompts"], data, categories, classifier, compiler
+                    )
+                )
+                uploader["finished"].append(i["chunk_number"])
+            finished = len(uploader["finished"]) == total_chunks
+            if finished:
+                emit(
+                    flush_prompts(uploader["prompts"], categories, classifier, compiler)
+                )
+                writer.close()
+                if uploader["prompts"]["dedup"] is not None:
+                    upload_index(
+                        uploader["prompts"]["dedup"], fileid, bucket, s3_client
+                    )
+                if categories is not None or classifier is not None:
+                    upload_known(uploader["prompts"], fileid, bucket, s3_client)
+                tokens = dict(uploader["prompts"]["tokens"])
+                with prompt_tokens_lock:
+                    for name, count in tokens.items():
+                        prompt_tokens[name] += count
+            elif get_upload_sessions().shared:
+                # another process may take the next chunk, it cannot pick up
+                # the parts still uploading here
+                writer.wait()
+            else:
+                writer.collect_done()
         except Exception as e:
-            raise DBError(str(e))
+            # the parts are gone, the upload cannot carry on
+            writer.abort()
+            error = e
+    if error is not None:
+        get_upload_sessions().drop(fileid)
+        remove_temp_files(fileid)
+        raise DBError(str(error))
+    if finished:
+        get_upload_sessions().drop(fileid)
+        remove_temp_files(fileid)
+        print(
+            f"{fileid} prompt tokens: {tokens['sent']} sent of {tokens['full']}, "
+            f"{token_savings(tokens):.1%} saved"
+        )
+        if on_tokens is not None:
+            on_tokens(tokens)
         return -1
     return chunk_number
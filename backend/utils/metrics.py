@@ -0,0 +1,65 @@
+"""
+Metrics.
+
+Gathers the counters of the caches, session stores and background tasks of
+the server into one snapshot, for the metrics event and the periodic log.
+"""
+
+import json
+from backend.utils.categories import get_category_cache
+from backend.utils.db.cache import get_result_cache
+from backend.utils.db.uploader import upload_metrics
+from backend.utils.model.classifier import get_classifier
+
+
+def collect_metrics(db_client, watcher=None, coalescer=None, ondemand=None):
+    """
+    Collect metrics.
+
+    Snapshot of every part that keeps counters, parts that are turned off
+    are left out.
+    """
+    parts = {
+        "uploads": upload_metrics,
+        "results": get_result_cache().metrics,
+    }
+    category_cache = get_category_cache(db_client)
+    if category_cache is not None:
+        parts["categories"] = category_cache.metrics
+    classifier = get_classifier()
+    if classifier is not None:
+        parts["classifier"] = classifier.metrics
+    for name, part in (
+        ("watcher", watcher),
+        ("coalescer", coalescer),
+        ("ondemand", ondemand),
+    ):
+        if part is not None:
+            parts[name] = part.metrics
+    res = {}
+    for name, metrics in parts.items():
+        try:
+            res[name] = metrics()
+        except Exception as e:
+            print(e)
+    return res
+
+
+def log_metrics(
+    socketio, interval, db_client, watcher=None, coalescer=None, ondemand=None
+):
+    """
+    Log metrics.
+
+    Loop for the socketio background task, prints a snapshot every interval
+    seconds.
+    """
+    while True:
+        socketio.sleep(interval)
+        try:
+            print(
+                "metrics "
+                + json.dumps(collect_metrics(db_client, watcher, coalescer, ondemand))
+            )
+        except Exception as e:
+            print(e)
@@ -0,0 +1,338 @@
+"""
+Local classifier.
+
+Nearest neighbour classifier over the labeled Treya spreadsheets, cheap
+enough to run on every upload. Vendor and description are turned into
+hashed char n-gram tf-idf vectors, and a row takes the category its closest
+training rows agree on. Rows it is not sure about still go to bedrock.
+"""
+
+import os
+import re
+import threading
+import numpy as np
+import pandas as pd
+from scipy import sparse
+from backend.utils.model.excel import to_pandas
+
+classifier = None
+
+NGRAMS = (3, 4)
+DIM = 1 << 18
+PRIME = np.uint64(1099511628211)
+# share of rows above which an n-gram is ignored
+MAX_DF = 0.05
+# rows scored at once, bounds the sparse score matrix
+QUERY_ROWS = 4096
+
+
+def row_text(vendor, description=None):
+    """
+    Row text.
+
+    Text a row is matched on, lowercased with punctuation and long numbers
+    removed.
+    """
+    text = str(vendor)
+    if isinstance(description, str):
+        text += " " + description
+    text = re.sub(r"\b\d{3,}\b", "", text.lower())
+    return " ".join(re.sub(r"[^a-z0-9]", " ", text).split())
+
+
+def hash_features(texts, dim=DIM):
+    """
+    Hash features.
+
+    Counts of the hashed char n-grams of every text, as a csr matrix. The
+    hashes of all texts are computed together with numpy.
+    """
+    encoded = [f" {text} ".encode("utf-8") for text in texts]
+    lengths = np.fromiter(map(len, encoded), dtype=np.int64, count=len(encoded))
+    starts = np.concatenate(([0], np.cumsum(lengths)[:-1])).astype(np.int64)
+    data = np.frombuffer(b"".join(encoded), dtype=np.uint8).astype(np.uint64)
+    rows = []
+    cols = []
+    for n in NGRAMS:
+        count = len(data) - n + 1
+        if count <= 0:
+            continue
+        hashes = np.zeros(count, dtype=np.uint64)
+        for k in range(n):
+            hashes = hashes * PRIME + data[k : k + count]
+        positions = np.arange(count)
+        owner = np.searchsorted(starts, positions, side="right") - 1
+        # drop n-grams that run into the next text
+        inside = positions + n <= starts[owner] + lengths[owner]
+        rows.append(owner[inside])
+        cols.append((hashes[inside] % np.uint64(dim)).astype(np.int64))
+    rows = np.concatenate(rows) if rows else np.zeros(0, dtype=np.int64)
+    cols = np.concatenate(cols) if cols else np.zeros(0, dtype=np.int64)
+    counts = sparse.csr_matrix(
+        (np.ones(len(rows), dtype=np.float32), (rows, cols)),
+        shape=(len(texts), dim),
+    )
+    counts.sum_duplicates()
+    return counts
+
+
+def normalize_rows(matrix):
+    """
+    Normalize rows.
+
+    Scales every row to unit length, so dot products are cosines.
+    """
+    norms = np.sqrt(np.asarray(matrix.multiply(matrix).sum(axis=1)).ravel())
+    norms[norms == 0] = 1
+    return sparse.diags(1 / norms).dot(matrix).tocsr()
+
+
+def top_neighbours(scores, k):
+    """
+    Top neighbours.
+
+    The k best scores of every row of a csr matrix and their columns, best
+    first, taking the row maximum k times instead of sorting. Missing
+    neighbours have column -1 and score 0.
+    """
+    count = scores.shape[0]
+    sims = np.zeros((count, k), dtype=np.float32)
+    neighbours = np.full((count, k), -1)
+    data = scores.data.astype(np.float32)
+    if len(data) == 0:
+        return sims, neighbours
+    owner = np.repeat(np.arange(count), np.diff(scores.indptr))
+    filled = np.diff(scores.indptr) > 0
+    # empty rows have no segment, reduceat only sees the others
+    starts = scores.indptr[:-1][filled]
+    best = np.zeros(count, dtype=np.float32)
+    for j in range(k):
+        best[filled] = np.maximum.reduceat(data, starts)
+        hits = np.flatnonzero((data == best[owner]) & (data > 0))
+        if len(hits) == 0:
+            break
+        rows, first = np.unique(owner[hits], return_index=True)
+        picked = hits[first]
+        sims[rows, j] = data[picked]
+        neighbours[rows, j] = scores.indices[picked]
+        data[picked] = 0
+    return sims, neighbours
+
+
+class NearestCategories:
+    """
+    Nearest categories.
+
+    k nearest neighbour classifier on tf-idf vectors.
+    """
+
+    def __init__(self, vectors, idf, labels, names, k=5):
+        """
+        Init function.
+
+        vectors are the normalized training rows, labels index into names.
+        """
+        self.vectors = vectors
+        self.vectors_t = vectors.T.tocsr()
+        self.idf = idf
+        self.labels = labels
+        self.names = names
+        self.k = k
+
+    @classmethod
+    def fit(cls, texts, categories, k=5):
+        """
+        Fit method.
+
+        Builds the classifier from texts and their categories. Repeated
+        pairs of text and category are kept once.
+        """
+        pairs = pd.DataFrame({"text": texts, "category": categories})
+        pairs = pairs[pairs["text"] != ""].drop_duplicates()
+        names, labels = np.unique(pairs["category"].to_numpy(str), return_inverse=True)
+        counts = hash_features(pairs["text"].tolist())
+        df = np.bincount(counts.indices, minlength=counts.shape[1])
+        idf = (np.log((1 + counts.shape[0]) / (1 + df)) + 1).astype(np.float32)
+        # n-grams most rows share say little and make every row a neighbour
+        idf[df > counts.shape[0] * MAX_DF] = 0
+        return cls(cls.weigh(counts, idf), idf, labels, names, k)
+
+    @staticmethod
+    def weigh(counts, idf):
+        """
+        Weigh method.
+
+        Sublinear tf times idf, normalized.
+        """
+        counts = counts.copy()
+        counts.data = 1 + np.log(counts.data)
+        weighed = counts.multiply(idf).tocsr()
+        weighed.eliminate_zeros()
+        return normalize_rows(weighed)
+
+    def predict(self, texts):
+        """
+        Predict method.
+
+        Gives the category and confidence of every text. Confidence is the
+        share of the neighbours' similarity behind the category times the
+        similarity of its closest row, so 1 is an exact match nobody
+        disagrees with.
+        """
+        names = np.empty(len(texts), dtype=object)
+        confidence = np.zeros(len(texts), dtype=np.float32)
+        if len(texts) == 0 or self.vectors.shape[0] == 0:
+            return names.tolist(), confidence
+        queries = self.weigh(hash_features(texts), self.idf)
+        for start in range(0, len(texts), QUERY_ROWS):
+            scores = queries[start : start + QUERY_ROWS].dot(self.vectors_t).tocsr()
+            count = scores.shape[0]
+            sims, neighbours = top_neighbours(scores, self.k)
+            labels = np.where(neighbours >= 0, self.labels[neighbours], -1)
+            same = labels[:, :, None] == labels[:, None, :]
+            votes = (same * sims[:, None, :]).sum(axis=2)
+            best = votes.argmax(axis=1)
+            rows = np.arange(count)
+            total = sims.sum(axis=1)
+            total[total == 0] = 1
+            closest = (same[rows, best] * sims).max(axis=1)
+            found = labels[rows, best]
+            end = start + count
+            confidence[start:end] = np.where(
+                found >= 0, votes[rows, best] / total * closest, 0
+            )
+            names[start:end] = np.where(found >= 0, self.names[found], None)
+        return names.tolist(), confidence
+
+    def save(self, path):
+        """
+        Save method.
+
+        Writes the classifier to an npz file.
+        """
+        np.savez_compressed(
+            path,
+            data=self.vectors.data,
+            indices=self.vectors.indices,
+            indptr=self.vectors.indptr,
+            shape=np.array(self.vectors.shape),
+            idf=self.idf,
+            labels=self.labels,
+            names=self.names.astype(str),
+            k=np.array(self.k),
+        )
+
+    @classmethod
+    def load(cls, path):
+        """
+        Load method.
+
+        Reads a classifier written by save.
+        """
+        with np.load(path, allow_pickle=False) as f:
+            vectors = sparse.csr_matrix(
+                (f["data"], f["indices"], f["indptr"]), shape=tuple(f["shape"])
+            )
+            return cls(vectors, f["idf"], f["labels"], f["names"], int(f["k"]))
+
+
+def spreadsheet_rows(paths):
+    """
+    Spreadsheet rows.
+
+    Texts and categories of labeled spreadsheets, read with to_pandas.
+    """
+    texts = []
+    categories = []
+    for path in paths:
+        df = to_pandas(path)
+        texts += [
+            row_text(vendor, description)
+            for vendor, description in zip(df["vendor"], df["description"])
+        ]
+        categories += df["category"].tolist()
+    return texts, categories
+
+
+class LocalResolver:
+    """
+    Local resolver.
+
+    Resolves the rows of an upload the classifier is confident about.
+    """
+
+    def __init__(self, model, vendor_column, description_column, min_confidence):
+        """
+        Init function.
+
+        Rows below min_confidence are left for bedrock.
+        """
+        self.model = model
+        self.vendor_column = vendor_column
+        self.description_column = description_column
+        self.min_confidence = min_confidence
+        self.lock = threading.Lock()
+        self.rows = 0
+        self.hits = 0
+
+    def resolve(self, df, rows=None):
+        """
+        Resolve method.
+
+        Gives the category of every row of df, None where the classifier is
+        not sure or the row has no vendor. Only rows in rows are looked at.
+        """
+        res = [None] * len(df)
+        if self.vendor_column not in df.columns:
+            return res
+        if rows is None:
+            rows = range(len(df))
+        vendors = df[self.vendor_column].tolist()
+        if self.description_column in df.columns:
+            descriptions = df[self.description_column].tolist()
+        else:
+            descriptions = [None] * len(df)
+        wanted = [i for i in rows if isinstance(vendors[i], str) and vendors[i].strip()]
+        texts = [row_text(vendors[i], descriptions[i]) for i in wanted]
+        names, confidence = self.model.predict(texts)
+        for i, name, sure in zip(wanted, names, confidence):
+            if sure >= self.min_confidence:
+                res[i] = name
+        with self.lock:
+            self.rows += len(rows)
+            self.hits += sum(category is not None for category in res)
+        return res
+
+    def metrics(self):
+        """
+        Metrics method.
+
+        Rows looked at and rows resolved.
+        """
+        with self.lock:
+            return {
+                "rows": self.rows,
+                "hits": self.hits,
+                "hit_rate": self.hits / self.rows if self.rows else 0.0,
+            }
+
+
+def get_classifier():
+    """
+    Get classifier.
+
+    Loads the classifier at CLASSIFIER_PATH on first use. Gives None when it
+    is not set.
+    """
+    global classifier
+    path = os.environ.get("CLASSIFIER_PATH")
+    if not path:
+        return None
+    if classifier is None:
+        classifier = LocalResolver(
+            NearestCategories.load(path),
+            os.environ.get("CATEGORY_VENDOR_COLUMN", "Original Vendor"),
+            os.environ.get("CATEGORY_DESCRIPTION_COLUMN", "GL Account Description"),
+            float(os.environ.get("CLASSIFIER_MIN_CONFIDENCE", "0.8")),
+        )
+    return classifier
@@ -23,7 +23,8 @@ def to_pandas(excel):
         lambda row: np.array(row.astype(int)), axis=1)
     df = df.rename(columns={'Original Vendor': 'vendor',
                             'GL Account Description': 'description',
-                            'Vendor Mapping': 'mapping'})
-    df = df[["vendor", "description", "mapping"]]
+                            'Vendor Mapping': 'mapping',
+                            'Final Mapping': 'category'})
+    df = df[["vendor", "description", "mapping", "category"]]
     df = df.assign(label=label)
     return df
@@ -1,29 +1,548 @@
 """
 Model file.
 
-Runs the model and gives back results.
+Runs the model and gives back results. An engine takes a prompt input at
+input/<name> and leaves its output in bedrock batch format at
+output/<job>/<name>.out, so the rest of the backend does not care which one
+ran it.
 """
 
-import shutil
+import io
 import os
+import json
+import time
+import uuid
+import hashlib
+import threading
+from abc import ABC, abstractmethod
+from concurrent.futures import ThreadPoolExecutor
+from backend.types.errors import BedrockError
+from backend.utils.batch import (
+    LOCAL_JOB_PREFIX,
+    ONDEMAND_JOB_PREFIX,
+    create_batch_job,
+    output_key,
+)
+from backend.utils.ratelimit import TokenBucket, backoff_delay
+from backend.utils.db.multipart import MultipartWriter, new_multipart_state
+from backend.utils.db.prompts import packed_rows
 
+engine = None
 
-def copy_file(source_file_path, destination_file_path):
+# lines answered at once by the local engine
+LOCAL_BATCH_LINES = 1000
+# invoke_model errors worth another try
+RETRY_CODES = {
+    "ThrottlingException",
+    "ServiceUnavailableException",
+    "ModelTimeoutException",
+    "ModelNotReadyException",
+    "InternalServerException",
+}
+
+
+def prompt_text(model_input):
+    """
+    Prompt text.
+
+    The text of the user message of a model input.
+    """
+    return model_input["messages"][0]["content"][0]["text"]
+
+
+def prompt_fields(text):
+    """
+    Prompt fields.
+
+    The column values of a prompt row, from the "name: value" lines of the
+    full template or the "; " separated pairs of a compact row.
+    """
+    fields = {}
+    for line in text.splitlines():
+        for part in line.split("; "):
+            name, sep, value = part.partition(": ")
+            if sep:
+                fields.setdefault(name.strip(), value.strip())
+    return fields
+
+
+def hashed_answer(categories):
+    """
+    Hashed answer.
+
+    Answers every prompt with a category picked by its hash, the same one on
+    every run.
+    """
+
+    def answer(texts):
+        return [
+            categories[
+                int.from_bytes(hashlib.blake2b(text.encode()).digest()[:8], "big")
+                % len(categories)
+            ]
+            for text in texts
+        ]
+
+    return answer
+
+
+def answer_inputs(answer, model_inputs):
+    """
+    Answer inputs.
+
+    Answers model inputs with one call to answer. Inputs of several rows
+    get every row answered, as the JSON object the prompt asks for.
+    """
+    texts = []
+    counts = []
+    for model_input in model_inputs:
+        rows = packed_rows(model_input)
+        if rows is None:
+            texts.append(prompt_text(model_input))
+            counts.append(None)
+        else:
+            texts += rows
+            counts.append(len(rows))
+    answers = iter(answer(texts))
+    res = []
+    for count in counts:
+        if count is None:
+            res.append(next(answers))
+        else:
+            res.append(json.dumps({str(n): next(answers) for n in range(1, count + 1)}))
+    return res
+
+
+def output_record(record, model_input, text, model_id):
+    """
+    Output record.
+
+    A line of a bedrock batch output for one answered record.
+    """
+    return {
+        "recordId": record,
+        "modelInput": model_input,
+        "modelOutput": {
+            "id": f"msg_local_{record}",
+            "type": "message",
+            "role": "assistant",
+            "model": model_id,
+            "content": [{"type": "text", "text": text}],
+            "stop_reason": "end_turn",
+            "stop_sequence": None,
+            "usage": {
+                "input_tokens": len(prompt_text(model_input)) // 4 + 1,
+                "output_tokens": len(text) // 4 + 1,
+            },
+        },
+    }
+
+
+def run_lines(lines, answer, model_id):
+    """
+    Run lines.
+
+    Answers the prompt lines of an input, yielding output lines in the same
+    order. Lines without a recordId get one like bedrock would.
+    """
+    batch = []
+
+    def flush():
+        texts = answer_inputs(answer, [model_input for _, model_input in batch])
+        for (record, model_input), text in zip(batch, texts):
+            yield json.dumps(output_record(record, model_input, text, model_id))
+            yield "\n"
+        batch.clear()
+
+    number = 0
+    for line in lines:
+        if isinstance(line, bytes):
+            line = line.decode("utf-8")
+        if line.strip() == "":
+            continue
+        json_line = json.loads(line)
+        record = json_line.get("recordId") or f"{number:011d}"
+        batch.append((record, json_line["modelInput"]))
+        number += 1
+        if len(batch) == LOCAL_BATCH_LINES:
+            yield from flush()
+    yield from flush()
+
+
+class InferenceEngine(ABC):
+    """
+    Inference engine.
+
+    Runs the prompts of an input file and gives back the job that holds the
+    output. Job statuses are read with batch.get_batch_job.
+    """
+
+    @abstractmethod
+    def submit(self, input_name):
+        """
+        Submit method.
+
+        Starts running input/<input_name>, giving back the jobid.
+        """
+
+    def stop(self, jobid):
+        """
+        Stop method.
+
+        Stops a job that is still running. Jobs that are done by the time
+        submit returns have nothing to stop.
+        """
+
+
+class BedrockBatchEngine(InferenceEngine):
+    """
+    Bedrock batch engine.
+
+    Runs inputs as bedrock batch inference jobs.
+    """
+
+    def __init__(self, bedrock_client, bucket):
+        """
+        Init function.
+
+        Inputs and outputs sit in bucket.
+        """
+        self.bedrock_client = bedrock_client
+        self.bucket = bucket
+
+    def submit(self, input_name):
+        """
+        Submit method.
+
+        Creates the batch job.
+        """
+        return create_batch_job(
+            f"s3://{self.bucket}/input/{input_name}",
+            f"s3://{self.bucket}/output/",
+            self.bedrock_client,
+        )
+
+    def stop(self, jobid):
+        """
+        Stop method.
+
+        Stops the batch job.
+        """
+        try:
+            self.bedrock_client.stop_model_invocation_job(jobIdentifier=jobid)
+        except Exception as e:
+            raise BedrockError(str(e))
+
+
+class LocalEngine(InferenceEngine):
+    """
+    Local engine.
+
+    Answers inputs in process without any network call to a model, writing
+    the same output bedrock would. Jobs are done by the time submit returns.
+    """
+
+    def __init__(self, s3_client, bucket, answer, model_id):
+        """
+        Init function.
+
+        answer takes a list of prompt texts and gives back their answers.
+        """
+        self.s3_client = s3_client
+        self.bucket = bucket
+        self.answer = answer
+        self.model_id = model_id
+
+    def submit(self, input_name):
+        """
+        Submit method.
+
+        Streams the input through the answer function into its output.
+        """
+        jobid = f"{LOCAL_JOB_PREFIX}{uuid.uuid4().hex}"
+        writer = MultipartWriter(
+            new_multipart_state(),
+            self.bucket,
+            output_key(jobid, input_name),
+            self.s3_client,
+        )
+        try:
+            body = self.s3_client.get_object(
+                Bucket=self.bucket, Key=f"input/{input_name}"
+            )["Body"]
+            lines = body.iter_lines(chunk_size=1024 * 1024)
+            batch = []
+            for part in run_lines(lines, self.answer, self.model_id):
+                batch.append(part)
+                if len(batch) == 2 * LOCAL_BATCH_LINES:
+                    writer.write(batch)
+                    batch = []
+            writer.write(batch)
+            writer.close()
+        except Exception as e:
+            writer.abort()
+            raise BedrockError(str(e))
+        return jobid
+
+
+class OnDemandEngine(InferenceEngine):
+    """
+    On demand engine.
+
+    Runs the prompts of small inputs as concurrent invoke_model calls, so
+    they are done in seconds instead of waiting on a batch job to be
+    scheduled. Calls share a token bucket and are retried with backoff when
+    throttled.
+    """
+
+    def __init__(
+        self,
+        runtime_client,
+        s3_client,
+        bucket,
+        model_id,
+        max_rows,
+        workers,
+        limiter,
+        retries=5,
+    ):
+        """
+        Init function.
+
+        Inputs of up to max_rows prompts are run on workers threads, taking
+        a token from limiter for every call. Throttled calls are tried again
+        up to retries times.
+        """
+        self.runtime_client = runtime_client
+        self.s3_client = s3_client
+        self.bucket = bucket
+        self.model_id = model_id
+        self.max_rows = max_rows
+        self.workers = workers
+        self.limiter = limiter
+        self.retries = retries
+        self.lock = threading.Lock()
+        self.calls = 0
+        self.retried = 0
+        self.failed = 0
+
+    def accepts(self, rows):
+        """
+        Accepts method.
+
+        Whether an input of rows prompts runs on demand.
+        """
+        return 0 < rows <= self.max_rows
+
+    def invoke(self, record, model_input):
+        """
+        Invoke method.
+
+        Runs one prompt and gives back its output line, or an error line
+        like bedrock batch writes once the retries are used up.
+        """
+        attempt = 0
+        while True:
+            self.limiter.take()
+            with self.lock:
+                self.calls += 1
+            try:
+                response = self.runtime_client.invoke_model(
+                    modelId=self.model_id,
+                    body=json.dumps(model_input),
+                    contentType="application/json",
+                    accept="application/json",
+                )
+                output = json.loads(response["body"].read())
+                return {
+                    "recordId": record,
+                    "modelInput": model_input,
+                    "modelOutput": output,
+                }
+            except Exception as e:
+                code = getattr(e, "response", {}).get("Error", {}).get("Code")
+                if code in RETRY_CODES and attempt < self.retries:
+                    with self.lock:
+                        self.retried += 1
+                    time.sleep(backoff_delay(attempt, 0.25, 8))
+                    attempt += 1
+                    continue
+                with self.lock:
+                    self.failed += 1
+                return {
+                    "recordId": record,
+                    "modelInput": model_input,
+                    "error": {"errorCode": code, "errorMessage": str(e)},
+                }
+
+    def submit(self, input_name):
+        """
+        Submit method.
+
+        Runs every prompt of the input and writes their output lines in
+        input order.
+        """
+        jobid = f"{ONDEMAND_JOB_PREFIX}{uuid.uuid4().hex}"
+        try:
+            body = self.s3_client.get_object(
+                Bucket=self.bucket, Key=f"input/{input_name}"
+            )["Body"]
+            prompts = []
+            for line in body.iter_lines():
+                if line.strip() == "":
+                    continue
+                json_line = json.loads(line)
+                record = json_line.get("recordId") or f"{len(prompts):011d}"
+                prompts.append((record, json_line["modelInput"]))
+            with ThreadPoolExecutor(max_workers=self.workers) as pool:
+                lines = list(pool.map(lambda prompt: self.invoke(*prompt), prompts))
+            self.s3_client.put_object(
+                Bucket=self.bucket,
+                Key=output_key(jobid, input_name),
+                Body="".join(json.dumps(line) + "\n" for line in lines),
+            )
+        except Exception as e:
+            raise BedrockError(str(e))
+        return jobid
+
+    def metrics(self):
+        """
+        Metrics method.
+
+        Calls made, retried and failed, and seconds spent waiting on the
+        bucket.
+        """
+        with self.lock:
+            return {
+                "calls": self.calls,
+                "retried": self.retried,
+                "failed": self.failed,
+                "waited": self.limiter.waited,
+            }
+
+
+class LocalRuntime:
+    """
+    Local runtime.
+
+    Stands in for the bedrock runtime client, answering invoke_model with
+    the local engine's answer function.
+    """
+
+    def __init__(self, answer, model_id=None):
+        """
+        Init function.
+
+        answer takes a list of prompt texts and gives back their answers.
+        """
+        self.answer = answer
+        self.model_id = model_id
+
+    def invoke_model(self, modelId, body, **kwargs):
+        """
+        Invoke model.
+
+        Answers one prompt the way bedrock would.
+        """
+        model_input = json.loads(body)
+        text = answer_inputs(self.answer, [model_input])[0]
+        output = output_record("", model_input, text, modelId)["modelOutput"]
+        return {"body": io.BytesIO(json.dumps(output).encode("utf-8"))}
+
+
+def local_answer():
+    """
+    Local answer.
+
+    The answer function of the local engine. Uses the local classifier when
+    one is loaded and LOCAL_MODEL_CATEGORIES otherwise. The classifier is
+    given the same vendor and description text it was trained on, taken
+    back out of the prompt.
+    """
+    # imported here, the classifier pulls in scipy
+    from backend.utils.model.classifier import get_classifier, row_text
+
+    categories = os.environ.get("LOCAL_MODEL_CATEGORIES", "Uncategorized").split(",")
+    fallback = hashed_answer([category.strip() for category in categories])
+    classifier = get_classifier()
+    if classifier is None:
+        return fallback
+
+    def answer(texts):
+        rows = []
+        for i, text in enumerate(texts):
+            fields = prompt_fields(text)
+            vendor = fields.get(classifier.vendor_column)
+            if vendor:
+                rows.append(
+                    (i, row_text(vendor, fields.get(classifier.description_column)))
+                )
+        res = fallback(texts)
+        if rows:
+            names, _ = classifier.model.predict([row for _, row in rows])
+            for (i, _), name in zip(rows, names):
+                res[i] = name or res[i]
+        return res
+
+    return answer
+
+
+def create_engine(name, s3_client, bedrock_client):
+    """
+    Create engine.
+
+    Builds the engine called name, bedrock or local.
+    """
+    bucket = os.environ.get("AWS_S3_UPLOAD_NAME")
+    if name == "bedrock":
+        return BedrockBatchEngine(bedrock_client, bucket)
+    if name == "local":
+        return LocalEngine(
+            s3_client, bucket, local_answer(), os.environ.get("AWS_MODEL_ID")
+        )
+    raise ValueError(f"unknown model engine {name}")
+
+
+def get_engine(s3_client, bedrock_client):
+    """
+    Get engine.
+
+    Creates the engine picked by MODEL_ENGINE on first use.
+    """
+    global engine
+    if engine is None:
+        engine = create_engine(
+            os.environ.get("MODEL_ENGINE", "bedrock"), s3_client, bedrock_client
+        )
+    return engine
+
+
+def create_ondemand(s3_client, runtime_client):
     """
-    Copy file.
+    Create on demand.
 
-    Copy file from one path to another
+    Builds the on demand engine from the env, running on the local runtime
+    when ONDEMAND_RUNTIME is local. Gives None when ONDEMAND_MAX_ROWS is 0.
     """
-    try:
-        shutil.copy(source_file_path, destination_file_path)
-        print(f"File copied from {source_file_path}"
-              " to {destination_file_path}")
-    except FileNotFoundError:
-        print("Source file not found.")
-    except PermissionError:
-        print("Permission error. Make sure you have appropriate permissions.")
-    except Exception as e:
-        print(f"An error occurred: {str(e)}")
+    max_rows = int(os.environ.get("ONDEMAND_MAX_ROWS", "50"))
+    if max_rows <= 0:
+        return None
+    model_id = os.environ.get("AWS_MODEL_ID")
+    if os.environ.get("ONDEMAND_RUNTIME", "bedrock") == "local":
+        runtime_client = LocalRuntime(local_answer(), model_id)
+    return OnDemandEngine(
+        runtime_client,
+        s3_client,
+        os.environ.get("AWS_S3_UPLOAD_NAME"),
+        model_id,
+        max_rows,
+        int(os.environ.get("ONDEMAND_WORKERS", "8")),
+        TokenBucket(
+            float(os.environ.get("ONDEMAND_RATE", "5")),
+            float(os.environ.get("ONDEMAND_BURST", "10")),
+        ),
+        int(os.environ.get("ONDEMAND_RETRIES", "5")),
+    )
 
 
 def model_handler(fileid):
@@ -31,7 +550,12 @@ def model_handler(fileid):
     Model Handler.
 
     Takes the file id, and runs the model on the file.
-    Overall handler for all the model's processes.
+    Overall handler for all the model's processes. Runs the local engine on
+    the prompts at MODEL_DOWNLOAD_PATH and writes the output to
+    MODEL_UPLOAD_PATH.
     """
-    copy_file(os.path.join(os.enivorn.get('MODEL_DOWNLOAD_PATH'), fileid),
-              os.path.join(os.enivorn.get('MODEL_UPLOAD_PATH'), fileid))
+    with open(os.path.join(os.environ.get("MODEL_DOWNLOAD_PATH"), fileid)) as f:
+        with open(
+            os.path.join(os.environ.get("MODEL_UPLOAD_PATH"), fileid), "w"
+        ) as out:
+            out.writelines(run_lines(f, local_answer(), os.environ.get("AWS_MODEL_ID")))
@@ -0,0 +1,61 @@
+"""
+Rate limiting.
+
+Token bucket shared by the threads calling a rate limited api, and the
+backoff used between retries of a call that was throttled.
+"""
+
+import time
+import random
+import threading
+
+
+class TokenBucket:
+    """
+    Token bucket.
+
+    Lets rate calls through per second on average, with bursts of up to
+    burst calls.
+    """
+
+    def __init__(self, rate, burst):
+        """
+        Init function.
+
+        The bucket starts full.
+        """
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+        self.waited = 0.0
+
+    def take(self, tokens=1):
+        """
+        Take method.
+
+        Blocks until tokens are available and takes them.
+        """
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(
+                    self.burst, self.tokens + (now - self.updated) * self.rate
+                )
+                self.updated = now
+                if self.tokens >= tokens:
+                    self.tokens -= tokens
+                    return
+                wait = (tokens - self.tokens) / self.rate
+                self.waited += wait
+            time.sleep(wait)
+
+
+def backoff_delay(attempt, base, cap):
+    """
+    Backoff delay.
+
+    Seconds to wait before retry attempt, exponential with full jitter.
+    """
+    return random.uniform(0, min(cap, base * 2**attempt))
@@ -0,0 +1,186 @@
+"""
+Sharding.
+
+Splits the prompts of a large file into shards that run as parallel bedrock
+batch jobs, so one file is not held to the throughput and record limits of a
+single job. Every line keeps the recordId of its row, which puts the shard
+outputs back in order when they are read.
+"""
+
+import os
+import math
+from concurrent.futures import ThreadPoolExecutor
+from backend.types.errors import BedrockError, DBError
+from backend.utils.db.multipart import MultipartWriter, new_multipart_state
+from backend.utils.db.uploader import record_id
+
+
+def input_size(fileid, bucket, s3_client):
+    """
+    Input size.
+
+    Bytes of the prompts of a file.
+    """
+    try:
+        response = s3_client.head_object(Bucket=bucket, Key=f"input/{fileid}.jsonl")
+    except Exception as e:
+        raise DBError(str(e))
+    return response["ContentLength"]
+
+
+def input_rows(fileid, bucket, s3_client, limit):
+    """
+    Input rows.
+
+    Number of prompts of a file, counting no further than limit + 1 so a
+    large file is not read through.
+    """
+    rows = 0
+    try:
+        body = s3_client.get_object(Bucket=bucket, Key=f"input/{fileid}.jsonl")["Body"]
+        for line in body.iter_lines(chunk_size=64 * 1024):
+            if line.strip():
+                rows += 1
+                if rows > limit:
+                    break
+        body.close()
+    except Exception as e:
+        raise DBError(str(e))
+    return rows
+
+
+def shard_count(size, shard_bytes, max_shards):
+    """
+    Shard count.
+
+    Number of shards a file of size bytes is split into.
+    """
+    if shard_bytes <= 0:
+        return 1
+    return max(1, min(max_shards, math.ceil(size / shard_bytes)))
+
+
+def with_record_id(line, fileid, row):
+    """
+    With record id.
+
+    Gives a prompt line that carries its recordId, adding it to lines
+    uploaded before prompts had one.
+    """
+    if line.startswith(b'{"recordId"'):
+        return line
+    return b'{"recordId": "' + record_id(fileid, row).encode() + b'", ' + line[1:]
+
+
+def shard_input(fileid, bucket, s3_client, count, size, max_rows=None, max_shards=None):
+    """
+    Shard input.
+
+    Streams input/{fileid}.jsonl into count shards of about the same size,
+    starting a new one early when a shard reaches max_rows. There are never
+    more than max_shards shards, the last one takes every row left once
+    they are all open. Gives back the shard input names.
+    """
+    target = math.ceil(size / count)
+    max_shards = max(max_shards or count, count)
+    names = []
+    writer = None
+    try:
+        body = s3_client.get_object(Bucket=bucket, Key=f"input/{fileid}.jsonl")["Body"]
+        row = 0
+        written = 0
+        rows = 0
+        for line in body.iter_lines(chunk_size=1024 * 1024):
+            if not line.strip():
+                continue
+            full = written >= target or rows == max_rows
+            if writer is None or (full and len(names) < max_shards):
+                if writer is not None:
+                    writer.close()
+                names.append(f"{fileid}-{len(names)}.jsonl")
+                writer = MultipartWriter(
+                    new_multipart_state(), bucket, f"input/{names[-1]}", s3_client
+                )
+                written = 0
+                rows = 0
+            data = with_record_id(line, fileid, row) + b"\n"
+            writer.write_bytes(data)
+            written += len(data)
+            rows += 1
+            row += 1
+            if max_rows and rows == max_rows + 1:
+                print(f"{fileid} has more rows than {max_shards} shards can hold")
+        if writer is not None:
+            writer.close()
+    except Exception as e:
+        if writer is not None:
+            writer.abort()
+        raise DBError(str(e))
+    return names
+
+
+def delete_shards(fileid, bucket, s3_client):
+    """
+    Delete shards.
+
+    Deletes every shard input of a file.
+    """
+    request = {"Bucket": bucket, "Prefix": f"input/{fileid}-"}
+    try:
+        while True:
+            response = s3_client.list_objects_v2(**request)
+            keys = [{"Key": item["Key"]} for item in response.get("Contents", [])]
+            if keys:
+                s3_client.delete_objects(Bucket=bucket, Delete={"Objects": keys})
+            if not response.get("IsTruncated"):
+                return
+            request["ContinuationToken"] = response["NextContinuationToken"]
+    except Exception as e:
+        raise DBError(str(e))
+
+
+def shard_jobs(
+    fileid, bucket, s3_client, engine, count, size, max_rows=None, max_shards=None
+):
+    """
+    Shard jobs.
+
+    Splits a file and submits a job per shard to the engine at the same
+    time. Gives back the jobs in shard order. If any submit fails the jobs
+    already started are stopped and the shards deleted, so none are left
+    running without being recorded.
+    """
+    names = shard_input(fileid, bucket, s3_client, count, size, max_rows, max_shards)
+    jobs = []
+    error = None
+    with ThreadPoolExecutor(max_workers=len(names) or 1) as pool:
+        futures = [(pool.submit(engine.submit, name), name) for name in names]
+        for future, name in futures:
+            try:
+                jobs.append({"jobid": future.result(), "input": name})
+            except Exception as e:
+                error = e
+    if error is not None:
+        for job in jobs:
+            try:
+                engine.stop(job["jobid"])
+            except Exception as e:
+                print(e)
+        delete_shards(fileid, bucket, s3_client)
+        raise BedrockError(str(error))
+    return jobs
+
+
+def get_shard_config():
+    """
+    Get shard config.
+
+    Bytes per shard, most shards per file and most rows per shard, from the
+    env. Sharding is off when SHARD_BYTES is 0.
+    """
+    max_rows = int(os.environ.get("SHARD_MAX_ROWS", "50000"))
+    return (
+        int(os.environ.get("SHARD_BYTES", str(32 * 1024 * 1024))),
+        int(os.environ.get("SHARD_MAX_JOBS", "8")),
+        max_rows or None,
+    )
@@ -0,0 +1,218 @@
+"""
+Job watcher.
+
+Background scheduler that follows the batch jobs of every user, writes their
+status to the file table and pushes it to the owner over socketio.
+"""
+
+import os
+import json
+import time
+import threading
+from backend.types.errors import FileIDError
+from backend.utils.batch import TERMINAL_STATES, files_state, get_job_tracker
+from backend.utils.db.dynamo import (
+    finish_item_db,
+    get_item_db,
+    item_jobs,
+    scan_processing_db,
+    set_status_db,
+)
+
+
+class JobWatcher:
+    """
+    Job watcher.
+
+    Polls tracked jobs with a per job backoff, batching every job that is due
+    into one round of status lookups.
+    """
+
+    def __init__(
+        self,
+        socketio,
+        db_client,
+        bedrock_client,
+        min_interval,
+        max_interval,
+        on_processed=None,
+    ):
+        """
+        Init function.
+
+        A job is first checked after min_interval seconds, and the wait doubles
+        every time its status has not moved, up to max_interval. on_processed
+        is called with the fileid and username of every file that finishes.
+        """
+        self.socketio = socketio
+        self.db_client = db_client
+        self.bedrock_client = bedrock_client
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.on_processed = on_processed
+        self.lock = threading.Lock()
+        self.jobs = {}
+
+    def track(self, jobid, fileid, username, status="Submitted", delay=None):
+        """
+        Track method.
+
+        Starts following a job, first checked after delay seconds. A shared
+        job is followed once for all of its files.
+        """
+        if delay is None:
+            delay = self.min_interval
+        with self.lock:
+            job = self.jobs.get(jobid)
+            if job is not None:
+                job["files"][fileid] = username
+                return
+            self.jobs[jobid] = {
+                "files": {fileid: username},
+                "status": status,
+                "interval": self.min_interval,
+                "due": time.monotonic() + delay,
+            }
+
+    def seed(self):
+        """
+        Seed method.
+
+        Picks up jobs that were processing before the server started.
+        """
+        for item in scan_processing_db(self.db_client):
+            fileid = item["fileid"]["S"]
+            for job in item_jobs(item):
+                self.track(job["jobid"], fileid, item["username"]["S"], None, 0)
+
+    def due(self, now):
+        """
+        Due method.
+
+        Jobs whose next check has come.
+        """
+        with self.lock:
+            return [jobid for jobid, job in self.jobs.items() if job["due"] <= now]
+
+    def poll(self):
+        """
+        Poll method.
+
+        Checks every due job in one batch and handles the ones that moved.
+        """
+        jobids = self.due(time.monotonic())
+        if not jobids:
+            return
+        statuses = get_job_tracker().statuses(jobids, self.bedrock_client)
+        now = time.monotonic()
+        for jobid in jobids:
+            with self.lock:
+                job = self.jobs.get(jobid)
+            if job is None:
+                continue
+            status = statuses[jobid]
+            if status == job["status"]:
+                job["interval"] = min(job["interval"] * 2, self.max_interval)
+            else:
+                job["interval"] = self.min_interval
+                try:
+                    self.changed(jobid, job, status)
+                except Exception as e:
+                    # the status is kept so the next poll tries again
+                    print(e)
+                    job["due"] = now + job["interval"]
+                    continue
+                job["status"] = status
+            job["due"] = now + job["interval"]
+            if status in TERMINAL_STATES:
+                with self.lock:
+                    self.jobs.pop(jobid, None)
+
+    def changed(self, jobid, job, status):
+        """
+        Changed method.
+
+        Stores the new status of a job for every one of its files and tells
+        the owners' rooms. A file spread over several jobs waits for all of
+        them. Only the call that marks a file processed learns its answers
+        and tells its owner, jobs of one file can finish in the same poll.
+        """
+        with self.lock:
+            files = list(job["files"].items())
+        for fileid, username in files:
+            try:
+                jobs = get_item_db(fileid, username, self.db_client)["jobs"]
+            except FileIDError:
+                # deleted while its job was running
+                continue
+            statuses = get_job_tracker().statuses(
+                [other["jobid"] for other in jobs if other["jobid"] != jobid],
+                self.bedrock_client,
+            )
+            statuses[jobid] = status
+            processed = files_state(statuses.values())
+            if processed != "processed":
+                set_status_db(fileid, username, processed, self.db_client)
+            elif not finish_item_db(fileid, username, self.db_client):
+                # another job or process already saw it finish
+                continue
+            elif self.on_processed is not None:
+                try:
+                    self.on_processed(fileid, username)
+                except Exception as e:
+                    print(e)
+            self.socketio.emit(
+                "status",
+                json.dumps(
+                    {
+                        "status": True,
+                        "fileid": fileid,
+                        "processed": processed,
+                        "job_status": status,
+                        "response": 200,
+                    }
+                ),
+                to=username,
+            )
+
+    def run(self):
+        """
+        Run method.
+
+        Loop for the socketio background task.
+        """
+        try:
+            self.seed()
+        except Exception as e:
+            print(e)
+        while True:
+            try:
+                self.poll()
+            except Exception as e:
+                print(e)
+            self.socketio.sleep(1)
+
+    def metrics(self):
+        """
+        Metrics method.
+
+        Number of jobs followed.
+        """
+        with self.lock:
+            return {"jobs": len(self.jobs)}
+
+
+def create_job_watcher(socketio, db_client, bedrock_client, on_processed=None):
+    """
+    Create job watcher.
+
+    Builds a watcher from the env.
+    """
+    return JobWatcher(
+        socketio,
+        db_client,
+        bedrock_client,
+        float(os.environ.get("JOB_WATCH_MIN_INTERVAL", "30")),
+        float(os.environ.get("JOB_WATCH_MAX_INTERVAL", "600")),
+        on_processed,
+    )
@@ -41,26 +41,22 @@ const FileUpload: React.FC = () => {
         const fileData = e.target?.result as ArrayBuffer;
 
         if (fileData) {
-          const base64String = btoa(
-            new Uint8Array(fileData).reduce(
-              (data, byte) => data + String.fromCharCode(byte),
-              ""
-            )
-          );
+          // sent as a binary attachment, written at chunk_number * chunk_size
           const payload = {
             filename: file.name,
             token: user?.token,
             fileid: fileid,
             chunk_number: currentChunk,
             total_chunks: totalChunks,
-            chunk: base64String,
+            chunk_size: CHUNK_SIZE,
+            chunk: fileData,
           };
 
           socket.emit("upload", payload);
 
           currentChunk++;
 
-          if (currentChunk <= totalChunks) {
+          if (currentChunk < totalChunks) {
             setTimeout(() => {
               loadNextChunk();
             }, 100);
@@ -183,8 +183,24 @@ const Files: React.FC = () => {
   }, [socket, updateFiles, processFile, deleteFile, downloadFile]);
 
   useEffect(() => {
+    // the server pushes job status changes, refresh the list when one lands
+    socket?.on("status", (_: any) => {
+      updateFiles();
+    });
+  }, [socket, updateFiles]);
+
+  useEffect(() => {
+    // results arrive in numbered batches, keep them until the last one
+    const batches: { [fileid: string]: string[][] } = {};
     socket?.on("download", (response: any) => {
-      let data = response.data.join("\n");
+      const parts = batches[response.fileid] ?? [];
+      parts[response.sequence] = response.data;
+      batches[response.fileid] = parts;
+      if (!response.finished) {
+        return;
+      }
+      delete batches[response.fileid];
+      let data = parts.flat().join("\n");
       let blob = new Blob([data], { type: "text/plain" });
       let url = window.URL.createObjectURL(blob);
       let a = document.createElement("a");
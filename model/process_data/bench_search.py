@@ -0,0 +1,193 @@
+"""
+Search benchmark.
+
+Times add_search against a fake search server and moto's local DynamoDB,
+next to the previous row by row lookups. Needs moto installed. Run from
+model/process_data with `python bench_search.py [rows] [vendors] [429 %]`,
+the server answers that share of requests with 429.
+"""
+
+import os
+import sys
+import json
+import time
+import random
+import tempfile
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs
+import numpy as np
+import pandas as pd
+from moto import mock_aws
+
+from utils import Utils
+
+LATENCY = 0.05
+TABLE = 'search-bench'
+BUCKET = 'search-bench-data'
+
+
+class FakeSearch(BaseHTTPRequestHandler):
+    """
+    Fake search class.
+
+    Answers like the custom search api after LATENCY seconds.
+    """
+
+    protocol_version = 'HTTP/1.1'
+    calls = 0
+    connections = 0
+    throttle = 0.0
+    lock = threading.Lock()
+
+    def setup(self):
+        """
+        Setup.
+
+        Counts the connections opened.
+        """
+        with FakeSearch.lock:
+            FakeSearch.connections += 1
+        super().setup()
+
+    def do_GET(self):
+        """
+        Do get.
+
+        Gives back one result naming the query.
+        """
+        with FakeSearch.lock:
+            FakeSearch.calls += 1
+        term = parse_qs(urlparse(self.path).query).get('q', [''])[0]
+        time.sleep(LATENCY)
+        if random.random() < FakeSearch.throttle:
+            self.send_response(429)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+        body = json.dumps({
+            'searchInformation': {'totalResults': '1'},
+            'items': [{'title': term, 'snippet': f'{term} sells things'}],
+        }).encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        """
+        Log message.
+
+        Keeps the server quiet.
+        """
+
+
+def make_csv(path, rows, vendors, seed=0):
+    """
+    Make csv.
+
+    Writes a clean csv of rows drawn from vendors vendors, spelled a few
+    ways.
+    """
+    rng = np.random.default_rng(seed)
+    names = np.array([f'Vendor {i}' for i in range(vendors)])
+    suffix = np.array(['', ' LLC', ' Inc.', ' Co'])
+    df = pd.DataFrame({
+        'vendor': (names[rng.integers(0, vendors, rows)]
+                   + suffix[rng.integers(0, len(suffix), rows)]),
+        'label': 'Expense',
+    })
+    df.to_csv(path, index=False)
+
+
+def reset(db_client):
+    """
+    Reset.
+
+    Gives the search table back empty.
+    """
+    if TABLE in db_client.list_tables()['TableNames']:
+        db_client.delete_table(TableName=TABLE)
+    db_client.create_table(
+        TableName=TABLE,
+        KeySchema=[{'AttributeName': 'name', 'KeyType': 'HASH'}],
+        AttributeDefinitions=[{'AttributeName': 'name',
+                               'AttributeType': 'S'}],
+        BillingMode='PAY_PER_REQUEST')
+
+
+def by_row(utils, inf, outf):
+    """
+    By row.
+
+    The previous add_search, one lookup after another, kept for comparison.
+    """
+    df = pd.read_csv(inf)
+    df['search'] = df.apply(lambda row: utils.get_object(row['vendor']),
+                            axis=1)
+    df.to_csv(outf, index=False)
+
+
+def timed(name, function, utils, inf, outf, rows, fresh=True):
+    """
+    Timed.
+
+    Runs one add_search and prints rows/sec and searches made. fresh
+    starts from an empty table.
+    """
+    if fresh:
+        reset(utils.dynamodb_client)
+    FakeSearch.calls = 0
+    FakeSearch.connections = 0
+    db_calls = []
+    utils.dynamodb_client.meta.events.register(
+        'before-call.dynamodb', lambda **kwargs: db_calls.append(1))
+    start = time.perf_counter()
+    function(inf, outf)
+    seconds = time.perf_counter() - start
+    print(f'{name:<8} {rows} rows {seconds:7.2f}s {rows / seconds:8.0f} '
+          f'rows/s  {FakeSearch.calls} searches '
+          f'{FakeSearch.connections} connections {len(db_calls)} db calls')
+    print(f'         {utils.metrics()}')
+
+
+def main(rows, vendors, throttle=0):
+    """
+    Main.
+
+    Runs both versions over the same csv, and enrich again with the
+    search cache warm.
+    """
+    FakeSearch.throttle = throttle / 100
+    server = ThreadingHTTPServer(('127.0.0.1', 0), FakeSearch)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    with tempfile.TemporaryDirectory() as tmp, mock_aws():
+        env = os.path.join(tmp, '.env')
+        with open(env, 'w') as f:
+            f.write('AWS_API_KEY=bench\nAWS_API_SECRET=bench\n'
+                    'AWS_REGION=us-east-1\nCUSTOM_SEARCH_API_KEY=bench\n'
+                    f'SEARCH_ENGINE_ID=bench\nAWS_TABLE_NAME={TABLE}\n'
+                    f'AWS_DATA_BUCKET={BUCKET}\nSEARCH_RATE=1000\n'
+                    'SEARCH_BURST=100\nSEARCH_MAX_BACKOFF=0.2\n'
+                    'SEARCH_BREAKER_COOLDOWN=1\n'
+                    f'SEARCH_CACHE_PATH={os.path.join(tmp, "cache.db")}\n'
+                    f'SEARCH_URL=http://127.0.0.1:{server.server_port}/\n')
+        utils = Utils(env)
+        utils.s3_client.create_bucket(Bucket=BUCKET)
+        inf = os.path.join(tmp, 'clean.csv')
+        outf = os.path.join(tmp, 'search.csv')
+        make_csv(inf, rows, vendors)
+        timed('enrich', utils.add_search, utils, inf, outf, rows)
+        timed('warm', utils.add_search, utils, inf, outf, rows, False)
+        # a new run only has the sqlite cache
+        rerun = Utils(env)
+        timed('disk', rerun.add_search, rerun, inf, outf, rows, False)
+        timed('by row', lambda i, o: by_row(utils, i, o), utils, inf, outf,
+              rows)
+    server.shutdown()
+
+
+if __name__ == '__main__':
+    args = [int(i) for i in sys.argv[1:]]
+    main(*(args + [2000, 300, 0][len(args):]))
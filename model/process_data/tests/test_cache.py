@@ -0,0 +1,83 @@
+"""
+Search cache tests.
+
+Checks the in-memory LRU, the sqlite tier behind it and expiry of old
+entries. Run from model/process_data with
+`python -m unittest tests.test_cache`.
+"""
+
+import time
+import unittest
+from tempfile import TemporaryDirectory
+
+from utils.utils import SearchCache
+
+
+def item(term):
+    """
+    Item.
+
+    A search table item for term.
+    """
+    return {'content': f'about {term}', 'vendors': {term.upper()}}
+
+
+class SearchCacheTest(unittest.TestCase):
+    """
+    Search cache test.
+
+    Hits, misses and evictions.
+    """
+
+    def test_lru(self):
+        """
+        Lru.
+
+        The least recently used entry is evicted from memory.
+        """
+        cache = SearchCache(2, 3600)
+        cache.put_many({'a': item('a'), 'b': item('b')})
+        self.assertEqual(cache.get_many(['a']), {'a': item('a')})
+        cache.put_many({'c': item('c')})
+        self.assertEqual(sorted(cache.get_many(['a', 'b', 'c'])), ['a', 'c'])
+        self.assertEqual(cache.metrics(), {'hits': 3, 'disk_hits': 0,
+                                           'misses': 1, 'entries': 2})
+
+    def test_ttl(self):
+        """
+        Ttl.
+
+        Entries older than ttl are misses, in memory and on disk.
+        """
+        with TemporaryDirectory() as tmp:
+            cache = SearchCache(10, 0.05, f'{tmp}/search.db')
+            cache.put_many({'a': item('a')})
+            self.assertEqual(cache.get_many(['a']), {'a': item('a')})
+            time.sleep(0.06)
+            self.assertEqual(cache.get_many(['a']), {})
+            self.assertEqual(cache.metrics()['entries'], 0)
+
+    def test_disk(self):
+        """
+        Disk.
+
+        Entries outlive the cache in its file, which keeps only the newest
+        max_disk_entries.
+        """
+        with TemporaryDirectory() as tmp:
+            path = f'{tmp}/search.db'
+            cache = SearchCache(10, 3600, path, max_disk_entries=2)
+            cache.put_many({'a': item('a')})
+            time.sleep(0.01)
+            cache.put_many({'b': item('b'), 'c': item('c')})
+            cache.db.close()
+            cache = SearchCache(1, 3600, path)
+            self.assertEqual(cache.get_many(['a', 'b', 'c']),
+                             {'b': item('b'), 'c': item('c')})
+            self.assertEqual(cache.metrics(), {'hits': 0, 'disk_hits': 2,
+                                               'misses': 1, 'entries': 1})
+            cache.db.close()
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,118 @@
+"""
+Enrich tests.
+
+Checks vendors are grouped by cleaned name, searched once each on a pool of
+threads and merged with what the search table already has. Run from
+model/process_data with `python -m unittest tests.test_enrich`.
+"""
+
+import os
+import threading
+import unittest
+import boto3
+from moto import mock_aws
+
+from utils.utils import CircuitBreaker, SearchCache, Utils
+
+TABLE = 'search'
+
+
+class EnrichTest(unittest.TestCase):
+    """
+    Enrich test.
+
+    Enriching against moto with searches stubbed out.
+    """
+
+    def setUp(self):
+        """
+        Set up.
+
+        Creates the table and a Utils using it, cleaning vendors by lower
+        casing them and searching with search.
+        """
+        os.environ.update(AWS_DEFAULT_REGION='us-east-1',
+                          AWS_ACCESS_KEY_ID='testing',
+                          AWS_SECRET_ACCESS_KEY='testing')
+        self.aws = mock_aws()
+        self.aws.start()
+        self.client = boto3.client('dynamodb')
+        self.client.create_table(
+            TableName=TABLE,
+            KeySchema=[{'AttributeName': 'name', 'KeyType': 'HASH'}],
+            AttributeDefinitions=[{'AttributeName': 'name',
+                                   'AttributeType': 'S'}],
+            BillingMode='PAY_PER_REQUEST')
+        self.utils = Utils.__new__(Utils)
+        self.utils.env_vars = {'AWS_TABLE_NAME': TABLE}
+        self.utils.dynamodb_client = self.client
+        self.utils.token_and_stem = lambda vendor: vendor.lower()
+        self.utils.get_search = self.search
+        self.utils.search_workers = 4
+        self.utils.search_breaker = CircuitBreaker(5, 0)
+        self.utils.search_cache = SearchCache(100, 3600)
+        self.utils.metrics_lock = threading.Lock()
+        self.utils.search_metrics = {'unresolved': 0}
+        self.searched = []
+        self.threads = set()
+        self.lock = threading.Lock()
+        # both searches must be running at once to get past it
+        self.barrier = threading.Barrier(2, timeout=5)
+
+    def tearDown(self):
+        """
+        Tear down.
+
+        Stops moto.
+        """
+        self.aws.stop()
+
+    def search(self, vendor):
+        """
+        Search.
+
+        Waits for the other search of a new vendor, fails for Broken.
+        """
+        with self.lock:
+            self.searched.append(vendor)
+            self.threads.add(threading.get_ident())
+        if vendor == 'Broken':
+            return None
+        self.barrier.wait()
+        return f'about {vendor.lower()}'
+
+    def test_grouped_and_concurrent(self):
+        """
+        Grouped and concurrent.
+
+        Spellings of a name share one search, names already in the table
+        are not searched but get the new spellings, and failed searches are
+        tried once more before coming back as None.
+        """
+        self.utils.write_tables([('beta', {'Beta Co'}, 'about beta')])
+        vendors = ['Acme', 'ACME', 'Beta', 'Gamma', 'Broken']
+        res = self.utils.enrich(vendors)
+        self.assertEqual(res, {'Acme': 'about acme', 'ACME': 'about acme',
+                               'Beta': 'about beta', 'Gamma': 'about gamma',
+                               'Broken': None})
+        self.assertEqual(sorted(self.searched),
+                         ['Acme', 'Broken', 'Broken', 'Gamma'])
+        self.assertGreater(len(self.threads), 1)
+        self.assertEqual(self.utils.search_metrics['unresolved'], 1)
+        items, failed = self.utils.get_tables(['acme', 'beta', 'gamma',
+                                               'broken'])
+        self.assertEqual(failed, [])
+        self.assertEqual(items, {
+            'acme': {'content': 'about acme', 'vendors': {'Acme', 'ACME'}},
+            'beta': {'content': 'about beta', 'vendors': {'Beta', 'Beta Co'}},
+            'gamma': {'content': 'about gamma', 'vendors': {'Gamma'}}})
+        # the second run is served from the search cache
+        self.searched = []
+        self.client.delete_table(TableName=TABLE)
+        res = self.utils.enrich(['Acme', 'Beta'])
+        self.assertEqual(res, {'Acme': 'about acme', 'Beta': 'about beta'})
+        self.assertEqual(self.searched, [])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,238 @@
+"""
+Search tests.
+
+Checks the rate limiter, the circuit breaker and retries of custom search
+calls, without calling the api. Run from model/process_data with
+`python -m unittest tests.test_search`.
+"""
+
+import threading
+import time
+import unittest
+from tempfile import TemporaryDirectory
+from unittest import mock
+
+from utils import utils
+from utils.utils import CircuitBreaker, TokenBucket, Utils, search_client
+
+
+class Response:
+    """
+    Response.
+
+    A canned search response.
+    """
+
+    def __init__(self, status_code, data=None, headers=None):
+        """
+        Init function.
+
+        Keeps the status, body and headers.
+        """
+        self.status_code = status_code
+        self.data = data
+        self.headers = headers or {}
+
+    def json(self):
+        """
+        Json.
+
+        The body.
+        """
+        return self.data
+
+
+class FakeHttp:
+    """
+    Fake http.
+
+    Gives back responses in order and counts calls.
+    """
+
+    def __init__(self, responses):
+        """
+        Init function.
+
+        Keeps the responses.
+        """
+        self.responses = list(responses)
+        self.calls = 0
+
+    def get(self, url, timeout):
+        """
+        Get.
+
+        The next response.
+        """
+        self.calls += 1
+        return self.responses.pop(0)
+
+
+class TokenBucketTest(unittest.TestCase):
+    """
+    Token bucket test.
+
+    Bursts and waits of the limiter.
+    """
+
+    def test_burst_then_rate(self):
+        """
+        Burst then rate.
+
+        A full bucket lets burst calls through at once, then one call per
+        1 / rate seconds.
+        """
+        bucket = TokenBucket(100, 3)
+        start = time.monotonic()
+        for _ in range(3):
+            bucket.take()
+        self.assertEqual(bucket.waited, 0)
+        for _ in range(5):
+            bucket.take()
+        self.assertGreaterEqual(time.monotonic() - start, 0.04)
+        self.assertGreater(bucket.waited, 0.03)
+
+    def test_shared_file(self):
+        """
+        Shared file.
+
+        Buckets with the same path share their tokens.
+        """
+        with TemporaryDirectory() as tmp:
+            path = f'{tmp}/bucket'
+            first = TokenBucket(0.001, 2, path)
+            second = TokenBucket(0.001, 2, path)
+            self.assertEqual(first.take_shared(), 0)
+            self.assertEqual(second.take_shared(), 0)
+            self.assertGreater(first.take_shared(), 100)
+            self.assertEqual(TokenBucket(0.001, 2, f'{tmp}/other')
+                             .take_shared(), 0)
+
+
+class CircuitBreakerTest(unittest.TestCase):
+    """
+    Circuit breaker test.
+
+    Opening, cooling down and closing.
+    """
+
+    def test_opens_and_closes(self):
+        """
+        Opens and closes.
+
+        The breaker opens after failures failed calls in a row, lets one
+        trial call through after the cooldown, opens again when it fails and
+        closes when it succeeds.
+        """
+        breaker = CircuitBreaker(2, 0.05)
+        breaker.failure()
+        breaker.success()
+        breaker.failure()
+        self.assertTrue(breaker.allow())
+        breaker.failure()
+        self.assertFalse(breaker.allow())
+        self.assertEqual(breaker.opens, 1)
+        breaker.wait()
+        self.assertTrue(breaker.allow())
+        self.assertFalse(breaker.allow())
+        breaker.failure()
+        self.assertEqual(breaker.opens, 2)
+        self.assertFalse(breaker.allow())
+        breaker.wait()
+        self.assertTrue(breaker.allow())
+        breaker.success()
+        self.assertTrue(breaker.allow())
+        self.assertTrue(breaker.allow())
+
+
+class SendRequestTest(unittest.TestCase):
+    """
+    Send request test.
+
+    Retries of search calls.
+    """
+
+    def setUp(self):
+        """
+        Set up.
+
+        A Utils with only what searching needs, and no sleeping.
+        """
+        self.utils = Utils.__new__(Utils)
+        self.utils.max_retries = 4
+        self.utils.default_backoff = 3
+        self.utils.max_backoff = 60
+        self.utils.search_timeout = 1
+        self.utils.search_limiter = TokenBucket(1000, 1000)
+        self.utils.search_breaker = CircuitBreaker(3, 60)
+        self.utils.metrics_lock = threading.Lock()
+        self.utils.search_metrics = {'calls': 0, 'retries': 0,
+                                     'throttled': 0, 'throttled_time': 0.0,
+                                     'failures': 0, 'rejected': 0,
+                                     'unresolved': 0}
+        sleep = mock.patch.object(utils.time, 'sleep')
+        self.sleep = sleep.start()
+        self.addCleanup(sleep.stop)
+
+    def test_retries_throttled(self):
+        """
+        Retries throttled.
+
+        Throttled and failed calls are retried, waiting as long as
+        Retry-After says.
+        """
+        self.utils.http = FakeHttp([
+            Response(429, headers={'Retry-After': '7'}), Response(503),
+            Response(200, {'a': 1})])
+        self.assertEqual(self.utils.send_request('url'), {'a': 1})
+        self.assertEqual(self.sleep.call_args_list[0], mock.call(7))
+        metrics = self.utils.search_metrics
+        self.assertEqual((metrics['calls'], metrics['retries'],
+                          metrics['throttled']), (3, 2, 1))
+        self.assertEqual(self.utils.search_breaker.failed, 0)
+
+    def test_gives_up(self):
+        """
+        Gives up.
+
+        Client errors are not retried, and an open breaker refuses calls
+        without sending them.
+        """
+        self.utils.http = FakeHttp([Response(400)])
+        self.assertIsNone(self.utils.send_request('url'))
+        self.assertEqual(self.utils.search_metrics['failures'], 1)
+        self.utils.http = FakeHttp([Response(500)] * 4)
+        self.assertIsNone(self.utils.send_request('url'))
+        self.assertEqual(self.utils.http.calls, 3)
+        self.assertEqual(self.utils.search_metrics['rejected'], 1)
+        self.assertEqual(self.utils.search_breaker.opens, 1)
+
+
+class SearchClientTest(unittest.TestCase):
+    """
+    Search client test.
+
+    The pooled http client.
+    """
+
+    def test_pooled_session(self):
+        """
+        Pooled session.
+
+        Both schemes share one keep-alive pool of pool_size connections,
+        that blocks instead of opening more, and keeps no cookies.
+        """
+        session = search_client(5)
+        adapter = session.get_adapter('https://www.googleapis.com')
+        self.assertIs(adapter, session.get_adapter('http://localhost'))
+        self.assertEqual(adapter._pool_maxsize, 5)
+        self.assertTrue(adapter._pool_block)
+        pool = adapter.poolmanager.connection_from_url(
+            'https://www.googleapis.com')
+        self.assertEqual(pool.pool.maxsize, 5)
+        self.assertEqual(session.headers['Connection'], 'keep-alive')
+        self.assertEqual(session.cookies.get_policy().allowed_domains(), ())
+
+
+if __name__ == '__main__':
+    unittest.main()
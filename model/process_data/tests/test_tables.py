@@ -0,0 +1,164 @@
+"""
+Table tests.
+
+Checks the batched search table reads and writes against moto, and that
+batches dynamo keeps failing are given back instead of dropped. Run from
+model/process_data with `python -m unittest tests.test_tables`.
+"""
+
+import os
+import unittest
+from unittest import mock
+import boto3
+from moto import mock_aws
+
+from utils import utils
+from utils.utils import Utils
+
+TABLE = 'search'
+
+
+class FailingClient:
+    """
+    Failing client.
+
+    Passes calls to a dynamo client, raising on the batches holding bad.
+    """
+
+    def __init__(self, client, bad):
+        """
+        Init function.
+
+        Fails every batch with the term bad in it.
+        """
+        self.client = client
+        self.bad = bad
+        self.calls = 0
+
+    def has_bad(self, request):
+        """
+        Has bad.
+
+        Whether a batch request names the bad term.
+        """
+        return f"'{self.bad}'" in str(request)
+
+    def batch_get_item(self, RequestItems):
+        """
+        Batch get item.
+
+        Raises on bad batches.
+        """
+        self.calls += 1
+        if self.has_bad(RequestItems):
+            raise RuntimeError('throttled')
+        return self.client.batch_get_item(RequestItems=RequestItems)
+
+    def batch_write_item(self, RequestItems):
+        """
+        Batch write item.
+
+        Raises on bad batches.
+        """
+        self.calls += 1
+        if self.has_bad(RequestItems):
+            raise RuntimeError('throttled')
+        return self.client.batch_write_item(RequestItems=RequestItems)
+
+
+class TablesTest(unittest.TestCase):
+    """
+    Tables test.
+
+    Reads and writes of the search table.
+    """
+
+    def setUp(self):
+        """
+        Set up.
+
+        Creates the table and a Utils using it. Only the table is set up,
+        the rest of Utils is not needed.
+        """
+        os.environ.update(AWS_DEFAULT_REGION='us-east-1',
+                          AWS_ACCESS_KEY_ID='testing',
+                          AWS_SECRET_ACCESS_KEY='testing')
+        self.aws = mock_aws()
+        self.aws.start()
+        self.client = boto3.client('dynamodb')
+        self.client.create_table(
+            TableName=TABLE,
+            KeySchema=[{'AttributeName': 'name', 'KeyType': 'HASH'}],
+            AttributeDefinitions=[{'AttributeName': 'name',
+                                   'AttributeType': 'S'}],
+            BillingMode='PAY_PER_REQUEST')
+        self.utils = Utils.__new__(Utils)
+        self.utils.env_vars = {'AWS_TABLE_NAME': TABLE}
+        self.utils.dynamodb_client = self.client
+        backoff = mock.patch.object(Utils, 'batch_backoff')
+        backoff.start()
+        self.addCleanup(backoff.stop)
+
+    def tearDown(self):
+        """
+        Tear down.
+
+        Stops moto.
+        """
+        self.aws.stop()
+
+    def puts(self, count):
+        """
+        Puts.
+
+        Items for count terms.
+        """
+        return [(f'term {i}', {f'Term {i}'}, f'content {i}')
+                for i in range(count)]
+
+    def test_round_trip(self):
+        """
+        Round trip.
+
+        Written items read back over several batches, deletes remove them.
+        """
+        self.assertEqual(self.utils.write_tables(self.puts(120)), [])
+        terms = [f'term {i}' for i in range(130)]
+        res, failed = self.utils.get_tables(terms)
+        self.assertEqual(failed, [])
+        self.assertEqual(len(res), 120)
+        self.assertEqual(res['term 7'], {'content': 'content 7',
+                                         'vendors': {'Term 7'}})
+        self.assertEqual(self.utils.write_tables(
+            deletes=[f'term {i}' for i in range(100)]), [])
+        res, failed = self.utils.get_tables(terms)
+        self.assertEqual(sorted(res), [f'term {i}' for i in range(100, 120)])
+
+    def test_failed_batches_are_given_back(self):
+        """
+        Failed batches are given back.
+
+        A batch that keeps raising is tried BATCH_ATTEMPTS times and its
+        terms come back as failed, while the other batches go through.
+        """
+        puts = self.puts(60)
+        client = FailingClient(self.client, 'term 30')
+        self.utils.dynamodb_client = client
+        failed = self.utils.write_tables(puts)
+        self.assertEqual(failed, [f'term {i}' for i in range(25, 50)])
+        self.assertEqual(client.calls, 2 + utils.BATCH_ATTEMPTS)
+        client.calls = 0
+        terms = [term for term, _, _ in puts]
+        res, failed = self.utils.get_tables(terms)
+        self.assertEqual(failed, terms)
+        self.assertEqual(res, {})
+        self.assertEqual(client.calls, utils.BATCH_ATTEMPTS)
+        self.utils.dynamodb_client = self.client
+        res, failed = self.utils.get_tables(terms)
+        self.assertEqual(sorted(res), sorted(set(terms) -
+                                             {f'term {i}'
+                                              for i in range(25, 50)}))
+
+
+if __name__ == '__main__':
+    unittest.main()
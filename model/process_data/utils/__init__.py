@@ -4,4 +4,4 @@ INIT for utils.
 init packages
 """
 
-from .utils import Utils
+from .utils import Utils, Normalizer
@@ -8,10 +8,19 @@ import pandas as pd
 import os
 from tqdm import tqdm
 import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from urllib.parse import urlencode
 from dotenv import dotenv_values
 import requests
+from requests.adapters import HTTPAdapter
+from http.cookiejar import DefaultCookiePolicy
 import boto3
 import time
+import json
+import fcntl
+import random
+import sqlite3
+from collections import OrderedDict
 import nltk
 from nltk.tokenize import word_tokenize
 from nltk.stem import SnowballStemmer
@@ -20,32 +29,334 @@ from geonamescache import GeonamesCache
 import re
 
 
-class Utils:
+# keys per BatchGetItem and items per BatchWriteItem dynamo accepts
+BATCH_GET_KEYS = 100
+BATCH_WRITE_ITEMS = 25
+# tries of a batch that raises before its keys are given back as failed
+BATCH_ATTEMPTS = 5
+
+
+class TokenBucket:
     """
-    Util class.
+    Token bucket class.
 
-    Major class for all util functions
+    Rate limiter shared by every thread searching, letting rate calls
+    through per second with bursts of up to burst calls. With a path the
+    bucket is kept in that file under a lock, so every process on the host
+    shares it too.
     """
 
-    def __init__(self, env_file):
+    def __init__(self, rate, burst, path=None):
         """
         Init function.
 
-        Initializes Util class
+        The bucket starts full.
         """
-        self.env_vars = dotenv_values(env_file)
-        self.session = boto3.Session(
-            aws_access_key_id=self.env_vars['AWS_API_KEY'],
-            aws_secret_access_key=self.env_vars['AWS_API_SECRET'],
-            region_name=self.env_vars['AWS_REGION']
-        )
+        self.rate = rate
+        self.burst = burst
+        self.path = path
+        self.tokens = burst
+        self.updated = time.time()
+        self.lock = threading.Lock()
+        self.waited = 0.0
 
-        self.dynamodb_client = self.session.client('dynamodb')
-        self.s3_client = self.session.client('s3')
-        self.api_key = self.env_vars['CUSTOM_SEARCH_API_KEY']
-        self.search_engine_id = self.env_vars['SEARCH_ENGINE_ID']
-        self.max_retries = 10
-        self.default_backoff = 3
+    def refill(self, tokens, updated):
+        """
+        Refill.
+
+        Takes a token from a bucket last seen at updated. Gives back the new
+        state and how long to wait when it was empty.
+        """
+        now = time.time()
+        tokens = min(self.burst, tokens + (now - updated) * self.rate)
+        if tokens >= 1:
+            return tokens - 1, now, 0.0
+        return tokens, now, (1 - tokens) / self.rate
+
+    def take_shared(self):
+        """
+        Take shared.
+
+        Takes a token from the bucket file.
+        """
+        with open(self.path, 'a+') as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            try:
+                f.seek(0)
+                state = f.read().split()
+                tokens, updated = ((float(state[0]), float(state[1]))
+                                   if len(state) == 2
+                                   else (self.burst, time.time()))
+                tokens, updated, wait = self.refill(tokens, updated)
+                f.seek(0)
+                f.truncate()
+                f.write(f'{tokens} {updated}')
+                f.flush()
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
+        return wait
+
+    def take(self):
+        """
+        Take.
+
+        Blocks until a token is available and takes it.
+        """
+        while True:
+            with self.lock:
+                if self.path:
+                    wait = self.take_shared()
+                else:
+                    self.tokens, self.updated, wait = self.refill(
+                        self.tokens, self.updated)
+                if wait == 0:
+                    return
+                self.waited += wait
+            time.sleep(wait)
+
+
+class CircuitBreaker:
+    """
+    Circuit breaker class.
+
+    Stops searching for cooldown seconds once failures calls in a row have
+    failed, then lets a single call through to see if the api is back.
+    """
+
+    def __init__(self, failures, cooldown):
+        """
+        Init function.
+
+        Starts closed.
+        """
+        self.failures = failures
+        self.cooldown = cooldown
+        self.failed = 0
+        self.opened = None
+        self.trial = False
+        self.opens = 0
+        self.lock = threading.Lock()
+
+    def allow(self):
+        """
+        Allow.
+
+        Whether a call may be made now.
+        """
+        with self.lock:
+            if self.opened is None:
+                return True
+            if time.monotonic() - self.opened < self.cooldown or self.trial:
+                return False
+            self.trial = True
+            return True
+
+    def success(self):
+        """
+        Success.
+
+        Closes the breaker.
+        """
+        with self.lock:
+            self.failed = 0
+            self.opened = None
+            self.trial = False
+
+    def failure(self):
+        """
+        Failure.
+
+        Counts a failed call, opening the breaker after too many.
+        """
+        with self.lock:
+            self.failed += 1
+            if self.trial or (self.opened is None
+                              and self.failed >= self.failures):
+                self.opened = time.monotonic()
+                self.opens += 1
+            self.trial = False
+
+    def wait(self):
+        """
+        Wait.
+
+        Sleeps until an open breaker lets a trial call through.
+        """
+        with self.lock:
+            if self.opened is None:
+                return
+            delay = self.cooldown - (time.monotonic() - self.opened)
+        if delay > 0:
+            time.sleep(delay)
+
+
+def search_client(pool_size, http2=False):
+    """
+    Search client.
+
+    HTTP client shared by every thread searching, keeping up to pool_size
+    connections alive. http2 uses httpx when it is installed with h2.
+    """
+    if http2:
+        try:
+            import httpx
+            return httpx.Client(http2=True, limits=httpx.Limits(
+                max_connections=pool_size,
+                max_keepalive_connections=pool_size))
+        except ImportError:
+            print("httpx[http2] is not installed, using requests")
+    session = requests.Session()
+    # nothing is kept between calls, so threads can share the session
+    session.cookies.set_policy(DefaultCookiePolicy(allowed_domains=[]))
+    adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size,
+                          pool_block=True)
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    session.headers['Connection'] = 'keep-alive'
+    return session
+
+
+def write_term(write):
+    """
+    Write term.
+
+    The term a BatchWriteItem request puts or deletes.
+    """
+    if 'PutRequest' in write:
+        return write['PutRequest']['Item']['name']['S']
+    return write['DeleteRequest']['Key']['name']['S']
+
+
+class SearchCache:
+    """
+    Search cache class.
+
+    Search table items kept by cleaned vendor in an in-memory LRU, in front
+    of an optional sqlite file that outlives the run. Entries older than ttl
+    seconds are misses.
+    """
+
+    def __init__(self, max_entries, ttl, path=None, max_disk_entries=None):
+        """
+        Init function.
+
+        Keeps up to max_entries in memory and max_disk_entries on disk.
+        """
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.max_disk_entries = max_disk_entries
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.db = None
+        if path:
+            self.db = sqlite3.connect(path, check_same_thread=False)
+            self.db.execute('CREATE TABLE IF NOT EXISTS search (name TEXT '
+                            'PRIMARY KEY, vendors TEXT, content TEXT, '
+                            'stored REAL)')
+            self.db.execute('CREATE INDEX IF NOT EXISTS search_stored ON '
+                            'search (stored)')
+            self.db.commit()
+
+    def remember(self, term, item, stored):
+        """
+        Remember.
+
+        Keeps an item in memory, evicting the least recently used.
+        """
+        self.entries[term] = (item, stored)
+        self.entries.move_to_end(term)
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+
+    def get_many(self, terms):
+        """
+        Get many.
+
+        Gives back the fresh items of terms, from memory or else disk.
+        """
+        now = time.time()
+        res = {}
+        with self.lock:
+            missing = []
+            for term in terms:
+                entry = self.entries.get(term)
+                if entry is not None and now - entry[1] < self.ttl:
+                    self.entries.move_to_end(term)
+                    res[term] = entry[0]
+                else:
+                    self.entries.pop(term, None)
+                    missing.append(term)
+            self.hits += len(res)
+            if self.db is not None:
+                for i in range(0, len(missing), 500):
+                    chunk = missing[i:i + 500]
+                    rows = self.db.execute(
+                        'SELECT name, vendors, content, stored FROM search '
+                        'WHERE stored > ? AND name IN ({})'.format(
+                            ','.join('?' * len(chunk))),
+                        [now - self.ttl] + chunk).fetchall()
+                    for name, vendors, content, stored in rows:
+                        item = {'content': content,
+                                'vendors': set(json.loads(vendors))}
+                        self.remember(name, item, stored)
+                        res[name] = item
+                        self.disk_hits += 1
+            self.misses += len(terms) - len(res)
+        return res
+
+    def put_many(self, items):
+        """
+        Put many.
+
+        Stores items by term, in memory and on disk.
+        """
+        now = time.time()
+        with self.lock:
+            for term, item in items.items():
+                self.remember(term, item, now)
+            if self.db is None:
+                return
+            self.db.executemany(
+                'INSERT OR REPLACE INTO search VALUES (?, ?, ?, ?)',
+                [(term, json.dumps(sorted(item['vendors'])), item['content'],
+                  now) for term, item in items.items()])
+            self.db.execute('DELETE FROM search WHERE stored <= ?',
+                            (now - self.ttl,))
+            if self.max_disk_entries:
+                self.db.execute(
+                    'DELETE FROM search WHERE name IN (SELECT name FROM '
+                    'search ORDER BY stored DESC LIMIT -1 OFFSET ?)',
+                    (self.max_disk_entries,))
+            self.db.commit()
+
+    def metrics(self):
+        """
+        Metrics.
+
+        Memory hits, disk hits and misses.
+        """
+        with self.lock:
+            return {'hits': self.hits, 'disk_hits': self.disk_hits,
+                    'misses': self.misses, 'entries': len(self.entries)}
+
+
+class Normalizer:
+    """
+    Normalizer class.
+
+    Vendor clean up behind Utils.token_and_stem, usable without the aws and
+    search setup of Utils.
+    """
+
+    def __init__(self):
+        """
+        Init function.
+
+        Loads the stop words, stemmer and place names.
+        """
         nltk.download('punkt')
         nltk.download('stopwords')
         self.stemmer = SnowballStemmer("english")
@@ -138,6 +449,79 @@ class Utils:
             return item
         return res.lower()
 
+
+class Utils:
+    """
+    Util class.
+
+    Major class for all util functions
+    """
+
+    def __init__(self, env_file):
+        """
+        Init function.
+
+        Initializes Util class
+        """
+        self.env_vars = dotenv_values(env_file)
+        self.session = boto3.Session(
+            aws_access_key_id=self.env_vars['AWS_API_KEY'],
+            aws_secret_access_key=self.env_vars['AWS_API_SECRET'],
+            region_name=self.env_vars['AWS_REGION']
+        )
+
+        self.dynamodb_client = self.session.client('dynamodb')
+        self.s3_client = self.session.client('s3')
+        self.api_key = self.env_vars['CUSTOM_SEARCH_API_KEY']
+        self.search_engine_id = self.env_vars['SEARCH_ENGINE_ID']
+        self.max_retries = 10
+        self.default_backoff = 3
+        self.search_url = self.env_vars.get(
+            'SEARCH_URL', 'https://www.googleapis.com/customsearch/v1')
+        self.search_workers = int(self.env_vars.get('SEARCH_WORKERS', 8))
+        # the custom search quota is 100 queries a minute by default
+        self.search_limiter = TokenBucket(
+            float(self.env_vars.get('SEARCH_RATE', 1.6)),
+            float(self.env_vars.get('SEARCH_BURST', 10)),
+            self.env_vars.get('SEARCH_LIMITER_PATH'))
+        self.search_breaker = CircuitBreaker(
+            int(self.env_vars.get('SEARCH_BREAKER_FAILURES', 5)),
+            float(self.env_vars.get('SEARCH_BREAKER_COOLDOWN', 60)))
+        self.max_backoff = float(self.env_vars.get('SEARCH_MAX_BACKOFF', 60))
+        self.search_timeout = float(self.env_vars.get('SEARCH_TIMEOUT', 30))
+        self.search_cache = SearchCache(
+            int(self.env_vars.get('SEARCH_CACHE_ENTRIES', 100000)),
+            float(self.env_vars.get('SEARCH_CACHE_TTL', 30 * 24 * 3600)),
+            self.env_vars.get('SEARCH_CACHE_PATH'),
+            int(self.env_vars.get('SEARCH_CACHE_DISK_ENTRIES', 1000000)))
+        self.http = search_client(
+            int(self.env_vars.get('SEARCH_POOL_SIZE', 16)),
+            self.env_vars.get('SEARCH_HTTP2', 'false').lower() == 'true')
+        self.metrics_lock = threading.Lock()
+        self.search_metrics = {'calls': 0, 'retries': 0, 'throttled': 0,
+                               'throttled_time': 0.0, 'failures': 0,
+                               'rejected': 0, 'unresolved': 0}
+        self.normalizer = Normalizer()
+        self.stemmer = self.normalizer.stemmer
+        self.stop_words = self.normalizer.stop_words
+        self.place_names = self.normalizer.place_names
+
+    def remove_city(self, word):
+        """
+        Remove City.
+
+        Removes cities from a string.
+        """
+        return self.normalizer.remove_city(word)
+
+    def token_and_stem(self, item):
+        """
+        Token and Stem.
+
+        Cleans up a vendor and returns it.
+        """
+        return self.normalizer.token_and_stem(item)
+
     def to_pandas(inf, outf):
         """
         To pandas.
@@ -163,75 +547,114 @@ class Utils:
         df_filtered = df[df['label'].str.lower() != 'unmapped']
         df_filtered.to_csv(outf, index=False)
 
+    def count(self, name, amount=1):
+        """
+        Count.
+
+        Adds to a search metric.
+        """
+        with self.metrics_lock:
+            self.search_metrics[name] += amount
+
+    def metrics(self):
+        """
+        Metrics.
+
+        Search calls, retries, throttled responses, seconds spent waiting on
+        the limiter or backing off, calls the circuit breaker refused and
+        vendors enrich gave no search result.
+        """
+        with self.metrics_lock:
+            res = dict(self.search_metrics)
+        res['throttled_time'] += self.search_limiter.waited
+        res['breaker_opens'] = self.search_breaker.opens
+        res['cache'] = self.search_cache.metrics()
+        return res
+
+    def backoff(self, attempt, retry_after=None):
+        """
+        Backoff.
+
+        Sleeps before retry attempt, exponential with full jitter unless the
+        api said how long to wait.
+        """
+        if retry_after is not None:
+            delay = min(self.max_backoff, retry_after)
+        else:
+            delay = random.uniform(0, min(self.max_backoff,
+                                          self.default_backoff * 2 ** attempt))
+        self.count('retries')
+        self.count('throttled_time', delay)
+        time.sleep(delay)
+
     def send_request(self, url):
         """
         Send request.
 
-        Sends a request to google search
+        Sends a request to google search, retrying throttled and failed
+        requests up to max_retries times. Gives back None when it could not.
         """
-        retries = 0
-
-        while retries < self.max_retries:
+        for attempt in range(self.max_retries):
+            if not self.search_breaker.allow():
+                self.count('rejected')
+                return None
+            self.search_limiter.take()
+            self.count('calls')
             try:
-                response = requests.get(url)
-
-                if response.status_code == 200:
-                    data = response.json()
-                    return data
-                elif response.status_code == 429:
-                    if 'Retry-After' in response.headers:
-                        retry_after = int(response.headers['Retry-After'])
-                        print("Received 429 error. Retrying after "
-                              "{} seconds...".format(retry_after))
-                        time.sleep(retry_after)
-                    else:
-                        print("Received 429 error. Retrying after "
-                              "default delay...")
-                        time.sleep(self.default_backoff)
-                else:
-                    print("Request failed with status code:",
-                          response.status_code)
-                    return None
+                response = self.http.get(url, timeout=self.search_timeout)
             except Exception as e:
                 print("An error occurred:", e)
+                self.search_breaker.failure()
+                self.backoff(attempt)
                 continue
-
-            retries += 1
-        print("Max retries reached for {url} . Request failed.")
-        return " "
+            if response.status_code == 200:
+                self.search_breaker.success()
+                return response.json()
+            if response.status_code == 429 or response.status_code >= 500:
+                if response.status_code == 429:
+                    self.count('throttled')
+                print("Received {} error. Retrying...".format(
+                    response.status_code))
+                self.search_breaker.failure()
+                retry_after = response.headers.get('Retry-After')
+                self.backoff(attempt, int(retry_after)
+                             if retry_after and retry_after.isdigit()
+                             else None)
+                continue
+            print("Request failed with status code:", response.status_code)
+            self.count('failures')
+            return None
+        print("Max retries reached. Request failed.")
+        self.count('failures')
+        return None
 
     def get_search(self, term):
         """
         Get search.
 
-        Get's results from google search.
+        Get's results from google search, trying again while a search that
+        has results comes back without them. Gives back None when the search
+        failed.
         """
-        url = (f'https://www.googleapis.com/customsearch/v1?key={self.api_key}'
-               f'&cx={self.search_engine_id}&q={term}')
-        try:
+        url = self.search_url + '?' + urlencode({
+            'key': self.api_key, 'cx': self.search_engine_id, 'q': term})
+        for attempt in range(self.max_retries):
             data = self.send_request(url)
-        except Exception as e:
-            print(f'search for {term} failed with {e}')
-            time.sleep(1)
-            return self.get_search(term)
-
-        if not data:
-            return self.get_search(term)
-
-        res = ""
-        if 'searchInformation' in data:
-            if data['searchInformation']['totalResults'] == "0":
-                return ""
-        if 'items' in data:
-            for item in data['items']:
+            if data is None:
+                return None
+            if 'searchInformation' in data:
+                if data['searchInformation']['totalResults'] == "0":
+                    return ""
+            res = ""
+            for item in data.get('items', []):
                 if 'title' in item:
                     res += item['title'] + " "
                 if 'snippet' in item:
                     res += item['snippet'] + " "
-        if res == "":
-            time.sleep(1)
-            return self.get_search(term)
-        return res
+            if res != "":
+                return res
+            self.backoff(attempt)
+        return ""
 
     def get_table(self, term):
         """
@@ -294,6 +717,22 @@ class Utils:
         except Exception as e:
             print(f"An error occurred: {e}")
 
+    def add_vendors(self, term, vendors):
+        """
+        Add vendors.
+
+        Adds vendors to an existing item in the table in one update.
+        """
+        try:
+            self.dynamodb_client.update_item(
+                TableName=self.env_vars['AWS_TABLE_NAME'],
+                Key={'name': {'S': term}},
+                UpdateExpression="ADD vendors :v",
+                ExpressionAttributeValues={':v': {'SS': vendors}}
+            )
+        except Exception as e:
+            print(f"An error occurred: {e}")
+
     def append_table(self, term, vendor):
         """
         Append table.
@@ -324,6 +763,97 @@ class Utils:
         except Exception as e:
             print(f"An error occurred: {e}")
 
+    def get_tables(self, terms):
+        """
+        Get tables.
+
+        Get's many items from the db, 100 keys per BatchGetItem, asking
+        again for keys dynamo left unprocessed. A batch that keeps raising
+        is tried BATCH_ATTEMPTS times. Gives back the content and vendors of
+        every term found, and the terms that could not be read.
+        """
+        table = self.env_vars['AWS_TABLE_NAME']
+        res = {}
+        failed = []
+        terms = list(terms)
+        for i in range(0, len(terms), BATCH_GET_KEYS):
+            request = {table: {'Keys': [{'name': {'S': term}} for term
+                                        in terms[i:i + BATCH_GET_KEYS]]}}
+            attempt = 0
+            while request:
+                try:
+                    response = self.dynamodb_client.batch_get_item(
+                        RequestItems=request)
+                except Exception as e:
+                    keys = request[table]['Keys']
+                    print(f"An error occurred reading {len(keys)} terms: {e}")
+                    attempt += 1
+                    if attempt == BATCH_ATTEMPTS:
+                        failed += [key['name']['S'] for key in keys]
+                        break
+                    self.batch_backoff(attempt)
+                    continue
+                for item in response.get('Responses', {}).get(table, []):
+                    res[item['name']['S']] = {
+                        'content': item['content']['S'],
+                        'vendors': set(item.get('vendors', {}).get('SS', []))}
+                request = response.get('UnprocessedKeys')
+                if request:
+                    self.batch_backoff(attempt)
+                    attempt += 1
+        return res, failed
+
+    def write_tables(self, puts=None, deletes=None):
+        """
+        Write tables.
+
+        Puts (term, vendors, content) items into the db and deletes terms
+        from it, 25 per BatchWriteItem, sending again whatever dynamo left
+        unprocessed. A put replaces the whole item, spellings of existing
+        items go through add_vendors instead. A batch that keeps raising is
+        tried BATCH_ATTEMPTS times. Gives back the terms that could not be
+        written.
+        """
+        table = self.env_vars['AWS_TABLE_NAME']
+        writes = [{'PutRequest': {'Item': {
+            'name': {'S': term},
+            'vendors': {'SS': sorted(vendors)},
+            'content': {'S': content},
+        }}} for term, vendors, content in puts or []]
+        writes += [{'DeleteRequest': {'Key': {'name': {'S': term}}}}
+                   for term in deletes or []]
+        failed = []
+        for i in range(0, len(writes), BATCH_WRITE_ITEMS):
+            request = {table: writes[i:i + BATCH_WRITE_ITEMS]}
+            attempt = 0
+            while request:
+                try:
+                    response = self.dynamodb_client.batch_write_item(
+                        RequestItems=request)
+                except Exception as e:
+                    print(f"An error occurred writing {len(request[table])} "
+                          f"terms: {e}")
+                    attempt += 1
+                    if attempt == BATCH_ATTEMPTS:
+                        failed += [write_term(write)
+                                   for write in request[table]]
+                        break
+                    self.batch_backoff(attempt)
+                    continue
+                request = response.get('UnprocessedItems')
+                if request:
+                    self.batch_backoff(attempt)
+                    attempt += 1
+        return failed
+
+    def batch_backoff(self, attempt):
+        """
+        Batch backoff.
+
+        Sleeps before sending unprocessed keys again.
+        """
+        time.sleep(random.uniform(0, min(1, 0.05 * 2 ** attempt)))
+
     def get_object(self, vendor):
         """
         Get object.
@@ -339,9 +869,103 @@ class Utils:
             self.append_table(clean_vendor, vendor)
             return table_res
         search_res = self.get_search(vendor)
-        self.put_table(clean_vendor, vendor, search_res)
+        if search_res is not None:
+            self.put_table(clean_vendor, vendor, search_res)
         return search_res
 
+    def enrich(self, vendors, bar=None):
+        """
+        Enrich.
+
+        Get's search results for many vendors at once. Vendors are grouped by
+        their cleaned name, the names are looked up in the search cache,
+        then read from the db in batches, and the missing ones searched on a
+        pool of search_workers threads. New items are written back in
+        batches and new spellings of existing items added to them one
+        update each. Searches that failed, or that the circuit breaker
+        refused, are tried once more after its cooldown; vendors still
+        without a result are reported and come back as None, as do those
+        whose names could not be read from the db. Results that could not
+        be written are reported and kept out of the search cache, so the
+        next run searches them again. bar is moved on by one per vendor.
+        """
+        terms = {}
+        for vendor in vendors:
+            terms.setdefault(self.token_and_stem(vendor), []).append(vendor)
+        found = self.search_cache.get_many(list(terms))
+        fetched, unread = self.get_tables([term for term in terms
+                                           if term not in found])
+        found.update(fetched)
+        # an unread name may be in the db, searching it would replace it
+        if unread:
+            print(f"Could not read {len(unread)} names from the db, e.g. "
+                  f"{unread[:5]}")
+        unread = set(unread)
+        res = {}
+        merges = []
+        for term, item in found.items():
+            spellings = terms[term]
+            for vendor in spellings:
+                res[vendor] = item['content']
+            new = set(spellings) - item['vendors']
+            if new:
+                item['vendors'] = item['vendors'].union(new)
+                fetched[term] = item
+                merges.append((term, sorted(new)))
+            if bar is not None:
+                bar.update(len(spellings))
+        missing = [term for term in terms
+                   if term not in found and term not in unread]
+        puts = []
+        unwritten = []
+        with ThreadPoolExecutor(max_workers=self.search_workers) as pool:
+            for term, spellings in merges:
+                pool.submit(self.add_vendors, term, spellings)
+            for attempt in range(2):
+                if attempt and missing:
+                    print(f"Searching {len(missing)} failed names again")
+                    self.search_breaker.wait()
+                futures = {pool.submit(self.get_search, terms[term][0]): term
+                           for term in missing}
+                missing = []
+                for future in as_completed(futures):
+                    term = futures[future]
+                    content = future.result()
+                    # failed searches are not stored, the next run tries
+                    # again
+                    if content is None:
+                        missing.append(term)
+                        continue
+                    for vendor in terms[term]:
+                        res[vendor] = content
+                    fetched[term] = {'vendors': set(terms[term]),
+                                     'content': content}
+                    puts.append((term, set(terms[term]), content))
+                    if len(puts) >= BATCH_WRITE_ITEMS:
+                        unwritten += self.write_tables(puts)
+                        puts = []
+                    if bar is not None:
+                        bar.update(len(terms[term]))
+        unwritten += self.write_tables(puts)
+        for term in unwritten:
+            fetched.pop(term, None)
+        if unwritten:
+            print(f"Could not write {len(unwritten)} search results to the "
+                  f"db, e.g. {unwritten[:5]}")
+        unresolved = [vendor for term in missing + list(unread)
+                      for vendor in terms[term]]
+        for vendor in unresolved:
+            res[vendor] = None
+        if unresolved:
+            self.count('unresolved', len(unresolved))
+            print(f"No search result for {len(unresolved)} vendors, e.g. "
+                  f"{unresolved[:5]}")
+        if bar is not None:
+            bar.update(len(unresolved))
+        # items read, changed or searched in this run
+        self.search_cache.put_many(fetched)
+        return res
+
     def get_random(self, num=10):
         """
         Get random.
@@ -408,16 +1032,14 @@ class Utils:
         Adds search results to csv.
         """
         df = pd.read_csv(inf)
+        vendors = df['vendor'].dropna().astype(str)
+        vendors = vendors[vendors != '']
 
-        overall_bar = tqdm(total=len(df), desc=f"Processing {inf}", position=0)
-
-        def apply_with_progress(row):
-            result = self.get_object(row['vendor'])
-            overall_bar.update(1)
-            return result
-
-        df['search'] = df.apply(apply_with_progress, axis=1)
+        overall_bar = tqdm(total=vendors.nunique(), desc=f"Processing {inf}",
+                           position=0)
+        results = self.enrich(vendors.unique(), overall_bar)
         overall_bar.close()
+        df['search'] = vendors.map(results).reindex(df.index)
         df.to_csv(outf, index=False)
         self.sync_s3(outf)
 
@@ -427,21 +1049,39 @@ class Utils:
 
         Take each one of the vendors dictionary, clean it and put the new items
         into the db
-        then delete all of the old items.
+        then delete all of the old items. Items are read and written in
+        batches. Gives back the terms that could not be read or written;
+        when reads failed nothing is written, as the old items are not
+        known.
         """
+        cleans = {vendor: self.token_and_stem(vendor) for vendor in vendors}
+        existing, unread = self.get_tables(set(vendors) |
+                                           set(cleans.values()))
+        if unread:
+            print(f"Could not read {len(unread)} items, nothing migrated")
+            return unread
+        items = {}
         for vendor, content in tqdm(vendors.items(),
                                     desc="Migrating",
                                     position=0):
-
-            clean_vendor = self.token_and_stem(vendor)
-            old_item = self.get_table(vendor)
-            if old_item:
-                self.delete_table(vendor)
-            new_item = self.get_table(clean_vendor)
-            if new_item:
-                self.append_table(clean_vendor, vendor)
-            else:
-                self.put_table(clean_vendor, vendor, content)
+            clean_vendor = cleans[vendor]
+            if clean_vendor not in items:
+                # a clean name that was also an old name starts over, as it
+                # was deleted before being read one vendor at a time
+                old = existing.get(clean_vendor)
+                if old is not None and clean_vendor not in vendors:
+                    items[clean_vendor] = (old['vendors'], old['content'])
+                else:
+                    items[clean_vendor] = (set(), content)
+            items[clean_vendor][0].add(vendor)
+        deletes = [vendor for vendor in vendors
+                   if vendor in existing and vendor not in items]
+        failed = self.write_tables([(term, spellings, content) for term,
+                                    (spellings, content) in items.items()],
+                                   deletes)
+        if failed:
+            print(f"Could not write {len(failed)} items, e.g. {failed[:5]}")
+        return failed
 
     def iterate(in_dir, out_dir, function):
         """